@@ -1,8 +1,74 @@
+import asyncio
+import contextlib
 import datetime
+import functools
 import gzip
+import heapq
 import io
-from collections import OrderedDict
-from typing import NamedTuple, BinaryIO, List, Dict, TextIO, Optional
+import itertools
+import json
+import operator
+import os
+import tempfile
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import (
+    Any,
+    Collection,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    BinaryIO,
+    List,
+    Dict,
+    Optional,
+    Iterator,
+    Iterable,
+    Callable,
+    Deque,
+    TypeVar,
+    Union,
+)
+
+from aliquot_level_maf.cache import SegmentCache, file_content_key
+from aliquot_level_maf.columnar import ColumnarWriter
+from aliquot_level_maf.compression import (
+    BgzfWriter,
+    GzipMemberWriter,
+    MappedGzipReader,
+    ParallelGzipWriter,
+    read_gzip_members,
+)
+from aliquot_level_maf.dedup import SpillingKeySet, hash_key
+from aliquot_level_maf.index import (
+    AliquotIndex,
+    AliquotIndexEntry,
+    RegionIndexingWriter,
+)
+
+# Size of the decompressed blocks copied from each input body into the output.
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Number of rows written to the output at once when rows are processed one by one.
+_ROW_BATCH_SIZE = 1024
+
+# Maximum compressed size of the inputs of a shard compressed on a worker process.
+_MAX_SHARD_SIZE = 16 * 1024 * 1024
+
+# The default memory budget of the keys of deduplicated rows.
+DEFAULT_DEDUP_MEMORY = 256 * 1024 * 1024
+
+# The default order of chromosomes when sorting by coordinate.
+DEFAULT_CHROMOSOME_ORDER = [f"chr{i}" for i in range(1, 23)] + ["chrX", "chrY", "chrM"]
+
+_T = TypeVar("_T")
+_U = TypeVar("_U")
 
 
 class ValidationError(Exception):
@@ -14,6 +80,9 @@ class ValidationError(Exception):
     """
 
     def __init__(self, message, details):
+        # Passing the arguments on lets the error be pickled, so that it is raised
+        # unchanged from worker processes.
+        super().__init__(message, details)
         self.message = message
         self.details = details
 
@@ -27,15 +96,123 @@ class AliquotLevelMaf(NamedTuple):
     The file is assumed to be gzipped.
 
     Attributes:
-        file: A file-like object representing the content of aliquot-level MAF file.
+        file: A file-like object representing the content of aliquot-level MAF file,
+              or the path of a local file.  Local files are memory-mapped and
+              decompressed without intermediate copies.
+        tumor_aliquot_submitter_id: The submitter id of the tumor aliquot.
+    """
+
+    file: Union[BinaryIO, str, "os.PathLike[str]"]
+    tumor_aliquot_submitter_id: str
+
+
+class RowFilter(NamedTuple):
+    """A predicate on the value of a column, used to filter aggregated rows.
+
+    Attributes:
+        column: The name of the column to test.
+        values: The values the column is compared with.
+        exclude: If false, only rows whose value is one of values are kept.  If true,
+                 those rows are dropped instead.
+        separator: If given, the column holds a list of values separated by it, such
+                   as GDC_FILTER, and a row matches if any of them is one of values.
+    """
+
+    column: str
+    values: Collection[str]
+    exclude: bool = False
+    separator: Optional[str] = None
+
+
+class FileStats(NamedTuple):
+    """Statistics of one input of aggregate_mafs.
+
+    Attributes:
         tumor_aliquot_submitter_id: The submitter id of the tumor aliquot.
+        skipped: Whether the input was skipped because its content was empty or the
+                 user does not have access to it.
+        seconds: The time spent adding the input to the output on the writing
+                 thread.  It includes decompression unless the input was
+                 decompressed ahead on a thread pool or process pool.  When sorting
+                 by coordinate, the rows of all inputs are interleaved, so it only
+                 includes validation.
+        decompression_seconds: The time spent decompressing the input, on
+                               whichever thread or process did it.
+        compressed_bytes: The size of the compressed input, or 0 if it cannot be
+                          determined because the input is not seekable.
+        uncompressed_bytes: The size of the rows of the input written to the output.
+                            It is 0 when sorting by coordinate.
+        row_count: The number of rows of the input written to the output.  It is 0
+                   when sorting by coordinate.
     """
 
-    file: BinaryIO
     tumor_aliquot_submitter_id: str
+    skipped: bool
+    seconds: float
+    decompression_seconds: float
+    compressed_bytes: int
+    uncompressed_bytes: int
+    row_count: int
 
 
-def aggregate_mafs(mafs: List[AliquotLevelMaf], output: BinaryIO) -> None:
+class AggregationStats(NamedTuple):
+    """Statistics of a run of aggregate_mafs.
+
+    Attributes:
+        files: The statistics of each input, in the order of the inputs.
+        seconds: The total time of the run.
+        decompression_seconds: The total time spent decompressing inputs.  Inputs
+                               decompressed concurrently count separately, so it can
+                               exceed seconds.
+        compression_seconds: The time spent writing rows to the compressed output,
+                             including compression, on the writing thread.
+        validation_seconds: The time spent validating headers.
+        compressed_bytes: The size of the compressed output, or 0 if it cannot be
+                          determined because the output is not seekable.
+        uncompressed_bytes: The size of the rows written to the output.
+        row_count: The number of rows written to the output.
+        duplicate_count: The number of duplicate rows dropped by deduplication.
+    """
+
+    files: List[FileStats]
+    seconds: float
+    decompression_seconds: float
+    compression_seconds: float
+    validation_seconds: float
+    compressed_bytes: int
+    uncompressed_bytes: int
+    row_count: int
+    duplicate_count: int = 0
+
+    @property
+    def skipped(self) -> List[str]:
+        """The submitter ids of the skipped inputs."""
+        return [f.tumor_aliquot_submitter_id for f in self.files if f.skipped]
+
+
+def aggregate_mafs(
+    mafs: List[AliquotLevelMaf],
+    output: BinaryIO,
+    decompression_threads: int = 0,
+    read_ahead: Optional[int] = None,
+    compression_level: int = 9,
+    compression_threads: int = 0,
+    preflight: bool = False,
+    sort_by_coordinate: bool = False,
+    chromosome_order: Optional[Sequence[str]] = None,
+    columns: Optional[Sequence[str]] = None,
+    filters: Optional[Sequence[RowFilter]] = None,
+    bgzf: bool = False,
+    region_index: Optional[BinaryIO] = None,
+    aliquot_index: Optional[BinaryIO] = None,
+    cache: Optional[SegmentCache] = None,
+    processes: int = 0,
+    on_file: Optional[Callable[["FileStats"], None]] = None,
+    deduplicate: Optional[Sequence[str]] = None,
+    dedup_memory: int = DEFAULT_DEDUP_MEMORY,
+    union_columns: bool = False,
+    columnar: bool = False,
+) -> "AggregationStats":
     """Aggregate a given list of aliquot-level MAF files.
 
     The aliquot-level MAF files will be combined into a single MAF file and written to
@@ -44,49 +221,1913 @@ def aggregate_mafs(mafs: List[AliquotLevelMaf], output: BinaryIO) -> None:
     The input files are assumed to be gzipped MAF files.  The output will be written
     as a gzipped MAF file.
 
+    Once the headers of an input have been parsed and validated, its body is copied
+    to the output in large decompressed blocks without being split into lines or
+    decoded.
+
+    If decompression_threads is given, upcoming inputs are decompressed and parsed on
+    a thread pool while earlier inputs are being written.  The output is still
+    written in the order of mafs.  At most read_ahead inputs are held decompressed
+    in memory at any time.
+
+    If compression_threads is given, the output is split into fixed-size chunks that
+    are compressed as independent gzip members on a thread pool.  The result is
+    still a single valid gzip file.
+
+    If preflight is set, the file and column headers of every input are read
+    concurrently and validated before anything is written, and every mismatch is
+    reported in a single ValidationError.  The body pass then continues from the
+    same readers, so the headers are only decompressed once.  All inputs are open
+    at the same time in this mode.
+
+    If sort_by_coordinate is set, the inputs, which must each be sorted by
+    coordinate, are merged into an output sorted by Chromosome and Start_Position
+    instead of being concatenated.  Only one row per input is buffered.  Inputs are
+    validated as with preflight, and the output header gets a
+    `#sort.order Coordinate` pragma.
+
+    If columns is given, only those columns are written, in the given order.  Their
+    positions are resolved once from the column headers of the first input, and
+    each row is then split just far enough to pick them.
+
+    If filters are given, only rows accepted by every filter are written.  Filters
+    are compiled once against the column headers.  Rows that do not contain any of
+    a filter's values are accepted or rejected without being split.
+
+    If bgzf is set, the output is compressed in the BGZF format used by htslib,
+    which gzip readers still read as a single gzip file.  If region_index is given,
+    the output is BGZF-compressed and an index of the rows by Chromosome,
+    Start_Position and End_Position is built during the same pass and written to
+    region_index.  index.read_region uses it to read only the blocks overlapping a
+    region.  Combined with sort_by_coordinate, each region maps to a few blocks.
+
+    If aliquot_index is given, the headers and the rows of each input are written in
+    their own gzip members, and the compressed and uncompressed offsets and the row
+    count of each are written to aliquot_index.  index.read_aliquot uses it to read
+    the rows of one aliquot without decompressing the rest of the output.  This
+    cannot be combined with sort_by_coordinate, which interleaves the rows.
+
+    If deduplicate is given, a row is dropped if its values in those columns, such
+    as Chromosome, Start_Position, Reference_Allele, Tumor_Seq_Allele2 and
+    Tumor_Sample_UUID, are the same as those of a row written before it.  Rows are
+    deduplicated after filtering and before projection, so the columns do not need
+    to be written.  The values of each written row are kept as a 16-byte hash, in
+    memory up to about dedup_memory bytes and then in temporary files, with a filter
+    of the keys in the files taking 2 to 4 bytes per key in memory.  The number
+    of dropped rows is reported in the returned statistics.  Deduplication depends
+    on the preceding inputs, so it cannot be combined with cache or processes.
+
+    If union_columns is set, the inputs may have different columns.  Their column
+    headers are read and validated as with preflight, and the output gets the
+    union of them: the columns of the first input, followed by the other columns in
+    the order they first appear.  A fixed permutation of the columns is compiled
+    for each input and applied to its rows, and columns missing from an input are
+    left empty.  Inputs with the columns of the output are copied unchanged, and
+    the rows of inputs with a prefix of them, such as the first input, are only
+    padded.  columns, filters and deduplicate refer to the union of the columns.
+
+    If columnar is set, the output is written in the columnar binary format of
+    columnar.ColumnarWriter instead of as a gzipped MAF, in row groups of bounded
+    size, with dictionary encoding for columns with repeated values and integer
+    encoding for positions and counts.  columnar.ColumnarReader reads some of its
+    columns without reading the others.  It cannot be combined with the options
+    writing gzip members: compression_threads, bgzf, region_index, aliquot_index,
+    cache and processes.
+
+    Statistics of the run are returned, including timings and sizes of each input
+    and the inputs that were skipped because they were empty or inaccessible.  They
+    are collected per block or batch of rows written, so they cost next to nothing.
+    If on_file is given, it is called with the statistics of each input as soon as
+    it has been handled, which can be used to report progress.
+
+    If cache is given, the compressed body of each input is looked up in it by a
+    hash of the compressed input and of the options affecting the body.  On a hit,
+    the headers are validated from the cached metadata and the cached gzip members
+    are copied to the output without decompressing anything.  On a miss, the body
+    is compressed into its own gzip members and added to the cache.  Inputs are
+    then read one at a time, and the cache cannot be combined with
+    decompression_threads, compression_threads, preflight, sort_by_coordinate or
+    BGZF output.
+
+    If processes is given, the inputs are split into shards of consecutive inputs
+    that are validated and compressed on a process pool, which avoids contending
+    for the GIL on per-row work such as filters.  Each body is compressed into its
+    own gzip members, and the members are concatenated to the output in the order
+    of mafs.  The compressed inputs of the shards in flight are sent to the
+    workers, so the inputs do not need to be picklable.  This cannot be combined
+    with the options excluded by cache, nor with cache itself.
+
     Args:
         mafs: A list of aliquot-level MAF files with metadata.
         output: A file-like object to write the aggregated MAF file.
+        decompression_threads: The number of threads used to decompress inputs.  When
+                               0, inputs are decompressed one at a time on the
+                               calling thread.
+        read_ahead: The maximum number of inputs decompressed ahead of the one being
+                    written.  Defaults to twice decompression_threads.
+        compression_level: The gzip compression level of the output, from 0 to 9.
+        compression_threads: The number of threads used to compress the output.  When
+                             0, the output is compressed on the calling thread.
+        preflight: Whether to validate the headers of all inputs before writing.
+        sort_by_coordinate: Whether to merge the inputs into a coordinate-sorted
+                            output.
+        chromosome_order: The order of chromosomes when sorting by coordinate.
+                          Chromosomes missing from it are sorted after it by name.
+                          Defaults to DEFAULT_CHROMOSOME_ORDER.
+        columns: The names of the columns to write.  Defaults to all of them.
+        filters: Filters that every written row must pass.
+        bgzf: Whether to write the output in the BGZF format.
+        region_index: A file-like object to write a region index of the output to.
+        aliquot_index: A file-like object to write an aliquot index of the output to.
+        cache: A cache of compressed input bodies.
+        processes: The number of processes used to validate and compress inputs.
+                   When 0, no process pool is used.
+        on_file: A function called with the statistics of each input once it has
+                 been written or skipped, in the order of mafs.
+        deduplicate: The names of the columns identifying duplicate rows.
+        dedup_memory: The approximate memory in bytes used for the keys of
+                      deduplicated rows before they are spilled to disk, not
+                      counting the filter of the spilled keys.
+        union_columns: Whether to accept inputs with different columns and write
+                       the union of their columns.
+        columnar: Whether to write the output in the columnar binary format.
+
+    Returns:
+        Statistics of the aggregation.
+    """
+    if not mafs:
+        return AggregationStats(
+            files=[],
+            seconds=0.0,
+            decompression_seconds=0.0,
+            compression_seconds=0.0,
+            validation_seconds=0.0,
+            compressed_bytes=0,
+            uncompressed_bytes=0,
+            row_count=0,
+        )
+    if aliquot_index is not None and sort_by_coordinate:
+        raise ValueError(
+            "An aliquot index cannot be written when sorting by coordinate"
+        )
+    if cache is not None and (
+        decompression_threads
+        or compression_threads
+        or preflight
+        or union_columns
+        or sort_by_coordinate
+        or bgzf
+        or region_index is not None
+    ):
+        raise ValueError("A cache can only be used with the default gzip output")
+    if processes < 0:
+        raise ValueError("processes must not be negative")
+    if deduplicate is not None and (cache is not None or processes):
+        raise ValueError("Rows cannot be deduplicated with a cache or processes")
+    if processes and (
+        cache is not None
+        or decompression_threads
+        or compression_threads
+        or preflight
+        or union_columns
+        or sort_by_coordinate
+        or bgzf
+        or region_index is not None
+    ):
+        raise ValueError("A process pool can only be used with the default gzip output")
+
+    output_options = _OutputOptions(
+        compression_level=compression_level,
+        compression_threads=compression_threads,
+        bgzf=bgzf or region_index is not None,
+        region_index=region_index,
+        separate_members=aliquot_index is not None
+        or cache is not None
+        or processes > 0,
+        columnar=columnar,
+    )
+    _check_output_options(output_options)
+
+    start = time.perf_counter()
+    output_start = _tell(output)
+    preflighted = None
+    try:
+        if preflight or sort_by_coordinate or union_columns:
+            preflighted = _preflight(
+                mafs,
+                threads=decompression_threads or None,
+                same_columns=not union_columns,
+            )
+            if union_columns:
+                preflighted = _remap_to_union(preflighted)
+
+        with contextlib.ExitStack() as stack:
+            gzip_output = stack.enter_context(_output_stream(output, output_options))
+            aggregator = _MafAggregator(
+                output=gzip_output,
+                submitter_ids=[m.tumor_aliquot_submitter_id for m in mafs],
+                sort_order="Coordinate" if sort_by_coordinate else None,
+                columns=columns,
+                filters=filters,
+                index_aliquots=aliquot_index is not None,
+                on_file=on_file,
+                deduplicate=deduplicate,
+                dedup_memory=dedup_memory,
+            )
+            stack.callback(aggregator.close)
+            if sort_by_coordinate:
+                _merge_by_coordinate(
+                    aggregator=aggregator,
+                    parsed_mafs=preflighted,
+                    chromosome_order=chromosome_order or DEFAULT_CHROMOSOME_ORDER,
+                )
+            elif processes:
+                _aggregate_in_processes(aggregator, mafs, processes, compression_level)
+            elif cache is not None:
+                options_key = _cache_options_key(compression_level, columns, filters)
+                for maf in mafs:
+                    _add_cached(aggregator, maf, cache, options_key, compression_level)
+            else:
+                parsed_mafs = _iter_parsed_mafs(
+                    mafs=mafs,
+                    decompression_threads=decompression_threads,
+                    read_ahead=read_ahead,
+                    preflighted=preflighted,
+                )
+                with contextlib.closing(parsed_mafs):
+                    for parsed in parsed_mafs:
+                        aggregator.add(parsed)
+    finally:
+        for parsed in preflighted or []:
+            parsed.body.close()
+
+    if aliquot_index is not None:
+        aggregator.aliquot_index(
+            union_columns=union_columns, bgzf=output_options.bgzf
+        ).write(aliquot_index)
+    output_end = _tell(output)
+    return aggregator.stats(
+        seconds=time.perf_counter() - start,
+        compressed_bytes=output_end - output_start
+        if output_start is not None and output_end is not None
+        else 0,
+    )
+
+
+def _tell(output: BinaryIO) -> Optional[int]:
+    """Return the position of a file-like object, or None if it is not seekable."""
+    try:
+        return output.tell() if output.seekable() else None
+    except (AttributeError, OSError):
+        return None
+
+
+def has_headers(maf: AliquotLevelMaf) -> bool:
+    """Return whether a MAF has headers, and so would not be skipped by aggregate_mafs.
+
+    Only the headers are read and decompressed.  A file-like object is read from
+    its current position, which is not restored.
+    """
+    parsed = _parse_maf(maf)
+    parsed.body.close()
+    return bool(parsed.file_headers)
+
+
+def update_aggregated_maf(
+    maf: BinaryIO,
+    index: AliquotIndex,
+    output: BinaryIO,
+    add: Optional[List[AliquotLevelMaf]] = None,
+    remove: Optional[Collection[str]] = None,
+    compression_level: int = 9,
+) -> AliquotIndex:
+    """Add aliquot-level MAF files to, or remove them from, an aggregated MAF.
+
+    The MAF must have been written by aggregate_mafs with an aliquot index.  Only its
+    headers are decompressed.  They are rewritten with updated
+    `#n.analyzed.samples`, `#tumor.aliquots.submitter_id` and `#filedate` pragmas,
+    the gzip members of the retained aliquots are copied without being decompressed,
+    and the added MAFs are appended in their own gzip members.
+
+    The columns, filters and union_columns options the MAF was aggregated with are
+    read from its index and applied to the added MAFs, so they are written as
+    aggregate_mafs would have written them.  The added MAFs must have the same
+    version and annotation spec as the aggregated MAF, and the same column headers
+    as its inputs, or a subset of them if it was aggregated with union_columns.
+    A MAF written in the BGZF format is updated in it: its headers and the added
+    MAFs are written as BGZF blocks, and the output ends with the BGZF end-of-file
+    marker.  Its region index is not updated.  MAFs aggregated with deduplicate, or
+    whose index does not record the options, cannot be updated.
+
+    Args:
+        maf: A seekable file-like object with the aggregated MAF.
+        index: The aliquot index of the MAF.
+        output: A file-like object to write the updated MAF to.
+        add: A list of aliquot-level MAF files to append.
+        remove: The submitter ids of the tumor aliquots to remove.
+        compression_level: The gzip compression level of the added MAFs.
+
+    Returns:
+        The aliquot index of the updated MAF.
+    """
+    if index.header is None:
+        raise ValueError("The aggregated MAF has no headers to update")
+    options = index.options
+    if options is None:
+        raise ValueError("The aliquot index does not record the aggregation options")
+    if options["deduplicate"] is not None:
+        raise ValueError("A MAF with deduplicated rows cannot be updated")
+    header = b"".join(
+        read_gzip_members(
+            maf, index.header.compressed_offset, index.header.compressed_size
+        )
+    )
+    file_headers = _read_and_parse_file_headers(io.BufferedReader(io.BytesIO(header)))
+    submitter_ids = file_headers.properties["tumor.aliquots.submitter_id"]
+    submitter_ids = submitter_ids.split(",") if submitter_ids else []
+
+    removed = set(remove or [])
+    missing = removed.difference(submitter_ids)
+    if missing:
+        raise ValueError(f"Aliquots are missing from the MAF: {sorted(missing)}")
+    add = add or []
+    submitter_ids = [s for s in submitter_ids if s not in removed]
+    submitter_ids += [m.tumor_aliquot_submitter_id for m in add]
+
+    parsed_mafs = _iter_parsed_mafs(add, decompression_threads=0, read_ahead=None)
+    bgzf = options.get("bgzf", False)
+    writer_class = BgzfWriter if bgzf else GzipMemberWriter
+    with contextlib.closing(parsed_mafs), writer_class(
+        output, compresslevel=compression_level
+    ) as gzip_output:
+        aggregator = _MafAggregator(
+            output=gzip_output,
+            submitter_ids=submitter_ids,
+            columns=options["columns"],
+            filters=_filters_from_json(options["filters"]),
+            index_aliquots=True,
+        )
+        aggregator.start(file_headers, options["column_headers"])
+        for entry in index.entries:
+            if entry.tumor_aliquot_submitter_id not in removed:
+                aggregator.copy_aliquot(maf, entry)
+        for parsed in parsed_mafs:
+            if options["union_columns"]:
+                parsed = _remap_to_columns(parsed, options["column_headers"])
+            aggregator.add(parsed)
+    return aggregator.aliquot_index(
+        union_columns=options["union_columns"], bgzf=bgzf
+    )
+
+
+def aggregate_mafs_sharded(
+    mafs: List[AliquotLevelMaf],
+    open_output: Callable[[str], BinaryIO],
+    shard_column: str,
+    decompression_threads: int = 0,
+    read_ahead: Optional[int] = None,
+    compression_level: int = 9,
+    compression_threads: int = 0,
+    columns: Optional[Sequence[str]] = None,
+    filters: Optional[Sequence[RowFilter]] = None,
+    on_file: Optional[Callable[["FileStats"], None]] = None,
+) -> "AggregationStats":
+    """Aggregate aliquot-level MAF files into one MAF per value of a column.
+
+    This writes the same rows as aggregate_mafs, but each row is written to the
+    output of its value in shard_column, such as Chromosome or
+    Variant_Classification, so that the inputs are only decompressed once for all
+    outputs.  The output of a value is opened by calling open_output with it when
+    the value is first seen, and gets the same headers as the output of
+    aggregate_mafs.  The outputs are not closed.
+
+    Rows are gathered in batches for each output.  If compression_threads is given,
+    each output is compressed by its own ParallelGzipWriter, and all of them share
+    one thread pool, so that the outputs are compressed concurrently.
+
+    Args:
+        mafs: A list of aliquot-level MAF files with metadata.
+        open_output: A function returning a file-like object to write the MAF of a
+                     value of shard_column to.
+        shard_column: The name of the column whose values split the rows.  It does
+                      not need to be in columns.
+        decompression_threads: The number of threads used to decompress inputs.  When
+                               0, inputs are decompressed one at a time on the
+                               calling thread.
+        read_ahead: The maximum number of inputs decompressed ahead of the one being
+                    written.  Defaults to twice decompression_threads.
+        compression_level: The gzip compression level of the outputs, from 0 to 9.
+        compression_threads: The number of threads used to compress the outputs.
+                             When 0, the outputs are compressed on the calling
+                             thread.
+        columns: The names of the columns to write.  Defaults to all of them.
+        filters: Filters that every written row must pass.
+        on_file: A function called with the statistics of each input once it has
+                 been written or skipped, in the order of mafs.
+
+    Returns:
+        Statistics of the aggregation, summed over the outputs.
+    """
+    if compression_threads < 0:
+        raise ValueError("compression_threads must not be negative")
+    start = time.perf_counter()
+    # The aggregator validates the inputs and writes the headers once, to be copied
+    # to each output.
+    headers = io.BytesIO()
+    aggregator = _MafAggregator(
+        output=headers,
+        submitter_ids=[m.tumor_aliquot_submitter_id for m in mafs],
+        columns=columns,
+        filters=filters,
+        on_file=on_file,
+    )
+    shard_key: Optional[Callable[[bytes], bytes]] = None
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if compression_threads:
+            executor = stack.enter_context(
+                ThreadPoolExecutor(max_workers=compression_threads)
+            )
+        shards = _ShardedOutput(
+            open_output, headers, compression_level, compression_threads, executor
+        )
+        stack.callback(shards.close)
+        parsed_mafs = stack.enter_context(
+            contextlib.closing(
+                _iter_parsed_mafs(
+                    mafs=mafs,
+                    decompression_threads=decompression_threads,
+                    read_ahead=read_ahead,
+                )
+            )
+        )
+        for parsed in parsed_mafs:
+            file_start = time.perf_counter()
+            if not aggregator.accept(parsed):
+                aggregator.record(parsed, time.perf_counter() - file_start)
+                continue
+            if shard_key is None:
+                shard_key = _compile_shard_key(
+                    aggregator.expected_column_headers, shard_column
+                )
+            written = shards.write_rows(
+                parsed.body, shard_key, aggregator.transform, aggregator.compression
+            )
+            aggregator.count(written)
+            aggregator.record(parsed, time.perf_counter() - file_start, written)
+
+    return aggregator.stats(
+        seconds=time.perf_counter() - start, compressed_bytes=shards.compressed_bytes
+    )
+
+
+class AsyncAliquotLevelMaf(NamedTuple):
+    """The name and content of an aliquot-level MAF file read asynchronously.
+
+    The file is assumed to be gzipped.
+
+    Attributes:
+        file: An asynchronous byte stream with the content of the aliquot-level MAF
+              file.  It must provide a coroutine `read(size)` which returns an empty
+              bytes object at the end of the stream, like asyncio.StreamReader.
+        tumor_aliquot_submitter_id: The submitter id of the tumor aliquot.
+    """
+
+    file: Any
+    tumor_aliquot_submitter_id: str
+
+
+async def aggregate_mafs_async(
+    mafs: List[AsyncAliquotLevelMaf],
+    output: BinaryIO,
+    max_concurrency: int = 8,
+    executor: Optional[Executor] = None,
+    compression_level: int = 9,
+    compression_threads: int = 0,
+) -> None:
+    """Aggregate a given list of aliquot-level MAF files read asynchronously.
+
+    This is the asynchronous counterpart of aggregate_mafs.  Up to max_concurrency
+    inputs are read concurrently and decompressed on an executor, while earlier
+    inputs are validated and written to the output on a dedicated writer thread.  The
+    output is written in the order of mafs and is the same as the one aggregate_mafs
+    would produce.
+
+    Each input is read and decompressed whole, so up to max_concurrency + 2
+    decompressed inputs are held in memory at once: those read concurrently, the
+    one being written and the next one to write.
+
+    Args:
+        mafs: A list of aliquot-level MAF files with metadata.
+        output: A file-like object to write the aggregated MAF file.
+        max_concurrency: The maximum number of inputs read concurrently.
+        executor: The executor used to decompress inputs.  Defaults to the event
+                  loop's default executor.
+        compression_level: The gzip compression level of the output, from 0 to 9.
+        compression_threads: The number of threads used to compress the output.  When
+                             0, the output is compressed on the writer thread.
     """
     if not mafs:
         return
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1")
+
+    # Inside a coroutine this is the running loop.  get_running_loop needs Python 3.7.
+    loop = asyncio.get_event_loop()
+
+    async def load(maf: AsyncAliquotLevelMaf) -> _ParsedMaf:
+        chunks = []
+        while True:
+            chunk = await maf.file.read(_COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        local_maf = AliquotLevelMaf(
+            file=io.BytesIO(b"".join(chunks)),
+            tumor_aliquot_submitter_id=maf.tumor_aliquot_submitter_id,
+        )
+        return await loop.run_in_executor(executor, _load_maf, local_maf)
+
+    gzip_output = _open_output(
+        output,
+        _OutputOptions(
+            compression_level=compression_level,
+            compression_threads=compression_threads,
+        ),
+    )
+    aggregator = _MafAggregator(
+        output=gzip_output, submitter_ids=[m.tumor_aliquot_submitter_id for m in mafs]
+    )
+    pending: Deque[asyncio.Future] = deque()
+    write: Optional[asyncio.Future] = None
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        try:
+            maf_iter = iter(mafs)
+            for maf in itertools.islice(maf_iter, max_concurrency):
+                pending.append(asyncio.ensure_future(load(maf)))
+            while pending:
+                parsed = await pending.popleft()
+                next_maf = next(maf_iter, None)
+                if next_maf is not None:
+                    pending.append(asyncio.ensure_future(load(next_maf)))
+                if write is not None:
+                    await write
+                write = loop.run_in_executor(writer, aggregator.add, parsed)
+            if write is not None:
+                await write
+            await loop.run_in_executor(writer, gzip_output.close)
+        finally:
+            for future in pending:
+                future.cancel()
+            outstanding = [f for f in [*pending, write] if f and not f.done()]
+            if outstanding:
+                await asyncio.wait(outstanding)
+            gzip_output.close()
+
+
+class _MafAggregator:
+    """Validates parsed aliquot-level MAFs and writes them to the output in order.
+
+    The first MAF with headers determines the expected headers of the following MAFs
+    and causes the file and column headers to be written.
+
+    If index_aliquots is set, the headers and the rows of each MAF end the current
+    gzip member of the output, which must support end_member, and their location is
+    recorded for the aliquot index.
+
+    Statistics of each MAF are recorded by add, or by record for MAFs added by other
+    means, and passed to on_file.
+    """
+
+    def __init__(
+        self,
+        output: BinaryIO,
+        submitter_ids: List[str],
+        sort_order: Optional[str] = None,
+        columns: Optional[Sequence[str]] = None,
+        filters: Optional[Sequence["RowFilter"]] = None,
+        index_aliquots: bool = False,
+        on_file: Optional[Callable[[FileStats], None]] = None,
+        deduplicate: Optional[Sequence[str]] = None,
+        dedup_memory: int = DEFAULT_DEDUP_MEMORY,
+    ):
+        self.output = output
+        self.submitter_ids = submitter_ids
+        self.sort_order = sort_order
+        self.columns = columns
+        self.filters = filters
+        self.expected_file_headers: Optional[_MafFileHeader] = None
+        self.expected_column_headers: Optional[List[str]] = None
+        self.transform: Optional[_RowTransform] = None
+        self.index_aliquots = index_aliquots
+        self.header_entry: Optional[AliquotIndexEntry] = None
+        self.aliquot_entries: List[AliquotIndexEntry] = []
+        self.on_file = on_file
+        self.files: List[FileStats] = []
+        self.written = _WrittenRows(row_count=0, size=0)
+        self.compression = _Timer()
+        self.validation = _Timer()
+        self.deduplicate = deduplicate
+        self.dedup_memory = dedup_memory
+        self.deduplicator: Optional[_Deduplicator] = None
+
+    def add(self, parsed: "_ParsedMaf") -> None:
+        start = time.perf_counter()
+        if not self.accept(parsed):
+            self.record(parsed, time.perf_counter() - start)
+            return
+        begin = self._position()
+        written = self.write_rows(parsed.body)
+        if self.index_aliquots:
+            self.aliquot_entries.append(
+                self._end_member(
+                    parsed.maf.tumor_aliquot_submitter_id, begin, written.row_count
+                )
+            )
+        self.record(parsed, time.perf_counter() - start, written)
+
+    def record(
+        self,
+        parsed: "_ParsedMaf",
+        seconds: float,
+        written: Optional["_WrittenRows"] = None,
+    ) -> None:
+        """Record the statistics of a MAF.
+
+        Args:
+            parsed: The MAF.
+            seconds: The time spent adding the MAF to the output.
+            written: The rows of the MAF written to the output, if they are known.
+        """
+        if written is None:
+            written = _WrittenRows(row_count=0, size=0)
+        input_stats = parsed.input_stats or _InputStats()
+        stats = FileStats(
+            tumor_aliquot_submitter_id=parsed.maf.tumor_aliquot_submitter_id,
+            skipped=not parsed.file_headers,
+            seconds=seconds,
+            decompression_seconds=input_stats.decompression_seconds,
+            compressed_bytes=input_stats.compressed_bytes,
+            uncompressed_bytes=written.size,
+            row_count=written.row_count,
+        )
+        self.files.append(stats)
+        if self.on_file is not None:
+            self.on_file(stats)
+
+    def stats(self, seconds: float, compressed_bytes: int) -> AggregationStats:
+        return AggregationStats(
+            files=self.files,
+            seconds=seconds,
+            decompression_seconds=sum(f.decompression_seconds for f in self.files),
+            compression_seconds=self.compression.seconds,
+            validation_seconds=self.validation.seconds,
+            compressed_bytes=compressed_bytes,
+            uncompressed_bytes=self.written.size,
+            row_count=self.written.row_count,
+            duplicate_count=self.deduplicator.duplicate_count
+            if self.deduplicator is not None
+            else 0,
+        )
+
+    def close(self) -> None:
+        """Release the resources held for deduplication."""
+        if self.deduplicator is not None:
+            self.deduplicator.keys.close()
+
+    def aliquot_index(
+        self, union_columns: bool = False, bgzf: bool = False
+    ) -> AliquotIndex:
+        """Return the aliquot index of the output, with the options of its rows.
+
+        The column headers are those of the inputs, before projection.
+        """
+        options = {
+            "column_headers": self.expected_column_headers,
+            "columns": list(self.columns) if self.columns is not None else None,
+            "filters": _filters_to_json(self.filters),
+            "union_columns": union_columns,
+            "bgzf": bgzf,
+            "deduplicate": list(self.deduplicate)
+            if self.deduplicate is not None
+            else None,
+        }
+        return AliquotIndex(
+            header=self.header_entry, entries=self.aliquot_entries, options=options
+        )
+
+    def write_rows(
+        self, rows: Iterable[bytes], output: Optional[BinaryIO] = None
+    ) -> "_WrittenRows":
+        """Write body rows, which must have been accepted, to the output.
+
+        Args:
+            rows: The rows to write.
+            output: The stream to write the rows to instead of the output.
+
+        Returns:
+            The number and size of the rows written.
+        """
+        if output is None:
+            output = self.output
+        if self.transform is None:
+            if isinstance(rows, io.IOBase):
+                written = _copy_rows(rows, output, self.compression)
+                if output is self.output:
+                    self.count(written)
+                return written
+            transform = _identity_row
+        else:
+            transform = self.transform
+
+        row_count = 0
+        size = 0
+        batch = []
+        for row in rows:
+            row = transform(row)
+            if row is not None:
+                batch.append(row)
+                if len(batch) >= _ROW_BATCH_SIZE:
+                    size += self._write_batch(batch, output)
+                    row_count += len(batch)
+                    batch.clear()
+        if batch:
+            size += self._write_batch(batch, output)
+            row_count += len(batch)
+        written = _WrittenRows(row_count=row_count, size=size)
+        if output is self.output:
+            self.count(written)
+        return written
+
+    def _write_batch(self, batch: List[bytes], output: BinaryIO) -> int:
+        data = b"".join(batch)
+        start = time.perf_counter()
+        output.write(data)
+        self.compression.seconds += time.perf_counter() - start
+        return len(data)
+
+    def count(self, written: "_WrittenRows") -> None:
+        """Add rows written to the output to the totals."""
+        self.written = _WrittenRows(
+            row_count=self.written.row_count + written.row_count,
+            size=self.written.size + written.size,
+        )
+
+    def accept(self, parsed: "_ParsedMaf") -> bool:
+        """Validate the headers of a MAF, writing the output headers if it is first.
+
+        Returns:
+            Whether the body of the MAF should be written.
+        """
+        # Case where the file content is empty or the user does not have access
+        # to a file.
+        file_headers = parsed.file_headers
+        if not file_headers:
+            return False
+
+        if self.expected_file_headers is None:
+            self.start(file_headers, parsed.column_headers)
+        start = time.perf_counter()
+        _validate_file_headers(
+            headers=file_headers, expected_headers=self.expected_file_headers
+        )
+        _validate_column_headers(
+            headers=parsed.column_headers, expected_headers=self.expected_column_headers
+        )
+        self.validation.seconds += time.perf_counter() - start
+        return True
+
+    def start(self, file_headers: "_MafFileHeader", column_headers: List[str]) -> None:
+        """Set the expected headers of the MAFs and write the output headers."""
+        self.expected_file_headers = file_headers
+        self.expected_column_headers = column_headers.copy()
+        if self.deduplicate is not None:
+            self.deduplicator = _Deduplicator(
+                column_headers, self.deduplicate, SpillingKeySet(self.dedup_memory)
+            )
+        self.transform, output_column_headers = _compile_row_transform(
+            column_headers=column_headers,
+            columns=self.columns,
+            filters=self.filters,
+            deduplicator=self.deduplicator,
+        )
+        _write_file_headers(
+            output=self.output,
+            version=file_headers.version,
+            file_date=datetime.datetime.now(),
+            annotation_spec=file_headers.annotation_spec,
+            submitter_ids=self.submitter_ids,
+            sort_order=self.sort_order,
+        )
+        _write_column_headers(self.output, output_column_headers)
+        if self.index_aliquots:
+            self.header_entry = self._end_member("", (0, 0), row_count=0)
+
+    def copy_aliquot(self, maf: BinaryIO, entry: AliquotIndexEntry) -> None:
+        """Copy the gzip members of an aliquot from an indexed MAF to the output.
+
+        The members are copied without being decompressed.
+        """
+        maf.seek(entry.compressed_offset)
+        self.copy_members(
+            source=maf,
+            submitter_id=entry.tumor_aliquot_submitter_id,
+            compressed_size=entry.compressed_size,
+            uncompressed_size=entry.uncompressed_size,
+            row_count=entry.row_count,
+        )
+
+    def copy_members(
+        self,
+        source: BinaryIO,
+        submitter_id: str,
+        compressed_size: int,
+        uncompressed_size: int,
+        row_count: int,
+    ) -> None:
+        """Copy the gzip members holding the rows of an accepted MAF to the output.
+
+        The output must support copy_members.
+        """
+        begin = self._position()
+        start = time.perf_counter()
+        self.output.copy_members(source, compressed_size, uncompressed_size)
+        self.compression.seconds += time.perf_counter() - start
+        self.count(_WrittenRows(row_count=row_count, size=uncompressed_size))
+        if self.index_aliquots:
+            self.aliquot_entries.append(
+                self._end_member(submitter_id, begin, row_count)
+            )
+
+    def _position(self) -> Tuple[int, int]:
+        if not self.index_aliquots:
+            return 0, 0
+        return self.output.compressed_size, self.output.uncompressed_size
+
+    def _end_member(
+        self, submitter_id: str, begin: Tuple[int, int], row_count: int
+    ) -> AliquotIndexEntry:
+        """End the current gzip member, returning the location of what it holds."""
+        self.output.end_member()
+        compressed_offset, uncompressed_offset = begin
+        return AliquotIndexEntry(
+            tumor_aliquot_submitter_id=submitter_id,
+            compressed_offset=compressed_offset,
+            compressed_size=self.output.compressed_size - compressed_offset,
+            uncompressed_offset=uncompressed_offset,
+            uncompressed_size=self.output.uncompressed_size - uncompressed_offset,
+            row_count=row_count,
+        )
+
+
+class _WrittenRows(NamedTuple):
+    row_count: int
+    size: int
+
+
+class _Timer:
+    """Accumulates the time spent in timed sections of code."""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+
+def _copy_rows(source: BinaryIO, destination: BinaryIO, timer: _Timer) -> _WrittenRows:
+    """Copy rows in large blocks without splitting them.
+
+    The time spent writing to destination is added to timer.
+
+    Returns:
+        The number and size of the rows copied.
+    """
+    row_count = 0
+    size = 0
+    last = b"\n"
+    while True:
+        block = source.read(_COPY_BUFFER_SIZE)
+        if not block:
+            break
+        start = time.perf_counter()
+        destination.write(block)
+        timer.seconds += time.perf_counter() - start
+        row_count += block.count(b"\n")
+        size += len(block)
+        last = block[-1:]
+    return _WrittenRows(row_count=row_count + (last != b"\n"), size=size)
+
+
+def _merge_by_coordinate(
+    aggregator: _MafAggregator,
+    parsed_mafs: List["_ParsedMaf"],
+    chromosome_order: Sequence[str],
+) -> None:
+    """Merge coordinate-sorted MAFs into a coordinate-sorted output."""
+    accepted = []
+    validation_seconds = []
+    for parsed in parsed_mafs:
+        start = time.perf_counter()
+        if aggregator.accept(parsed):
+            accepted.append(parsed)
+        validation_seconds.append(time.perf_counter() - start)
+
+    if accepted:
+        key = _coordinate_key(accepted[0].column_headers, chromosome_order)
+        # heapq.merge is stable, so rows with the same coordinate keep the input
+        # order.
+        rows = heapq.merge(*[_sorted_rows(parsed, key) for parsed in accepted], key=key)
+        aggregator.write_rows(rows)
+
+    # The statistics are recorded once the rows, and so the decompression times of
+    # the inputs, are known.
+    for parsed, seconds in zip(parsed_mafs, validation_seconds):
+        aggregator.record(parsed, seconds)
+
+
+def _coordinate_key(
+    column_headers: List[str], chromosome_order: Sequence[str]
+) -> Callable[[bytes], Tuple[int, bytes, int]]:
+    """Compile a function returning the coordinate sort key of a row."""
+    try:
+        chromosome_index = column_headers.index("Chromosome")
+        position_index = column_headers.index("Start_Position")
+    except ValueError:
+        raise ValidationError(
+            message="Cannot sort by coordinate.",
+            details="Chromosome and Start_Position columns are required.",
+        )
+    max_split = max(chromosome_index, position_index) + 1
+    ranks = {chromosome.encode(): i for i, chromosome in enumerate(chromosome_order)}
+    unranked = len(ranks)
+
+    def key(row: bytes) -> Tuple[int, bytes, int]:
+        fields = row.split(b"\t", max_split)
+        chromosome = fields[chromosome_index]
+        return (
+            ranks.get(chromosome, unranked),
+            chromosome,
+            int(fields[position_index]),
+        )
+
+    return key
+
+
+def _sorted_rows(
+    parsed: "_ParsedMaf", key: Callable[[bytes], Tuple[int, bytes, int]]
+) -> Iterator[bytes]:
+    """Yield the rows of a MAF, checking that they are sorted by the given key."""
+    previous = None
+    for number, row in enumerate(parsed.body, start=1):
+        if not row.strip():
+            continue
+        if not row.endswith(b"\n"):
+            row += b"\n"
+        try:
+            current = key(row)
+        except (IndexError, ValueError):
+            raise ValidationError(
+                message="Cannot sort by coordinate.",
+                details=f"{parsed.maf.tumor_aliquot_submitter_id}: row {number} "
+                "does not have a valid Chromosome and Start_Position.",
+            )
+        if previous is not None and current < previous:
+            raise ValidationError(
+                message="Input MAFs must be sorted by coordinate.",
+                details=f"{parsed.maf.tumor_aliquot_submitter_id}: row {number} "
+                "is out of order.",
+            )
+        previous = current
+        yield row
+
+
+# Transforms a body row.  Returns None if the row should be dropped.
+_RowTransform = Callable[[bytes], Optional[bytes]]
+
+
+def _identity_row(row: bytes) -> bytes:
+    return row
+
+
+def _compile_row_transform(
+    column_headers: List[str],
+    columns: Optional[Sequence[str]],
+    filters: Optional[Sequence["RowFilter"]],
+    deduplicator: Optional[_RowTransform] = None,
+) -> Tuple[Optional[_RowTransform], List[str]]:
+    """Compile the transform applied to each body row.
+
+    Rows are filtered, then deduplicated, then projected.
+
+    Returns:
+        The transform, or None if rows are written unchanged, and the column headers
+        of the transformed rows.
+    """
+    transforms = [_compile_filter(column_headers, f) for f in filters or []]
+    if deduplicator is not None:
+        transforms.append(deduplicator)
+    if columns is not None:
+        transforms.append(_compile_projection(column_headers, columns))
+        column_headers = list(columns)
 
-    with gzip.open(output, "wt") as gzip_output:
-        is_first_pass = True
-        for maf in mafs:
-            with io.BufferedReader(gzip.open(maf.file, "r")) as reader:
-                # Case where the file content is empty or the user does not have access
-                # to a file.
-                file_headers = _read_and_parse_file_headers(reader)
-                if not file_headers:
+    if not transforms:
+        return None, column_headers
+    if len(transforms) == 1:
+        return transforms[0], column_headers
+
+    def transform(row: bytes) -> Optional[bytes]:
+        for step in transforms:
+            row = step(row)
+            if row is None:
+                return None
+        return row
+
+    return transform, column_headers
+
+
+def _compile_filter(
+    column_headers: List[str], row_filter: "RowFilter"
+) -> _RowTransform:
+    """Compile a transform dropping rows rejected by a filter."""
+    if row_filter.column not in column_headers:
+        raise ValidationError(
+            message="Filtered column is missing from the MAF files.",
+            details=f"Missing: {row_filter.column}\nAvailable: {column_headers}",
+        )
+    index = column_headers.index(row_filter.column)
+    values = frozenset(value.encode() for value in row_filter.values)
+    separator = row_filter.separator.encode() if row_filter.separator else None
+    exclude = row_filter.exclude
+    # A row can only match if one of the values appears somewhere in it, which is
+    # much cheaper to check than splitting the row.  This does not work for the
+    # empty string, which appears in every row.
+    needles = tuple(values) if all(values) else None
+
+    def matches(row: bytes) -> bool:
+        value = row.split(b"\t", index + 1)[index].rstrip(b"\r\n")
+        if separator is None:
+            return value in values
+        return any(part in values for part in value.split(separator))
+
+    def apply(row: bytes) -> Optional[bytes]:
+        if needles is not None and not any(needle in row for needle in needles):
+            return row if exclude else None
+        try:
+            if matches(row) != exclude:
+                return row
+            return None
+        except IndexError:
+            return _check_short_row(row)
+
+    return apply
+
+
+def _check_short_row(row: bytes) -> None:
+    """Handle a row with too few fields, which is only allowed if it is blank."""
+    if not row.strip():
+        return None
+    raise ValidationError(
+        message="Row has fewer columns than the column headers.",
+        details=f"Row: {row!r}",
+    )
+
+
+def _compile_projection(
+    column_headers: List[str], columns: Sequence[str]
+) -> _RowTransform:
+    """Compile a transform keeping only the given columns of a row."""
+    if not columns:
+        raise ValueError("At least one column must be requested")
+    missing = [column for column in columns if column not in column_headers]
+    if missing:
+        raise ValidationError(
+            message="Requested columns are missing from the MAF files.",
+            details=f"Missing: {missing}\nAvailable: {column_headers}",
+        )
+    indices = [column_headers.index(column) for column in columns]
+    max_split = max(indices) + 1
+    pick = _field_picker(indices)
+
+    def project(row: bytes) -> Optional[bytes]:
+        fields = row.rstrip(b"\r\n").split(b"\t", max_split)
+        try:
+            return b"\t".join(pick(fields)) + b"\n"
+        except IndexError:
+            return _check_short_row(row)
+
+    return project
+
+
+def _field_picker(indices: List[int]) -> Callable[[List[bytes]], Tuple[bytes, ...]]:
+    """Compile a function picking the fields at the given indices of a split row."""
+    getter = operator.itemgetter(*indices)
+    if len(indices) > 1:
+        return getter
+
+    def pick(fields: List[bytes]) -> Tuple[bytes, ...]:
+        return (getter(fields),)
+
+    return pick
+
+
+class _Deduplicator:
+    """A row transform dropping rows whose key columns match an earlier row.
+
+    Keys are hashed into compact digests and kept in a SpillingKeySet, so memory
+    stays within its budget however many rows are written.
+
+    Attributes:
+        keys: The hashed keys of the rows written so far.
+        duplicate_count: The number of rows dropped so far.
+    """
+
+    def __init__(
+        self, column_headers: List[str], columns: Sequence[str], keys: SpillingKeySet
+    ):
+        if not columns:
+            raise ValueError("At least one deduplication column must be given")
+        missing = [column for column in columns if column not in column_headers]
+        if missing:
+            raise ValidationError(
+                message="Deduplication columns are missing from the MAF files.",
+                details=f"Missing: {missing}\nAvailable: {column_headers}",
+            )
+        indices = [column_headers.index(column) for column in columns]
+        self._max_split = max(indices) + 1
+        self._pick = _field_picker(indices)
+        self.keys = keys
+        self.duplicate_count = 0
+
+    def __call__(self, row: bytes) -> Optional[bytes]:
+        fields = row.rstrip(b"\r\n").split(b"\t", self._max_split)
+        try:
+            key = b"\t".join(self._pick(fields))
+        except IndexError:
+            return _check_short_row(row)
+        if self.keys.add(hash_key(key)):
+            return row
+        self.duplicate_count += 1
+        return None
+
+
+# Version of the cache entries written by _add_cached.
+_CACHE_FORMAT = 1
+
+
+def _cache_options_key(
+    compression_level: int,
+    columns: Optional[Sequence[str]],
+    filters: Optional[Sequence[RowFilter]],
+) -> bytes:
+    """Serialize the options that affect a cached body."""
+    return json.dumps(
+        [
+            _CACHE_FORMAT,
+            compression_level,
+            list(columns) if columns is not None else None,
+            _filters_to_json(filters),
+        ]
+    ).encode()
+
+
+def _filters_to_json(filters: Optional[Sequence[RowFilter]]) -> List[List[Any]]:
+    """Serialize filters as JSON values."""
+    return [[f.column, sorted(f.values), f.exclude, f.separator] for f in filters or []]
+
+
+def _filters_from_json(values: List[List[Any]]) -> List[RowFilter]:
+    """Deserialize filters serialized by _filters_to_json."""
+    return [RowFilter(*value) for value in values]
+
+
+def _add_cached(
+    aggregator: _MafAggregator,
+    maf: AliquotLevelMaf,
+    cache: SegmentCache,
+    options_key: bytes,
+    compression_level: int,
+) -> None:
+    """Add a MAF to the aggregator, reusing or filling its cached body."""
+    start = time.perf_counter()
+    maf, key, size = _hash_input(maf, options_key)
+    entry = cache.get(key)
+    if entry is not None:
+        with entry.body:
+            metadata = entry.metadata
+            file_headers = metadata["file_headers"]
+            parsed = _ParsedMaf(
+                maf=maf,
+                file_headers=file_headers and _MafFileHeader(**file_headers),
+                column_headers=metadata.get("column_headers", []),
+                body=entry.body,
+                input_stats=_InputStats(compressed_bytes=size),
+            )
+            if not aggregator.accept(parsed):
+                aggregator.record(parsed, time.perf_counter() - start)
+                return
+            body = _CompressedBody(
+                compressed_size=metadata["compressed_size"],
+                uncompressed_size=metadata["uncompressed_size"],
+                row_count=metadata["row_count"],
+            )
+            aggregator.copy_members(
+                entry.body, maf.tumor_aliquot_submitter_id, **body._asdict()
+            )
+        aggregator.record(parsed, time.perf_counter() - start, body.written())
+        return
+
+    parsed = _parse_maf(maf)
+    with parsed.body, tempfile.TemporaryFile() as segment:
+        if not aggregator.accept(parsed):
+            cache.put(key, {"file_headers": None}, segment)
+            aggregator.record(parsed, time.perf_counter() - start)
+            return
+        body = _compress_body(aggregator, parsed, segment, compression_level)
+        metadata = {
+            "file_headers": parsed.file_headers._asdict(),
+            "column_headers": parsed.column_headers,
+            **body._asdict(),
+        }
+        segment.seek(0)
+        cache.put(key, metadata, segment)
+        segment.seek(0)
+        aggregator.copy_members(
+            segment, maf.tumor_aliquot_submitter_id, **body._asdict()
+        )
+    aggregator.record(parsed, time.perf_counter() - start, body.written())
+
+
+class _CompressedBody(NamedTuple):
+    """The location of the body of a MAF compressed into its own gzip members."""
+
+    compressed_size: int
+    uncompressed_size: int
+    row_count: int
+
+    def written(self) -> "_WrittenRows":
+        return _WrittenRows(row_count=self.row_count, size=self.uncompressed_size)
+
+
+def _compress_body(
+    aggregator: _MafAggregator,
+    parsed: "_ParsedMaf",
+    segment: BinaryIO,
+    compression_level: int,
+) -> _CompressedBody:
+    """Compress the body of an accepted MAF into gzip members written to segment."""
+    with GzipMemberWriter(segment, compresslevel=compression_level) as writer:
+        written = aggregator.write_rows(parsed.body, output=writer)
+    return _CompressedBody(
+        compressed_size=writer.compressed_size,
+        uncompressed_size=writer.uncompressed_size,
+        row_count=written.row_count,
+    )
+
+
+class _CompressedMaf(NamedTuple):
+    """The headers and compressed body of a MAF, as returned by worker processes."""
+
+    file_headers: Optional["_MafFileHeader"]
+    column_headers: List[str]
+    members: bytes
+    body: Optional[_CompressedBody]
+    input_stats: "_InputStats"
+
+
+def _compress_shard(
+    contents: List[Any],
+    compression_level: int,
+    columns: Optional[Sequence[str]],
+    filters: Optional[Sequence[RowFilter]],
+) -> List[_CompressedMaf]:
+    """Validate and compress the bodies of consecutive MAFs in a worker process.
+
+    The MAFs are validated against the first of them with headers.  The parent
+    validates them again against the first MAF of all shards.
+    """
+    # The output headers written by the aggregator are not needed.
+    aggregator = _MafAggregator(
+        output=io.BytesIO(), submitter_ids=[], columns=columns, filters=filters
+    )
+    results = []
+    for content in contents:
+        if not _is_path(content):
+            content = io.BytesIO(content)
+        parsed = _parse_maf(AliquotLevelMaf(content, ""))
+        with parsed.body:
+            if not aggregator.accept(parsed):
+                results.append(_CompressedMaf(None, [], b"", None, parsed.input_stats))
+                continue
+            segment = io.BytesIO()
+            body = _compress_body(aggregator, parsed, segment, compression_level)
+        results.append(
+            _CompressedMaf(
+                file_headers=parsed.file_headers,
+                column_headers=parsed.column_headers,
+                members=segment.getvalue(),
+                body=body,
+                input_stats=parsed.input_stats,
+            )
+        )
+    return results
+
+
+def _aggregate_in_processes(
+    aggregator: _MafAggregator,
+    mafs: List[AliquotLevelMaf],
+    processes: int,
+    compression_level: int,
+) -> None:
+    """Compress the bodies of MAFs on a process pool and add them in order."""
+    # Several shards per process balance the load when MAFs differ in size, and
+    # capping their size bounds the inputs and results in flight to about
+    # 2 * processes * _MAX_SHARD_SIZE bytes however large the MAFs are.
+    shard_length = -(-len(mafs) // (4 * processes))
+    shards: Deque[List[AliquotLevelMaf]] = deque()
+
+    def contents() -> Iterator[List[Any]]:
+        # Inputs are only read when their shard is submitted.  Paths are opened by
+        # the workers.
+        for shard, shard_contents in _shards(mafs, shard_length, _MAX_SHARD_SIZE):
+            shards.append(shard)
+            yield shard_contents
+
+    compress = functools.partial(
+        _compress_shard,
+        compression_level=compression_level,
+        columns=aggregator.columns,
+        filters=aggregator.filters,
+    )
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = _ordered_map(executor, compress, contents(), window=2 * processes)
+        for compressed_mafs in results:
+            shard = shards.popleft()
+            for maf, compressed in zip(shard, compressed_mafs):
+                start = time.perf_counter()
+                parsed = _ParsedMaf(
+                    maf=maf,
+                    file_headers=compressed.file_headers,
+                    column_headers=compressed.column_headers,
+                    body=io.BytesIO(compressed.members),
+                    input_stats=compressed.input_stats,
+                )
+                if not aggregator.accept(parsed):
+                    aggregator.record(parsed, time.perf_counter() - start)
                     continue
-                if is_first_pass:
-                    expected_file_headers = file_headers
-                _validate_file_headers(
-                    headers=file_headers, expected_headers=expected_file_headers
+                aggregator.copy_members(
+                    parsed.body,
+                    maf.tumor_aliquot_submitter_id,
+                    **compressed.body._asdict(),
                 )
+                aggregator.record(
+                    parsed, time.perf_counter() - start, compressed.body.written()
+                )
+
+
+def _shards(
+    mafs: List[AliquotLevelMaf], shard_length: int, shard_size: int
+) -> Iterator[Tuple[List[AliquotLevelMaf], List[Any]]]:
+    """Split MAFs into shards of consecutive inputs, with their compressed contents.
+
+    Inputs are added to a shard until it holds shard_length of them or their
+    compressed size reaches shard_size.  File-like inputs are read as their shard
+    is built, and paths are kept as is.
+    """
+    shard: List[AliquotLevelMaf] = []
+    contents: List[Any] = []
+    size = 0
+    for maf in mafs:
+        if _is_path(maf.file):
+            contents.append(maf.file)
+            size += _compressed_size(maf.file)
+        else:
+            contents.append(maf.file.read())
+            size += len(contents[-1])
+        shard.append(maf)
+        if len(shard) >= shard_length or size >= shard_size:
+            yield shard, contents
+            shard, contents, size = [], [], 0
+    if shard:
+        yield shard, contents
+
+
+def _compile_shard_key(
+    column_headers: List[str], shard_column: str
+) -> Callable[[bytes], bytes]:
+    """Compile a function returning the value of the shard column of a row."""
+    if shard_column not in column_headers:
+        raise ValidationError(
+            message="Shard column is missing from the MAF files.",
+            details=f"Missing: {shard_column}\nAvailable: {column_headers}",
+        )
+    index = column_headers.index(shard_column)
+
+    def key(row: bytes) -> bytes:
+        try:
+            return row.split(b"\t", index + 1)[index].rstrip(b"\r\n")
+        except IndexError:
+            _check_short_row(row)
+            return b""
+
+    return key
+
+
+class _ShardedOutput:
+    """The compressed outputs of aggregate_mafs_sharded, opened as values appear.
+
+    Attributes:
+        compressed_bytes: The number of compressed bytes written to the outputs, once
+                          closed, as far as their positions are known.
+    """
+
+    def __init__(
+        self,
+        open_output: Callable[[str], BinaryIO],
+        headers: io.BytesIO,
+        compression_level: int,
+        compression_threads: int,
+        executor: Optional[Executor],
+    ):
+        self.open_output = open_output
+        self.headers = headers
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.executor = executor
+        self.compressed_bytes = 0
+        self._streams: Dict[bytes, BinaryIO] = {}
+        self._starts: Dict[bytes, Tuple[BinaryIO, Optional[int]]] = {}
+
+    def write_rows(
+        self,
+        rows: Iterable[bytes],
+        shard_key: Callable[[bytes], bytes],
+        transform: Optional[_RowTransform],
+        timer: _Timer,
+    ) -> _WrittenRows:
+        """Write body rows, which must have been accepted, to their outputs."""
+        row_count = 0
+        size = 0
+        batches: Dict[bytes, List[bytes]] = {}
+        for row in rows:
+            if not row.strip():
+                continue
+            if not row.endswith(b"\n"):
+                row += b"\n"
+            key = shard_key(row)
+            if transform is not None:
+                row = transform(row)
+                if row is None:
+                    continue
+            batch = batches.get(key)
+            if batch is None:
+                batch = batches[key] = []
+            batch.append(row)
+            if len(batch) >= _ROW_BATCH_SIZE:
+                size += self._write_batch(key, batch, timer)
+                row_count += len(batch)
+                batch.clear()
+        for key, batch in batches.items():
+            if batch:
+                size += self._write_batch(key, batch, timer)
+                row_count += len(batch)
+        return _WrittenRows(row_count=row_count, size=size)
+
+    def close(self) -> None:
+        try:
+            for stream in self._streams.values():
+                stream.close()
+        finally:
+            for output, begin in self._starts.values():
+                end = _tell(output)
+                if begin is not None and end is not None:
+                    self.compressed_bytes += end - begin
+
+    def _write_batch(self, key: bytes, batch: List[bytes], timer: _Timer) -> int:
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = self._open(key)
+        data = b"".join(batch)
+        start = time.perf_counter()
+        stream.write(data)
+        timer.seconds += time.perf_counter() - start
+        return len(data)
+
+    def _open(self, key: bytes) -> BinaryIO:
+        output = self.open_output(key.decode())
+        self._starts[key] = (output, _tell(output))
+        if self.compression_threads:
+            stream: BinaryIO = ParallelGzipWriter(
+                output,
+                compresslevel=self.compression_level,
+                threads=self.compression_threads,
+                executor=self.executor,
+            )
+        else:
+            stream = gzip.GzipFile(
+                fileobj=output, mode="wb", compresslevel=self.compression_level
+            )
+        self._streams[key] = stream
+        stream.write(self.headers.getvalue())
+        return stream
+
+
+class _OutputOptions(NamedTuple):
+    compression_level: int = 9
+    compression_threads: int = 0
+    bgzf: bool = False
+    region_index: Optional[BinaryIO] = None
+    separate_members: bool = False
+    columnar: bool = False
+
+
+def _check_output_options(options: _OutputOptions) -> None:
+    if options.compression_threads < 0:
+        raise ValueError("compression_threads must not be negative")
+    if options.bgzf and options.compression_threads:
+        raise ValueError("BGZF output cannot be compressed with compression_threads")
+    if options.columnar and (
+        options.compression_threads or options.bgzf or options.separate_members
+    ):
+        raise ValueError("Columnar output cannot be written as gzip members")
 
-                column_headers = _read_and_parse_column_headers(reader)
-                if is_first_pass:
-                    expected_column_headers = column_headers.copy()
+
+def _open_output(output: BinaryIO, options: _OutputOptions) -> BinaryIO:
+    _check_output_options(options)
+    if options.columnar:
+        return ColumnarWriter(output, compresslevel=options.compression_level)
+    if options.region_index is not None:
+        return RegionIndexingWriter(
+            BgzfWriter(output, compresslevel=options.compression_level)
+        )
+    if options.bgzf:
+        return BgzfWriter(output, compresslevel=options.compression_level)
+    if options.compression_threads:
+        return ParallelGzipWriter(
+            output,
+            compresslevel=options.compression_level,
+            threads=options.compression_threads,
+        )
+    if options.separate_members:
+        return GzipMemberWriter(output, compresslevel=options.compression_level)
+    return gzip.GzipFile(
+        fileobj=output, mode="wb", compresslevel=options.compression_level
+    )
+
+
+@contextlib.contextmanager
+def _output_stream(output: BinaryIO, options: _OutputOptions) -> Iterator[BinaryIO]:
+    """Open the compressed output stream, writing any sidecar index on success."""
+    stream = _open_output(output, options)
+    with stream:
+        yield stream
+    if options.region_index is not None:
+        stream.index.write(options.region_index)
+
+
+class _ParsedMaf(NamedTuple):
+    """An aliquot-level MAF whose headers have been read.
+
+    The body is positioned at the first line after the column headers.
+    """
+
+    maf: AliquotLevelMaf
+    file_headers: Optional["_MafFileHeader"]
+    column_headers: List[str]
+    body: BinaryIO
+    input_stats: Optional["_InputStats"] = None
+
+
+class _InputStats:
+    """Statistics of reading an input, updated as it is decompressed."""
+
+    def __init__(self, compressed_bytes: int = 0):
+        self.compressed_bytes = compressed_bytes
+        self.decompression_seconds = 0.0
+
+
+class _TimedReader(io.RawIOBase):
+    """A raw reader adding the time spent reading a stream to its input statistics.
+
+    Wrapped in an io.BufferedReader, it is only called once per buffer fill or
+    large read, so timing costs next to nothing.
+    """
+
+    def __init__(self, stream: BinaryIO, input_stats: _InputStats):
+        self.stream = stream
+        self.input_stats = input_stats
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        start = time.perf_counter()
+        try:
+            return self.stream.readinto(buffer)
+        finally:
+            self.input_stats.decompression_seconds += time.perf_counter() - start
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.stream.close()
+        finally:
+            super().close()
+
+
+def _is_path(file: Any) -> bool:
+    return isinstance(file, (str, os.PathLike))
+
+
+def _open_maf(maf: AliquotLevelMaf, input_stats: _InputStats) -> io.BufferedReader:
+    """Open a reader of the decompressed content of a MAF.
+
+    Readers keep the default buffer size, since preflight and the coordinate merge
+    hold every input open at once.  Bodies copied without being parsed are read
+    in blocks of _COPY_BUFFER_SIZE, which bypass the buffer.
+    """
+    if _is_path(maf.file):
+        return io.BufferedReader(_TimedReader(MappedGzipReader(maf.file), input_stats))
+    return io.BufferedReader(_TimedReader(gzip.open(maf.file, "r"), input_stats))
+
+
+def _compressed_size(file: Any) -> int:
+    """Return the size of the rest of a compressed input, or 0 if it is unknown."""
+    if _is_path(file):
+        return os.path.getsize(file)
+    try:
+        if not file.seekable():
+            return 0
+        position = file.tell()
+        end = file.seek(0, io.SEEK_END)
+        file.seek(position)
+        return end - position
+    except (AttributeError, OSError):
+        return 0
+
+
+def _hash_input(
+    maf: AliquotLevelMaf, options_key: bytes
+) -> Tuple[AliquotLevelMaf, str, int]:
+    """Return the MAF ready to parse, its cache key and its compressed size.
+
+    The input is hashed in blocks.  Paths are reopened and seekable files are
+    rewound to be parsed; other files are read whole, once, to be hashed.
+    """
+    if _is_path(maf.file):
+        size = os.path.getsize(maf.file)
+        with open(maf.file, "rb") as file:
+            return maf, file_content_key(options_key, file, size), size
+    position = _tell(maf.file)
+    if position is not None:
+        size = _compressed_size(maf.file)
+        key = file_content_key(options_key, maf.file, size)
+        maf.file.seek(position)
+        return maf, key, size
+    content = maf.file.read()
+    key = file_content_key(options_key, io.BytesIO(content), len(content))
+    return maf._replace(file=io.BytesIO(content)), key, len(content)
+
+
+def _parse_maf(maf: AliquotLevelMaf) -> _ParsedMaf:
+    input_stats = _InputStats(compressed_bytes=_compressed_size(maf.file))
+    reader = _open_maf(maf, input_stats)
+    try:
+        file_headers = _read_and_parse_file_headers(reader)
+        column_headers = _read_and_parse_column_headers(reader) if file_headers else []
+    except BaseException:
+        reader.close()
+        raise
+    return _ParsedMaf(
+        maf=maf,
+        file_headers=file_headers,
+        column_headers=column_headers,
+        body=reader,
+        input_stats=input_stats,
+    )
+
+
+def _load_maf(maf: AliquotLevelMaf) -> _ParsedMaf:
+    """Parse a MAF and decompress its whole body into memory."""
+    return _buffer_body(_parse_maf(maf))
+
+
+def _buffer_body(parsed: _ParsedMaf) -> _ParsedMaf:
+    """Decompress the rest of the body of a parsed MAF into memory."""
+    with parsed.body as reader:
+        body = reader.read()
+    return parsed._replace(body=io.BytesIO(body))
+
+
+def _preflight(
+    mafs: List[AliquotLevelMaf], threads: Optional[int], same_columns: bool = True
+) -> List[_ParsedMaf]:
+    """Parse and validate the headers of all MAFs before any body is read.
+
+    The headers are read concurrently.  On success, the returned MAFs are positioned
+    at the start of their bodies.  If same_columns is not set, the MAFs may have
+    different column headers.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(_parse_maf, maf) for maf in mafs]
+    # The executor has waited for every future, so none of these calls block.
+    parsed_mafs = [future.result() for future in futures if not future.exception()]
+    try:
+        for future in futures:
+            future.result()
+        _validate_all_headers(parsed_mafs, same_columns=same_columns)
+    except BaseException:
+        for parsed in parsed_mafs:
+            parsed.body.close()
+        raise
+    return parsed_mafs
+
+
+def _validate_all_headers(
+    parsed_mafs: List[_ParsedMaf], same_columns: bool = True
+) -> None:
+    """Validate the headers of all MAFs against the first one with headers.
+
+    Every validation error is collected and reported in a single ValidationError.
+    If same_columns is not set, only the file headers are validated.
+    """
+    errors = []
+    expected: Optional[_ParsedMaf] = None
+    for parsed in parsed_mafs:
+        if not parsed.file_headers:
+            continue
+        if expected is None:
+            expected = parsed
+        try:
+            _validate_file_headers(
+                headers=parsed.file_headers, expected_headers=expected.file_headers
+            )
+            if same_columns:
                 _validate_column_headers(
-                    headers=column_headers, expected_headers=expected_column_headers
+                    headers=parsed.column_headers,
+                    expected_headers=expected.column_headers,
                 )
+        except ValidationError as e:
+            errors.append(f"{parsed.maf.tumor_aliquot_submitter_id}: {e}")
+
+    if errors:
+        raise ValidationError(
+            message=f"Failed header validation of {len(errors)} files.",
+            details="\n".join(errors),
+        )
+
+
+def _union_column_headers(parsed_mafs: List[_ParsedMaf]) -> List[str]:
+    """Return the columns of all MAFs, in the order they first appear."""
+    union: Dict[str, None] = OrderedDict()
+    for parsed in parsed_mafs:
+        if parsed.file_headers:
+            union.update((column, None) for column in parsed.column_headers)
+    return list(union)
+
+
+def _remap_to_union(parsed_mafs: List[_ParsedMaf]) -> List[_ParsedMaf]:
+    """Remap the bodies of MAFs to the union of their columns."""
+    union = _union_column_headers(parsed_mafs)
+    return [_remap_to_columns(parsed, union) for parsed in parsed_mafs]
+
+
+def _remap_to_columns(parsed: _ParsedMaf, column_headers: List[str]) -> _ParsedMaf:
+    """Remap the body of a MAF to columns including all of its own."""
+    if not parsed.file_headers or parsed.column_headers == column_headers:
+        return parsed
+    missing = [c for c in parsed.column_headers if c not in column_headers]
+    if missing:
+        raise ValidationError(
+            message="MAF has columns missing from the aggregated MAF.",
+            details=f"{parsed.maf.tumor_aliquot_submitter_id}: {missing}",
+        )
+    return parsed._replace(
+        column_headers=column_headers,
+        body=_RemappedBody(
+            parsed.body, _compile_remap(parsed.column_headers, column_headers)
+        ),
+    )
+
+
+def _compile_remap(column_headers: List[str], union: List[str]) -> _RowTransform:
+    """Compile a transform reordering the columns of a row to those of union.
+
+    Columns of union missing from column_headers are left empty.
+    """
+    width = len(column_headers)
+    if union[:width] == column_headers:
+        padding = b"\t" * (len(union) - width)
+
+        def pad(row: bytes) -> bytes:
+            return row.rstrip(b"\r\n") + padding + b"\n"
+
+        return pad
+
+    # Missing columns pick the empty field appended after the last column.
+    positions = {column: i for i, column in enumerate(column_headers)}
+    pick = _field_picker([positions.get(column, width) for column in union])
+
+    def remap(row: bytes) -> Optional[bytes]:
+        fields = row.rstrip(b"\r\n").split(b"\t", width - 1)
+        if len(fields) < width:
+            return _check_short_row(row)
+        fields.append(b"")
+        return b"\t".join(pick(fields)) + b"\n"
+
+    return remap
 
-                if is_first_pass:
-                    _write_file_headers(
-                        output=gzip_output,
-                        version=file_headers.version,
-                        file_date=datetime.datetime.now(),
-                        annotation_spec=file_headers.annotation_spec,
-                        submitter_ids=[m.tumor_aliquot_submitter_id for m in mafs],
-                    )
-                    _write_column_headers(gzip_output, column_headers)
 
-                for line in reader:
-                    gzip_output.write(line.decode())
+class _RemappedBody:
+    """The rows of a MAF body with a row transform applied to each."""
 
-            is_first_pass = False
+    def __init__(self, body: BinaryIO, transform: _RowTransform):
+        self.body = body
+        self.transform = transform
+
+    def __iter__(self) -> Iterator[bytes]:
+        transform = self.transform
+        for row in self.body:
+            if not row.strip():
+                continue
+            row = transform(row)
+            if row is not None:
+                yield row
+
+    def read(self) -> bytes:
+        return b"".join(self)
+
+    def close(self) -> None:
+        self.body.close()
+
+    def __enter__(self) -> "_RemappedBody":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _iter_parsed_mafs(
+    mafs: List[AliquotLevelMaf],
+    decompression_threads: int,
+    read_ahead: Optional[int],
+    preflighted: Optional[List[_ParsedMaf]] = None,
+) -> Iterator[_ParsedMaf]:
+    """Parse the given MAFs, yielding them in order.
+
+    If preflighted is given, its MAFs, whose headers were already parsed, are used
+    instead of parsing mafs again.  Each yielded body is only valid until the next
+    MAF is requested.
+    """
+    if decompression_threads < 0:
+        raise ValueError("decompression_threads must not be negative")
+
+    sources: List[Any] = mafs
+    parse: Callable[[Any], _ParsedMaf] = _parse_maf
+    if preflighted is not None:
+        sources = preflighted
+        parse = _already_parsed
+
+    if not decompression_threads:
+        for source in sources:
+            parsed = parse(source)
+            with parsed.body:
+                yield parsed
+        return
+
+    if read_ahead is None:
+        read_ahead = 2 * decompression_threads
+    if read_ahead < 1:
+        raise ValueError("read_ahead must be at least 1")
+
+    def load(source: Any) -> _ParsedMaf:
+        return _buffer_body(parse(source))
+
+    with ThreadPoolExecutor(max_workers=decompression_threads) as executor:
+        yield from _ordered_map(executor, load, sources, read_ahead)
+
+
+def _already_parsed(parsed: _ParsedMaf) -> _ParsedMaf:
+    return parsed
+
+
+def _ordered_map(
+    executor: Executor, fn: Callable[[_T], _U], items: Iterable[_T], window: int
+) -> Iterator[_U]:
+    """Like Executor.map, but with at most window calls submitted ahead.
+
+    Unlike Executor.map, items are consumed lazily so that memory held by pending
+    results stays bounded.
+    """
+    pending: Deque[Future] = deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
 
 
 class _MafFileHeader(NamedTuple):
@@ -133,7 +2174,7 @@ class _MafFileHeaderBuilder:
 
 def _read_and_parse_file_headers(reader: io.BufferedReader) -> Optional[_MafFileHeader]:
     builder = _MafFileHeaderBuilder()
-    while reader.peek(1) and reader.peek(1).decode()[0] == "#":
+    while reader.peek(1)[:1] == b"#":
         line = reader.readline().decode().rstrip()[1:]
         key, value = line.split(" ", 1)
         if key == "version":
@@ -182,22 +2223,27 @@ def _validate_column_headers(headers: List[str], expected_headers: List[str]) ->
 
 
 def _write_file_headers(
-    output: TextIO,
+    output: BinaryIO,
     version: str,
     file_date: datetime.datetime,
     annotation_spec: str,
     submitter_ids: List[str],
+    sort_order: Optional[str] = None,
 ) -> None:
     header_lines = [
         f"#version {version}\n",
         f"#filedate {file_date.strftime('%Y%m%d')}\n",
         f"#annotation.spec {annotation_spec}\n",
+    ]
+    if sort_order:
+        header_lines.append(f"#sort.order {sort_order}\n")
+    header_lines += [
         f"#n.analyzed.samples {len(submitter_ids)}\n",
         f"#tumor.aliquots.submitter_id {','.join(submitter_ids)}\n",
     ]
-    output.writelines(header_lines)
+    output.write("".join(header_lines).encode())
 
 
-def _write_column_headers(output: TextIO, column_headers: List[str]) -> None:
-    output.write("\t".join(column_headers))
-    output.write("\n")
+def _write_column_headers(output: BinaryIO, column_headers: List[str]) -> None:
+    output.write("\t".join(column_headers).encode())
+    output.write(b"\n")
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+_METADATA_SUFFIX = ".json"
+_BODY_SUFFIX = ".gz"
+
+# Once the cache exceeds max_size, entries are evicted until it fits in this
+# fraction of max_size, so that the directory is only rescanned once in a while.
+_EVICTION_TARGET = 0.9
+
+
+class CacheEntry(NamedTuple):
+    """An entry of a SegmentCache.
+
+    Attributes:
+        metadata: The metadata stored with the entry.
+        body: The open body file of the entry, which the caller must close.
+    """
+
+    metadata: Dict[str, Any]
+    body: BinaryIO
+
+
+class SegmentCache:
+    """An on-disk cache of compressed body segments of aliquot-level MAFs.
+
+    Each entry is stored as two files in the cache directory: the metadata as JSON
+    and the body as gzip members that can be concatenated to an output as is.
+    Entries are written atomically, so several processes can share a cache.
+
+    Reading an entry marks it as recently used.  The total size and the order of
+    use of the entries are tracked in memory, so adding an entry costs O(1).  When
+    the total size exceeds max_size, the directory is rescanned, to account for
+    other processes sharing the cache, and the least recently used entries are
+    evicted until the cache fits in 90% of max_size.
+
+    Attributes:
+        directory: The directory holding the entries.
+        max_size: The maximum total size of the entries in bytes.  Defaults to no
+                  limit.
+    """
+
+    def __init__(self, directory: str, max_size: Optional[int] = None):
+        if max_size is not None and max_size < 0:
+            raise ValueError("max_size must not be negative")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        # The size of each entry, from least to most recently used.  Only tracked
+        # when there is a max_size.
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        if max_size is not None:
+            self._load(sorted(self._entries()))
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Return the entry with the given key, or None if it is not cached."""
+        metadata_path, body_path = self._paths(key)
+        try:
+            with open(metadata_path, "r") as metadata_file:
+                metadata = json.load(metadata_file)
+            body = open(body_path, "rb")
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(metadata_path)
+        except FileNotFoundError:
+            pass
+        if key in self._sizes:
+            self._sizes.move_to_end(key)
+        return CacheEntry(metadata=metadata, body=body)
+
+    def put(self, key: str, metadata: Dict[str, Any], body: BinaryIO) -> None:
+        """Add an entry, copying its body from the current position of a file."""
+        metadata_path, body_path = self._paths(key)
+        self._write_atomically(body_path, lambda f: shutil.copyfileobj(body, f))
+        # The metadata is written last, so an entry is only visible once complete.
+        self._write_atomically(
+            metadata_path, lambda f: f.write(json.dumps(metadata).encode())
+        )
+        if self.max_size is None:
+            return
+        try:
+            size = os.path.getsize(metadata_path) + os.path.getsize(body_path)
+        except FileNotFoundError:
+            return
+        self._total += size - self._sizes.pop(key, 0)
+        self._sizes[key] = size
+        if self._total > self.max_size:
+            self.evict()
+
+    def size(self) -> int:
+        """Return the total size of the entries in bytes."""
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self) -> None:
+        """Rescan the cache and evict the least recently used entries if it is full.
+
+        Entries are evicted until the cache fits in 90% of max_size.
+        """
+        if self.max_size is None:
+            return
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        evicted = 0
+        if total > self.max_size:
+            target = self.max_size * _EVICTION_TARGET
+            for _, key, size in entries:
+                if total <= target:
+                    break
+                for path in self._paths(key):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                evicted += 1
+        self._load(entries[evicted:])
+
+    def _load(self, entries: List[Tuple[float, str, int]]) -> None:
+        """Replace the tracked entries with entries sorted by last use."""
+        self._sizes = OrderedDict((key, size) for _, key, size in entries)
+        self._total = sum(self._sizes.values())
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.directory, key)
+        return base + _METADATA_SUFFIX, base + _BODY_SUFFIX
+
+    def _entries(self) -> List[Tuple[float, str, int]]:
+        """Return the last use time, key and size of each complete entry."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_METADATA_SUFFIX):
+                continue
+            key = name[: -len(_METADATA_SUFFIX)]
+            try:
+                metadata_stat = os.stat(os.path.join(self.directory, name))
+                body_stat = os.stat(self._paths(key)[1])
+            except FileNotFoundError:
+                continue
+            size = metadata_stat.st_size + body_stat.st_size
+            entries.append((metadata_stat.st_mtime, key, size))
+        return entries
+
+    def _write_atomically(self, path: str, write) -> None:
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temporary_file:
+                write(temporary_file)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+
+def content_key(*parts: bytes) -> str:
+    """Return a key identifying the given content, for use with SegmentCache."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def file_content_key(
+    prefix: bytes, file: BinaryIO, size: int, block_size: int = 1024 * 1024
+) -> str:
+    """Return content_key(prefix, content) for the next size bytes of a file.
+
+    The content is hashed in blocks of block_size bytes rather than read whole.
+    """
+    digest = hashlib.sha256()
+    digest.update(len(prefix).to_bytes(8, "little"))
+    digest.update(prefix)
+    digest.update(size.to_bytes(8, "little"))
+    remaining = size
+    while remaining:
+        block = file.read(min(block_size, remaining))
+        if not block:
+            raise ValueError("File ended before the given size.")
+        digest.update(block)
+        remaining -= len(block)
+    return digest.hexdigest()
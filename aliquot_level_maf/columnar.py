@@ -0,0 +1,395 @@
+import array
+import io
+import json
+import struct
+import sys
+import zlib
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+# Approximate memory taken by the rows buffered for a row group by default.
+DEFAULT_ROW_GROUP_BYTES = 16 * 1024 * 1024
+
+# Approximate memory taken by each buffered field besides its value.
+_FIELD_MEMORY = 48
+
+# Marks the start and the end of a columnar MAF.
+_MAGIC = b"ALMAFCOL1"
+
+# Size of the footer, written before the final magic.
+_FOOTER_SIZE = struct.Struct("<Q")
+
+# Size of the dictionary of a dictionary-encoded column chunk.
+_DICTIONARY_SIZE = struct.Struct("<I")
+
+# Range of integers that can be integer-encoded.
+_MIN_INT = -(2**63)
+_MAX_INT = 2**63 - 1
+
+_PLAIN = "plain"
+_DICTIONARY = "dictionary"
+_INT = "int"
+
+
+class _ColumnChunk(NamedTuple):
+    """The location and encoding of the values of one column in a row group."""
+
+    offset: int
+    size: int
+    encoding: str
+
+
+class _RowGroup(NamedTuple):
+    row_count: int
+    chunks: List[_ColumnChunk]
+
+
+class ColumnarWriter(io.BufferedIOBase):
+    """A write-only stream converting a MAF to a columnar binary format.
+
+    The MAF is written to the stream as text, as aggregate_mafs writes it.  Pragmas
+    and column headers are kept for the footer, and rows are buffered until they
+    take about row_group_bytes of memory and are written as a row group, so memory
+    stays bounded however wide the rows are.  Each column of a row group is encoded
+    on its own and compressed with zlib:
+
+    - as integers, if every value is an integer or empty, as positions and counts
+      are;
+    - with a dictionary, if values repeat at least twice on average, as in
+      Hugo_Symbol, Variant_Classification, Chromosome and IMPACT;
+    - as plain text otherwise.
+
+    The footer records the location of every column chunk, so ColumnarReader can
+    read some columns without reading the others.  It also records the integer
+    columns, those with integer-encoded chunks and no other non-empty values, so
+    that a column is read with the same type in every row group.
+
+    Closing the writer writes the last row group and the footer but does not close
+    the underlying file-like object.
+
+    Attributes:
+        fileobj: The file-like object the columnar MAF is written to.
+        compresslevel: The zlib compression level of the column chunks, from 0 to 9.
+        row_group_bytes: The approximate memory taken by the rows of a row group.
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        compresslevel: int = 9,
+        row_group_bytes: int = DEFAULT_ROW_GROUP_BYTES,
+    ):
+        if row_group_bytes < 1:
+            raise ValueError("row_group_bytes must be at least 1")
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.row_group_bytes = row_group_bytes
+        self._pragmas: List[str] = []
+        self._columns: Optional[List[str]] = None
+        # Whether each column has integer-encoded chunks, and other non-empty values.
+        self._has_integers: List[bool] = []
+        self._has_text: List[bool] = []
+        self._rows: List[List[bytes]] = []
+        self._buffered_bytes = 0
+        self._row_groups: List[_RowGroup] = []
+        self._partial = b""
+        self._offset = 0
+        self._write(_MAGIC)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = bytes(data)
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._write_line(line)
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._partial:
+                self._write_line(self._partial)
+                self._partial = b""
+            self._write_row_group()
+            footer = json.dumps(
+                {
+                    "pragmas": self._pragmas,
+                    "columns": self._columns or [],
+                    "integer_columns": [
+                        column
+                        for column, integers, text in zip(
+                            self._columns or [], self._has_integers, self._has_text
+                        )
+                        if integers and not text
+                    ],
+                    "row_groups": [
+                        [row_group.row_count, [list(c) for c in row_group.chunks]]
+                        for row_group in self._row_groups
+                    ],
+                }
+            ).encode()
+            self._write(footer + _FOOTER_SIZE.pack(len(footer)) + _MAGIC)
+            self.fileobj.flush()
+        finally:
+            super().close()
+
+    def _write(self, data: bytes) -> None:
+        self.fileobj.write(data)
+        self._offset += len(data)
+
+    def _write_line(self, line: bytes) -> None:
+        line = line.rstrip(b"\r")
+        if self._columns is None:
+            if line.startswith(b"#"):
+                self._pragmas.append(line.decode())
+            elif line:
+                self._columns = line.decode().split("\t")
+                self._has_integers = [False] * len(self._columns)
+                self._has_text = [False] * len(self._columns)
+            return
+        # Rows whose fields are all empty are still rows.
+        if not line:
+            return
+        fields = line.split(b"\t")
+        if len(fields) != len(self._columns):
+            raise ValueError(
+                f"Row has {len(fields)} columns instead of {len(self._columns)}"
+            )
+        self._rows.append(fields)
+        self._buffered_bytes += len(line) + _FIELD_MEMORY * len(fields)
+        if self._buffered_bytes >= self.row_group_bytes:
+            self._write_row_group()
+
+    def _write_row_group(self) -> None:
+        if not self._rows:
+            return
+        chunks = []
+        # Transposing the rows at once is much faster than appending each field.
+        for index, values in enumerate(zip(*self._rows)):
+            encoding, payload = _encode(values)
+            if encoding == _INT:
+                self._has_integers[index] = True
+            elif any(values):
+                self._has_text[index] = True
+            data = zlib.compress(payload, self.compresslevel)
+            chunks.append(_ColumnChunk(self._offset, len(data), encoding))
+            self._write(data)
+        self._row_groups.append(_RowGroup(len(self._rows), chunks))
+        self._rows.clear()
+        self._buffered_bytes = 0
+
+
+class ColumnarReader:
+    """A reader of MAFs written by ColumnarWriter.
+
+    Only the footer is read when the reader is created.  Reading columns then only
+    reads and decompresses the chunks of those columns.
+
+    Values of integer columns are returned as integers, or None if they are empty,
+    in every row group.  Values of other columns are returned as strings.
+
+    Attributes:
+        fileobj: The seekable file-like object the columnar MAF is read from.
+        pragmas: The pragmas of the MAF, such as `#version 2.4`.
+        columns: The column headers of the MAF.
+        row_count: The number of rows of the MAF.
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        trailer_size = _FOOTER_SIZE.size + len(_MAGIC)
+        fileobj.seek(0)
+        if fileobj.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("Not a columnar MAF")
+        end = fileobj.seek(0, io.SEEK_END)
+        if end < len(_MAGIC) + trailer_size:
+            raise ValueError("Truncated columnar MAF")
+        fileobj.seek(end - trailer_size)
+        trailer = fileobj.read(trailer_size)
+        if trailer[_FOOTER_SIZE.size :] != _MAGIC:
+            raise ValueError("Truncated columnar MAF")
+        (footer_size,) = _FOOTER_SIZE.unpack(trailer[: _FOOTER_SIZE.size])
+        fileobj.seek(end - trailer_size - footer_size)
+        footer = json.loads(fileobj.read(footer_size).decode())
+
+        self.pragmas: List[str] = footer["pragmas"]
+        self.columns: List[str] = footer["columns"]
+        self._integer_columns = set(footer["integer_columns"])
+        self._row_groups = [
+            _RowGroup(row_count, [_ColumnChunk(*chunk) for chunk in chunks])
+            for row_count, chunks in footer["row_groups"]
+        ]
+        self.row_count = sum(row_group.row_count for row_group in self._row_groups)
+
+    def read_columns(
+        self, columns: Optional[Sequence[str]] = None
+    ) -> Dict[str, List[Any]]:
+        """Read the values of some columns of every row.
+
+        Args:
+            columns: The names of the columns to read.  Defaults to all of them.
+
+        Returns:
+            A dictionary of column names to their values, in row order.
+        """
+        result: Dict[str, List[Any]] = {}
+        for row_group in self.iter_row_groups(columns):
+            for column, values in row_group.items():
+                result.setdefault(column, []).extend(values)
+        if not result:
+            result = {column: [] for column in self._indices(columns)[1]}
+        return result
+
+    def iter_row_groups(
+        self, columns: Optional[Sequence[str]] = None
+    ) -> Iterator[Dict[str, List[Any]]]:
+        """Read the values of some columns one row group at a time.
+
+        Args:
+            columns: The names of the columns to read.  Defaults to all of them.
+
+        Returns:
+            A dictionary of column names to their values in each row group.
+        """
+        indices, names = self._indices(columns)
+        for row_group in self._row_groups:
+            values = {}
+            for index, name in zip(indices, names):
+                chunk = row_group.chunks[index]
+                self.fileobj.seek(chunk.offset)
+                payload = zlib.decompress(self.fileobj.read(chunk.size))
+                values[name] = _decode(
+                    chunk.encoding,
+                    payload,
+                    row_group.row_count,
+                    integer=name in self._integer_columns,
+                )
+            yield values
+
+    def _indices(self, columns: Optional[Sequence[str]]) -> Tuple[List[int], List[str]]:
+        if columns is None:
+            columns = self.columns
+        missing = [column for column in columns if column not in self.columns]
+        if missing:
+            raise KeyError(f"Columns are missing from the MAF: {missing}")
+        return [self.columns.index(column) for column in columns], list(columns)
+
+
+def _encode(values: Tuple[bytes, ...]) -> Tuple[str, bytes]:
+    """Choose the encoding of the values of a column chunk and encode them."""
+    integers = _parse_integers(values)
+    if integers is not None:
+        # Empty values are encoded as 0, and marked as null after the integers.
+        payload = _to_little_endian(array.array("q", (i or 0 for i in integers)))
+        if None in integers:
+            payload += bytes(i is None for i in integers)
+        return _INT, payload
+
+    dictionary = list(dict.fromkeys(values))
+    if len(values) >= 2 * len(dictionary):
+        codes = {value: code for code, value in enumerate(dictionary)}
+        dictionary_bytes = b"\n".join(dictionary)
+        code_array = array.array(_code_type(len(dictionary)), map(codes.get, values))
+        return _DICTIONARY, (
+            _DICTIONARY_SIZE.pack(len(dictionary_bytes))
+            + dictionary_bytes
+            + _to_little_endian(code_array)
+        )
+
+    return _PLAIN, b"\n".join(values)
+
+
+def _decode(
+    encoding: str, payload: bytes, row_count: int, integer: bool
+) -> List[Any]:
+    """Decode the values of a column chunk, as integers if its column is integer.
+
+    Chunks of integer columns that are not integer-encoded only have empty values.
+    """
+    if encoding == _INT:
+        integers = _from_little_endian("q", payload[: 8 * row_count])
+        nulls = payload[8 * row_count :]
+        if integer:
+            if not nulls:
+                return integers.tolist()
+            return [None if null else i for i, null in zip(integers, nulls)]
+        if not nulls:
+            return [str(i) for i in integers]
+        return ["" if null else str(i) for i, null in zip(integers, nulls)]
+    if integer and encoding in (_DICTIONARY, _PLAIN):
+        return [None] * row_count
+
+    if encoding == _DICTIONARY:
+        (size,) = _DICTIONARY_SIZE.unpack_from(payload)
+        start = _DICTIONARY_SIZE.size
+        dictionary = payload[start : start + size].decode().split("\n")
+        codes = _from_little_endian(
+            _code_type(len(dictionary)), payload[start + size :]
+        )
+        return [dictionary[code] for code in codes]
+
+    if encoding == _PLAIN:
+        return payload.decode().split("\n")
+
+    raise ValueError(f"Unknown column encoding: {encoding}")
+
+
+def _parse_integers(values: Sequence[bytes]) -> Optional[List[Optional[int]]]:
+    """Parse values that are all integers or empty, or return None.
+
+    Only integers written in canonical form are parsed, so that their text is
+    restored exactly.
+    """
+    integers: List[Optional[int]] = []
+    for value in values:
+        if not value:
+            integers.append(None)
+            continue
+        try:
+            integer = int(value)
+        except ValueError:
+            return None
+        if b"%d" % integer != value or not _MIN_INT <= integer <= _MAX_INT:
+            return None
+        integers.append(integer)
+    if all(integer is None for integer in integers):
+        return None
+    return integers
+
+
+def _code_type(dictionary_size: int) -> str:
+    """Return the smallest array type holding the codes of a dictionary."""
+    if dictionary_size <= 1 << 8:
+        return "B"
+    if dictionary_size <= 1 << 16:
+        return "H"
+    return "I"
+
+
+def _to_little_endian(values: array.array) -> bytes:
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: bytes) -> array.array:
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
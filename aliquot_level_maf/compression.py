@@ -0,0 +1,592 @@
+import gzip
+import io
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque, Iterator, Optional, Tuple, Union
+
+# Amount of uncompressed data compressed into each gzip member by default.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Maximum amount of uncompressed data in a BGZF block, as used by htslib.
+BGZF_BLOCK_SIZE = 0xFF00
+
+# The empty block marking the end of a BGZF file.
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Amount of compressed data handed to the decompressor at once by MappedGzipReader.
+_MAPPED_INPUT_CHUNK_SIZE = 256 * 1024
+
+# Gzip member header without a file name or modification time.
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+# Gzip header with the BGZF extra field, followed by the total block size minus 1.
+_BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+
+
+class ParallelGzipWriter(io.BufferedIOBase):
+    """A write-only gzip stream that compresses on a thread pool.
+
+    Data written to the stream is split into fixed-size chunks.  Each chunk is
+    compressed as an independent gzip member on a thread pool and the members are
+    written to the underlying file-like object in order.  A gzip file may consist of
+    several members, so the result can be read by any gzip reader such as the
+    `gzip` module or `zcat`.
+
+    Closing the writer flushes all pending data but does not close the underlying
+    file-like object.
+
+    Attributes:
+        fileobj: The file-like object the compressed data is written to.
+        compresslevel: The gzip compression level, from 0 to 9.
+        compressed_size: The number of compressed bytes written to fileobj.
+        uncompressed_size: The number of bytes written to the stream.
+        threads: The number of threads compressing chunks.  Defaults to the number of
+                 CPUs.  Ignored when an executor is given.
+        chunk_size: The amount of uncompressed data in each gzip member.
+        executor: An executor to compress chunks on instead of a private thread pool.
+                  It is not shut down when the writer is closed.
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        compresslevel: int = 9,
+        threads: Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        executor: Optional[Executor] = None,
+    ):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        threads = threads or os.cpu_count() or 1
+
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.chunk_size = chunk_size
+        self._owns_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=threads)
+        # Bound the number of chunks in flight so that memory stays capped when the
+        # producer is faster than the compressors.
+        self._max_pending = 2 * threads
+        self._pending: Deque[Future] = deque()
+        self._buffer = bytearray()
+        self._wrote_member = False
+        self.compressed_size = 0
+        self.uncompressed_size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            chunk = bytes(self._buffer[: self.chunk_size])
+            del self._buffer[: self.chunk_size]
+            self._submit(chunk)
+        self.uncompressed_size += data.nbytes
+        return data.nbytes
+
+    def end_member(self) -> None:
+        """End the current gzip member, so that the following data starts a new one.
+
+        All pending members are written, so compressed_size is then exact.
+        """
+        self.flush()
+
+    def flush(self) -> None:
+        """Compress any buffered data and wait for all members to be written."""
+        if self.closed:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._write_member(self._pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+            # An empty gzip file still has one member.
+            if not self._wrote_member:
+                self._write_member(gzip.compress(b"", self.compresslevel))
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._buffer.clear()
+            if self._owns_executor:
+                self._executor.shutdown()
+            super().close()
+
+    def _submit(self, chunk: bytes) -> None:
+        if len(self._pending) >= self._max_pending:
+            self._write_member(self._pending.popleft().result())
+        self._pending.append(
+            self._executor.submit(gzip.compress, chunk, self.compresslevel)
+        )
+
+    def _write_member(self, member: bytes) -> None:
+        self.fileobj.write(member)
+        self._wrote_member = True
+        self.compressed_size += len(member)
+
+
+class GzipMemberWriter(io.BufferedIOBase):
+    """A write-only gzip stream that can start a new gzip member at any point.
+
+    This is the single-threaded counterpart of ParallelGzipWriter.end_member, used
+    to give parts of the output, such as the body of each aliquot, their own gzip
+    members that can be decompressed independently.
+
+    Closing the writer ends the current member but does not close the underlying
+    file-like object.
+
+    Attributes:
+        fileobj: The file-like object the compressed data is written to.
+        compresslevel: The gzip compression level, from 0 to 9.
+        compressed_size: The number of compressed bytes written to fileobj.  It is
+                         only exact after end_member.
+        uncompressed_size: The number of bytes written to the stream.
+    """
+
+    def __init__(self, fileobj: BinaryIO, compresslevel: int = 9):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.compressed_size = 0
+        self.uncompressed_size = 0
+        self._compressor = None
+        self._crc = 0
+        self._member_size = 0
+        self._wrote_member = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = memoryview(data).cast("B")
+        if not data.nbytes:
+            return 0
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS
+            )
+            self._write(_GZIP_HEADER)
+        self._write(self._compressor.compress(data))
+        self._crc = zlib.crc32(data, self._crc)
+        self._member_size += data.nbytes
+        self.uncompressed_size += data.nbytes
+        return data.nbytes
+
+    def end_member(self) -> None:
+        """End the current gzip member, so that the following data starts a new one.
+
+        Nothing is written if no data was written since the previous member ended.
+        """
+        if self._compressor is None:
+            return
+        self._write(self._compressor.flush())
+        self._write(struct.pack("<II", self._crc, self._member_size & 0xFFFFFFFF))
+        self._compressor = None
+        self._crc = 0
+        self._member_size = 0
+        self._wrote_member = True
+
+    def copy_members(self, source: BinaryIO, size: int, uncompressed_size: int) -> None:
+        """Copy complete gzip members to the stream without recompressing them.
+
+        The current member is ended first.
+
+        Args:
+            source: A file-like object positioned at the first member.
+            size: The total compressed size of the members.
+            uncompressed_size: The total decompressed size of the members.
+        """
+        self.end_member()
+        remaining = size
+        while remaining:
+            chunk = source.read(min(DEFAULT_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError("Truncated gzip member")
+            self._write(chunk)
+            remaining -= len(chunk)
+        self.uncompressed_size += uncompressed_size
+        self._wrote_member = self._wrote_member or size > 0
+
+    def flush(self) -> None:
+        if not self.closed:
+            self.fileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.end_member()
+            # An empty gzip file still has one member.
+            if not self._wrote_member:
+                self._write(gzip.compress(b"", self.compresslevel))
+            self.fileobj.flush()
+        finally:
+            super().close()
+
+    def _write(self, data: bytes) -> None:
+        self.fileobj.write(data)
+        self.compressed_size += len(data)
+
+
+def read_gzip_members(
+    fileobj: BinaryIO, offset: int, size: int, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Decompress the consecutive gzip members stored in a range of a file.
+
+    Args:
+        fileobj: A seekable file-like object.
+        offset: The offset of the first member in fileobj.
+        size: The total compressed size of the members.
+        chunk_size: The amount of compressed data read at once.
+
+    Returns:
+        The decompressed data, in blocks of arbitrary size.
+    """
+    fileobj.seek(offset)
+    remaining = size
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    in_member = False
+    while remaining:
+        chunk = fileobj.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError("Truncated gzip member")
+        remaining -= len(chunk)
+        while chunk:
+            in_member = True
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            in_member = False
+    if in_member:
+        raise ValueError("Truncated gzip member")
+
+
+class MappedGzipReader(io.RawIOBase):
+    """A raw reader of a memory-mapped gzip file.
+
+    The file is decompressed with a streaming decompressor fed with slices of a
+    memoryview of the mapping, so compressed data is never copied into Python
+    buffers.  The decompressor returns new bytes objects of at most the size
+    requested, which are copied into the buffers given to readinto.  Files with
+    several gzip members are supported, and NUL bytes padding them are skipped as
+    gzip.open skips them.
+
+    Wrap the reader in an io.BufferedReader for line-oriented reads.
+
+    Attributes:
+        name: The path of the file.
+    """
+
+    def __init__(self, path: Union[str, "os.PathLike[str]"]):
+        self.name = path
+        self._view: Optional[memoryview] = None
+        self._mapping: Optional[mmap.mmap] = None
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            # Empty files cannot be mapped, and have no content anyway.
+            if size:
+                self._mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mapping)
+        self._size = size
+        self._position = 0
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._in_member = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.closed:
+            raise ValueError("read from closed file")
+        with memoryview(buffer) as view, view.cast("B") as output:
+            while output.nbytes:
+                if self._decompressor.eof:
+                    self._skip_padding()
+                    if self._position == self._size:
+                        break
+                    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data = self._decompress(output.nbytes)
+                if data:
+                    output[: len(data)] = data
+                    return len(data)
+                if self._position == self._size and not self._decompressor.eof:
+                    break
+        if self._in_member:
+            raise EOFError(
+                "Compressed file ended before the end-of-stream marker was reached"
+            )
+        return 0
+
+    def _skip_padding(self) -> None:
+        """Skip the NUL bytes following a gzip member."""
+        # Most members, such as BGZF blocks, are followed by the next member.
+        if self._position == self._size or self._view[self._position]:
+            return
+        while self._position < self._size:
+            end = min(self._position + _MAPPED_INPUT_CHUNK_SIZE, self._size)
+            with self._view[self._position : end] as chunk:
+                data = chunk.tobytes()
+            padding = len(data) - len(data.lstrip(b"\0"))
+            self._position += padding
+            if padding < len(data):
+                return
+
+    def _decompress(self, max_length: int) -> bytes:
+        """Decompress up to max_length bytes from the current position."""
+        if self._position == self._size:
+            # The decompressor may still hold output of input it already consumed.
+            data = self._decompressor.decompress(b"", max_length)
+        else:
+            end = min(self._position + _MAPPED_INPUT_CHUNK_SIZE, self._size)
+            with self._view[self._position : end] as chunk:
+                data = self._decompressor.decompress(chunk, max_length)
+            # At the end of a member, the input following it is in unused_data and
+            # unconsumed_tail is not updated.
+            if self._decompressor.eof:
+                self._position = end - len(self._decompressor.unused_data)
+            else:
+                self._position = end - len(self._decompressor.unconsumed_tail)
+            self._in_member = True
+        if self._decompressor.eof:
+            self._in_member = False
+        return data
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._view is not None:
+                self._view.release()
+            if self._mapping is not None:
+                self._mapping.close()
+        finally:
+            super().close()
+
+
+class BgzfWriter(io.BufferedIOBase):
+    """A write-only BGZF stream.
+
+    BGZF is the blocked gzip format used by htslib.  Data is compressed in
+    independent gzip members of at most BGZF_BLOCK_SIZE uncompressed bytes, each
+    recording its own compressed size, so the result is a valid gzip file that also
+    supports random access through virtual offsets.  A virtual offset is the offset
+    of a block in the compressed stream shifted left by 16 bits, combined with an
+    offset within the uncompressed block.
+
+    Offsets are relative to the position of fileobj when the writer is created.
+    Closing the writer writes the BGZF end-of-file marker but does not close the
+    underlying file-like object.
+
+    Attributes:
+        fileobj: The file-like object the compressed data is written to.
+        compresslevel: The compression level, from 0 to 9.
+        uncompressed_size: The number of bytes written to the stream.
+    """
+
+    def __init__(self, fileobj: BinaryIO, compresslevel: int = 9):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.uncompressed_size = 0
+        self._buffer = bytearray()
+        self._block_offset = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            block = bytes(self._buffer[:BGZF_BLOCK_SIZE])
+            del self._buffer[:BGZF_BLOCK_SIZE]
+            self._write_block(block)
+        self.uncompressed_size += data.nbytes
+        return data.nbytes
+
+    def tell_virtual(self) -> int:
+        """Return the virtual offset of the next byte to be written."""
+        return (self._block_offset << 16) | len(self._buffer)
+
+    @property
+    def compressed_size(self) -> int:
+        """The number of compressed bytes written, exact after end_member."""
+        return self._block_offset
+
+    def end_member(self) -> None:
+        """End the current block, so that the following data starts a new one."""
+        self.flush()
+
+    def copy_members(self, source: BinaryIO, size: int, uncompressed_size: int) -> None:
+        """Copy complete BGZF blocks to the stream without recompressing them.
+
+        The current block is ended first.
+
+        Args:
+            source: A file-like object positioned at the first block.
+            size: The total compressed size of the blocks.
+            uncompressed_size: The total decompressed size of the blocks.
+        """
+        self.end_member()
+        remaining = size
+        while remaining:
+            chunk = source.read(min(DEFAULT_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError("Truncated BGZF block")
+            self.fileobj.write(chunk)
+            remaining -= len(chunk)
+        self._block_offset += size
+        self.uncompressed_size += uncompressed_size
+
+    def flush(self) -> None:
+        """Write any buffered data as a block, which may be smaller than usual."""
+        if self.closed:
+            return
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer.clear()
+        self.fileobj.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self.fileobj.write(BGZF_EOF)
+        finally:
+            super().close()
+
+    def _write_block(self, data: bytes) -> None:
+        compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        block_size = _BGZF_HEADER.size + len(compressed) + 8
+        header = _BGZF_HEADER.pack(
+            31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1
+        )
+        trailer = struct.pack("<II", zlib.crc32(data), len(data))
+        self.fileobj.write(header + compressed + trailer)
+        self._block_offset += block_size
+
+
+class BgzfReader:
+    """A reader of BGZF files supporting seeks to virtual offsets.
+
+    See BgzfWriter for a description of the format and of virtual offsets.
+
+    Attributes:
+        fileobj: A seekable file-like object with the BGZF data.
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+        self._block_offset = 0
+        self._block_size = 0
+        self._data = b""
+        self._position = 0
+        self.seek_virtual(0)
+
+    def seek_virtual(self, virtual_offset: int) -> None:
+        """Move to the given virtual offset."""
+        block_offset, position = virtual_offset >> 16, virtual_offset & 0xFFFF
+        if block_offset != self._block_offset or not self._block_size:
+            self._load_block(block_offset)
+        if position > len(self._data):
+            raise ValueError(f"Invalid virtual offset {virtual_offset}")
+        self._position = position
+
+    def tell_virtual(self) -> int:
+        """Return the virtual offset of the next byte to be read."""
+        if self._position == len(self._data):
+            self._next_block()
+        return (self._block_offset << 16) | self._position
+
+    def readline(self) -> bytes:
+        """Read a line, including its line terminator, or b"" at the end of file."""
+        parts = []
+        while True:
+            end = self._data.find(b"\n", self._position)
+            if end >= 0:
+                parts.append(self._data[self._position : end + 1])
+                self._position = end + 1
+                break
+            parts.append(self._data[self._position :])
+            self._position = len(self._data)
+            if not self._next_block():
+                break
+        return b"".join(parts)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def _next_block(self) -> bool:
+        """Load the following non-empty block.  Returns False at the end of file."""
+        while self._block_size:
+            self._load_block(self._block_offset + self._block_size)
+            if self._data:
+                return True
+        return False
+
+    def _load_block(self, block_offset: int) -> None:
+        self.fileobj.seek(block_offset)
+        self._block_offset = block_offset
+        self._position = 0
+        self._data, self._block_size = _read_bgzf_block(self.fileobj)
+
+
+def _read_bgzf_block(fileobj: BinaryIO) -> Tuple[bytes, int]:
+    """Read and decompress the BGZF block at the current position of fileobj.
+
+    Returns:
+        The uncompressed data and the compressed size of the block, which is 0 at
+        the end of file.
+    """
+    header = fileobj.read(12)
+    if not header:
+        return b"", 0
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04":
+        raise ValueError("Not a BGZF block")
+    extra_length = struct.unpack("<H", header[10:12])[0]
+    extra = fileobj.read(extra_length)
+
+    block_size = None
+    position = 0
+    while position + 4 <= len(extra):
+        field_id = extra[position : position + 2]
+        (field_length,) = struct.unpack("<H", extra[position + 2 : position + 4])
+        if field_id == b"BC" and field_length == 2:
+            block_size = struct.unpack("<H", extra[position + 4 : position + 6])[0] + 1
+        position += 4 + field_length
+    if block_size is None:
+        raise ValueError("Not a BGZF block")
+
+    rest = fileobj.read(block_size - 12 - extra_length)
+    data = zlib.decompress(rest[:-8], -15)
+    crc, size = struct.unpack("<II", rest[-8:])
+    if size != len(data) or crc != zlib.crc32(data):
+        raise ValueError("Corrupt BGZF block")
+    return data, block_size
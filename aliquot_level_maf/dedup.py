@@ -0,0 +1,256 @@
+import bisect
+import hashlib
+import mmap
+import tempfile
+from typing import Iterable, Iterator, List, Optional, Set
+
+# Size of the hashed keys held by SpillingKeySet.
+KEY_SIZE = 16
+
+# Approximate memory taken by each key held in memory, including the set overhead.
+_KEY_MEMORY = 100
+
+# Number of keys written to a run at once.
+_WRITE_BATCH_SIZE = 64 * 1024
+
+# Number of runs of a tier merged into a run of the next tier.
+_MERGE_FACTOR = 4
+
+# Number of keys in a page of a run, the unit searched by a lookup.
+_PAGE_KEYS = 256
+
+# Bits of the Bloom filter of spilled keys per key, for 2 bits set by each key.
+_FILTER_BITS_PER_KEY = 16
+
+
+def hash_key(key: bytes) -> bytes:
+    """Return the compact hashed key of a key, for use with SpillingKeySet."""
+    return hashlib.blake2b(key, digest_size=KEY_SIZE).digest()
+
+
+class SpillingKeySet:
+    """A set of hashed keys that spills to disk once it exceeds a memory budget.
+
+    Keys are held in memory until they take about memory_budget bytes.  They are
+    then sorted and written to a sorted run of keys in a temporary file, which is
+    memory-mapped.  Keys are KEY_SIZE bytes long, such as those returned by
+    hash_key, so runs have fixed-size records.
+
+    Runs are merged in tiers: once _MERGE_FACTOR runs of the same tier exist, they
+    are merged into one run of the next tier, so each key is rewritten a
+    logarithmic number of times.
+
+    A Bloom filter of the spilled keys answers most lookups of new keys without
+    reading any run.  It takes 2 bytes per key it is sized for, on top of
+    memory_budget.  It is first sized for four times the keys held in memory, and
+    doubles in size, without reading the runs again, whenever the spilled keys
+    outgrow it, so it then takes 2 to 4 bytes per spilled key.  Other lookups
+    locate a page of each run from keys sampled in memory, and search it with a
+    single byte search.
+
+    Attributes:
+        memory_budget: The approximate memory the keys held in memory may take.
+        directory: The directory of the temporary files.  Defaults to the system
+                   temporary directory.
+    """
+
+    def __init__(self, memory_budget: int, directory: Optional[str] = None):
+        if memory_budget < 1:
+            raise ValueError("memory_budget must be at least 1")
+        self.memory_budget = memory_budget
+        self.directory = directory
+        self._max_keys = max(1, memory_budget // _KEY_MEMORY)
+        self._keys: Set[bytes] = set()
+        # Runs are ordered by tier, highest first.
+        self._runs: List[_SortedRun] = []
+        self._filter: Optional[_KeyFilter] = None
+
+    def add(self, key: bytes) -> bool:
+        """Add a key.
+
+        Returns:
+            Whether the key was not in the set yet.
+        """
+        if key in self._keys:
+            return False
+        if self._filter is not None and key in self._filter:
+            for run in self._runs:
+                if key in run:
+                    return False
+        self._keys.add(key)
+        if len(self._keys) >= self._max_keys:
+            self._spill()
+        return True
+
+    def __len__(self) -> int:
+        return len(self._keys) + sum(len(run) for run in self._runs)
+
+    @property
+    def spilled(self) -> bool:
+        """Whether keys have been spilled to disk."""
+        return bool(self._runs)
+
+    def close(self) -> None:
+        """Release the memory and temporary files of the set."""
+        self._keys.clear()
+        self._filter = None
+        runs, self._runs = self._runs, []
+        for run in runs:
+            run.close()
+
+    def __enter__(self) -> "SpillingKeySet":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _spill(self) -> None:
+        keys = sorted(self._keys)
+        self._runs.append(_write_run([keys], 0, self.directory))
+        spilled = sum(len(run) for run in self._runs)
+        if self._filter is None:
+            self._filter = _KeyFilter(4 * self._max_keys)
+        while spilled > self._filter.capacity:
+            self._filter.grow()
+        self._filter.update(keys)
+        self._keys.clear()
+
+        runs = self._runs
+        while len(runs) >= _MERGE_FACTOR and (
+            runs[-_MERGE_FACTOR].tier == runs[-1].tier
+        ):
+            merged = runs[-_MERGE_FACTOR:]
+            run = _write_run(_merge(merged), merged[0].tier + 1, self.directory)
+            runs[-_MERGE_FACTOR:] = [run]
+            for old in merged:
+                old.close()
+
+
+class _KeyFilter:
+    """A Bloom filter of hashed keys.
+
+    Keys are uniformly distributed hashes, so the positions of their bits are taken
+    from the keys themselves, modulo the size of the filter.
+
+    Attributes:
+        capacity: The number of keys the filter is sized for.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._size = capacity * _FILTER_BITS_PER_KEY
+        self._bits = bytearray(self._size // 8)
+
+    def grow(self) -> None:
+        """Double the capacity of the filter, keeping the keys it holds.
+
+        A bit at position p of the filter is at position p or p plus its size once
+        the size is doubled, so the filter is repeated to set both.  The keys held
+        then take twice as many bits, so more lookups pass the grown filter.
+        """
+        self.capacity *= 2
+        self._size *= 2
+        self._bits *= 2
+
+    def update(self, keys: Iterable[bytes]) -> None:
+        bits = self._bits
+        size = self._size
+        for key in keys:
+            value = int.from_bytes(key, "little")
+            first = value % size
+            second = (value >> 64) % size
+            bits[first >> 3] |= 1 << (first & 7)
+            bits[second >> 3] |= 1 << (second & 7)
+
+    def __contains__(self, key: bytes) -> bool:
+        value = int.from_bytes(key, "little")
+        first = value % self._size
+        if not self._bits[first >> 3] & (1 << (first & 7)):
+            return False
+        second = (value >> 64) % self._size
+        return bool(self._bits[second >> 3] & (1 << (second & 7)))
+
+
+def _merge(runs: List["_SortedRun"]) -> Iterator[List[bytes]]:
+    """Merge runs of distinct keys into sorted batches of keys.
+
+    A page of each run is buffered.  The keys up to the smallest last key of the
+    buffers precede every key not buffered yet, so they are sorted and returned,
+    which empties at least one buffer.
+    """
+    pages = [run.pages() for run in runs]
+    buffers: List[List[bytes]] = [[] for _ in runs]
+    while True:
+        for i, buffer in enumerate(buffers):
+            if not buffer:
+                buffers[i] = next(pages[i], [])
+        bound = min((buffer[-1] for buffer in buffers if buffer), default=None)
+        if bound is None:
+            return
+        batch: List[bytes] = []
+        for i, buffer in enumerate(buffers):
+            end = bisect.bisect_right(buffer, bound)
+            batch += buffer[:end]
+            buffers[i] = buffer[end:]
+        batch.sort()
+        yield batch
+
+
+def _write_run(
+    batches: Iterable[List[bytes]], tier: int, directory: Optional[str]
+) -> "_SortedRun":
+    """Write sorted batches of sorted keys to a new run in a temporary file."""
+    file = tempfile.TemporaryFile(dir=directory)
+    try:
+        for batch in batches:
+            for start in range(0, len(batch), _WRITE_BATCH_SIZE):
+                file.write(b"".join(batch[start : start + _WRITE_BATCH_SIZE]))
+        file.flush()
+        return _SortedRun(file, tier)
+    except BaseException:
+        file.close()
+        raise
+
+
+class _SortedRun:
+    """A memory-mapped file of sorted fixed-size keys.
+
+    The first key of every page of _PAGE_KEYS keys is held in memory, so a lookup
+    bisects them and then searches a single page.
+    """
+
+    def __init__(self, file, tier: int):
+        self.tier = tier
+        self._file = file
+        self._mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._length = len(self._mapping) // KEY_SIZE
+        self._fences = [
+            self._mapping[offset : offset + KEY_SIZE]
+            for offset in range(0, len(self._mapping), _PAGE_KEYS * KEY_SIZE)
+        ]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def pages(self) -> Iterator[List[bytes]]:
+        """Iterate over the keys of the run, a page at a time."""
+        page_size = _PAGE_KEYS * KEY_SIZE
+        for offset in range(0, len(self._mapping), page_size):
+            page = self._mapping[offset : offset + page_size]
+            yield [page[i : i + KEY_SIZE] for i in range(0, len(page), KEY_SIZE)]
+
+    def __contains__(self, key: bytes) -> bool:
+        page = bisect.bisect_right(self._fences, key) - 1
+        if page < 0:
+            return False
+        offset = page * _PAGE_KEYS * KEY_SIZE
+        keys = self._mapping[offset : offset + _PAGE_KEYS * KEY_SIZE]
+        index = keys.find(key)
+        # Matches spanning two keys are skipped.
+        while index != -1 and index % KEY_SIZE:
+            index = keys.find(key, index + 1)
+        return index != -1
+
+    def close(self) -> None:
+        self._mapping.close()
+        self._file.close()
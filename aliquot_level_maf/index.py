@@ -0,0 +1,342 @@
+import io
+import json
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple, Optional
+
+from aliquot_level_maf.compression import BgzfReader, BgzfWriter, read_gzip_members
+
+_REGION_INDEX_MAGIC = "#aliquot-level-maf region index 1"
+
+_ALIQUOT_INDEX_MAGIC = "#aliquot-level-maf aliquot index 1"
+
+
+class RegionIndexEntry(NamedTuple):
+    """A run of consecutive rows on one chromosome within a BGZF-compressed MAF.
+
+    Attributes:
+        chromosome: The chromosome of every row in the run.
+        start: The smallest Start_Position of the rows.
+        end: The largest End_Position of the rows.
+        begin_offset: The virtual offset of the first row.
+        end_offset: The virtual offset just after the last row.
+    """
+
+    chromosome: str
+    start: int
+    end: int
+    begin_offset: int
+    end_offset: int
+
+
+class RegionIndex(NamedTuple):
+    """An index from genomic regions to rows of a BGZF-compressed MAF.
+
+    Attributes:
+        chromosome_column: The position of the Chromosome column.
+        start_column: The position of the Start_Position column.
+        end_column: The position of the End_Position column.
+        entries: The runs of rows, in file order.
+    """
+
+    chromosome_column: int
+    start_column: int
+    end_column: int
+    entries: List[RegionIndexEntry]
+
+    def query(self, chromosome: str, start: int, end: int) -> List[RegionIndexEntry]:
+        """Return the runs that may contain rows overlapping a region."""
+        return [
+            entry
+            for entry in self.entries
+            if entry.chromosome == chromosome
+            and entry.start <= end
+            and entry.end >= start
+        ]
+
+    def write(self, output: BinaryIO) -> None:
+        """Write the index to a file-like object as tab-separated text."""
+        lines = [
+            f"{_REGION_INDEX_MAGIC}\n",
+            f"#columns\t{self.chromosome_column}\t{self.start_column}\t"
+            f"{self.end_column}\n",
+        ]
+        lines += ["\t".join(str(value) for value in e) + "\n" for e in self.entries]
+        output.write("".join(lines).encode())
+
+    @classmethod
+    def read(cls, index_file: BinaryIO) -> "RegionIndex":
+        """Read an index written by RegionIndex.write."""
+        lines = index_file.read().decode().splitlines()
+        if not lines or lines[0] != _REGION_INDEX_MAGIC:
+            raise ValueError("Not a region index")
+        columns = [int(value) for value in lines[1].split("\t")[1:]]
+        entries = []
+        for line in lines[2:]:
+            chromosome, *values = line.split("\t")
+            start, end, begin_offset, end_offset = (int(value) for value in values)
+            entries.append(
+                RegionIndexEntry(chromosome, start, end, begin_offset, end_offset)
+            )
+        return cls(*columns, entries=entries)
+
+
+def read_region(
+    maf: BinaryIO, index: RegionIndex, chromosome: str, start: int, end: int
+) -> Iterator[str]:
+    """Read the rows of a BGZF-compressed MAF overlapping a genomic region.
+
+    The MAF must have been written by aggregate_mafs with a region index.  Only the
+    blocks that may contain matching rows are read and decompressed.
+
+    Args:
+        maf: A seekable file-like object with the BGZF-compressed MAF.
+        index: The region index of the MAF.
+        chromosome: The chromosome of the region.
+        start: The first position of the region.
+        end: The last position of the region, inclusive.
+
+    Returns:
+        The rows overlapping the region, without line terminators, in file order.
+    """
+    reader = BgzfReader(maf)
+    chromosome_bytes = chromosome.encode()
+    max_split = max(index.chromosome_column, index.start_column, index.end_column) + 1
+    position = None
+    for entry in index.query(chromosome, start, end):
+        if position is None or position != entry.begin_offset:
+            reader.seek_virtual(entry.begin_offset)
+        while reader.tell_virtual() < entry.end_offset:
+            line = reader.readline()
+            fields = line.split(b"\t", max_split)
+            if (
+                fields[index.chromosome_column] == chromosome_bytes
+                and int(fields[index.start_column]) <= end
+                and int(fields[index.end_column]) >= start
+            ):
+                yield line.rstrip(b"\r\n").decode()
+        position = entry.end_offset
+
+
+class RegionIndexingWriter(io.BufferedIOBase):
+    """A write-only BGZF stream of a MAF that builds a region index of its rows.
+
+    Pragmas and the column headers are written without being indexed.  The column
+    headers must contain the Chromosome, Start_Position and End_Position columns.
+    Rows whose coordinates cannot be parsed are written without being indexed.
+
+    Closing the writer closes the BGZF stream but not the underlying file-like
+    object.  The index is then available as the index attribute.
+
+    Attributes:
+        bgzf: The BGZF stream the MAF is written to.
+        index: The region index, once the writer is closed.
+    """
+
+    def __init__(self, bgzf: BgzfWriter):
+        self.bgzf = bgzf
+        self.index: Optional[RegionIndex] = None
+        self._entries: List[RegionIndexEntry] = []
+        self._partial = b""
+        self._columns: Optional[List[int]] = None
+        self._max_split = 0
+        self._run: Optional[list] = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        data = bytes(data)
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._write_line(line + b"\n")
+        return len(data)
+
+    @property
+    def compressed_size(self) -> int:
+        return self.bgzf.compressed_size
+
+    @property
+    def uncompressed_size(self) -> int:
+        return self.bgzf.uncompressed_size + len(self._partial)
+
+    def end_member(self) -> None:
+        """End the current BGZF block, so that the following data starts a new one."""
+        self._write_partial()
+        self._end_run()
+        self.bgzf.end_member()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._write_partial()
+            self._end_run()
+            self.bgzf.close()
+            # A MAF without column headers has no rows, so any columns will do.
+            columns = self._columns or [0, 0, 0]
+            self.index = RegionIndex(*columns, entries=self._entries)
+        finally:
+            super().close()
+
+    def _write_partial(self) -> None:
+        if self._partial:
+            self._write_line(self._partial)
+            self._partial = b""
+
+    def _write_line(self, line: bytes) -> None:
+        offset = self.bgzf.tell_virtual()
+        self.bgzf.write(line)
+        if self._columns is None:
+            if not line.startswith(b"#"):
+                self._set_columns(line.rstrip(b"\r\n").decode().split("\t"))
+            return
+
+        chromosome_column, start_column, end_column = self._columns
+        fields = line.split(b"\t", self._max_split)
+        try:
+            chromosome = fields[chromosome_column].decode()
+            start = int(fields[start_column])
+            end = int(fields[end_column])
+        except (IndexError, ValueError):
+            self._end_run()
+            return
+
+        run = self._run
+        # Runs do not span blocks, so that a query only reads the blocks it needs.
+        if run is None or run[0] != chromosome or run[3] >> 16 != offset >> 16:
+            self._end_run()
+            self._run = [chromosome, start, end, offset, self.bgzf.tell_virtual()]
+            return
+        run[1] = min(run[1], start)
+        run[2] = max(run[2], end)
+        run[4] = self.bgzf.tell_virtual()
+
+    def _set_columns(self, column_headers: List[str]) -> None:
+        try:
+            self._columns = [
+                column_headers.index(column)
+                for column in ("Chromosome", "Start_Position", "End_Position")
+            ]
+        except ValueError:
+            raise ValueError(
+                "Chromosome, Start_Position and End_Position columns are required "
+                "to build a region index"
+            )
+        self._max_split = max(self._columns) + 1
+
+    def _end_run(self) -> None:
+        if self._run is not None:
+            self._entries.append(RegionIndexEntry(*self._run))
+            self._run = None
+
+
+class AliquotIndexEntry(NamedTuple):
+    """The location of part of a MAF stored in its own gzip members.
+
+    Offsets are relative to the position of the output when aggregation started.
+
+    Attributes:
+        tumor_aliquot_submitter_id: The submitter id of the tumor aliquot whose rows
+                                    are stored, or an empty string for the headers.
+        compressed_offset: The offset of the first gzip member.
+        compressed_size: The total size of the gzip members.
+        uncompressed_offset: The offset of the first row in the decompressed MAF.
+        uncompressed_size: The size of the decompressed rows.
+        row_count: The number of rows.
+    """
+
+    tumor_aliquot_submitter_id: str
+    compressed_offset: int
+    compressed_size: int
+    uncompressed_offset: int
+    uncompressed_size: int
+    row_count: int
+
+
+class AliquotIndex(NamedTuple):
+    """An index from tumor aliquots to their rows in an aggregated MAF.
+
+    Attributes:
+        header: The location of the pragmas and column headers, or None if the MAF
+                has no headers.
+        entries: The location of the rows of each aliquot, in file order.  Inputs
+                 that were skipped, because they were empty or inaccessible, have no
+                 entry.
+        options: The options of aggregate_mafs that determined the rows of the MAF,
+                 as JSON values, so that update_aggregated_maf can apply them to the
+                 MAFs it adds.  None if they are unknown.
+    """
+
+    header: Optional[AliquotIndexEntry]
+    entries: List[AliquotIndexEntry]
+    options: Optional[Dict[str, Any]] = None
+
+    def get(self, tumor_aliquot_submitter_id: str) -> Optional[AliquotIndexEntry]:
+        """Return the entry of an aliquot, or None if it has no rows in the MAF."""
+        for entry in self.entries:
+            if entry.tumor_aliquot_submitter_id == tumor_aliquot_submitter_id:
+                return entry
+        return None
+
+    def write(self, output: BinaryIO) -> None:
+        """Write the index to a file-like object as tab-separated text."""
+        lines = [f"{_ALIQUOT_INDEX_MAGIC}\n"]
+        if self.options is not None:
+            lines.append(f"#options\t{json.dumps(self.options)}\n")
+        if self.header is not None:
+            values = [str(value) for value in self.header[1:]]
+            lines.append("\t".join(["#header"] + values) + "\n")
+        lines += ["\t".join(str(value) for value in e) + "\n" for e in self.entries]
+        output.write("".join(lines).encode())
+
+    @classmethod
+    def read(cls, index_file: BinaryIO) -> "AliquotIndex":
+        """Read an index written by AliquotIndex.write."""
+        lines = index_file.read().decode().splitlines()
+        if not lines or lines[0] != _ALIQUOT_INDEX_MAGIC:
+            raise ValueError("Not an aliquot index")
+        header = None
+        entries = []
+        options = None
+        for line in lines[1:]:
+            if line.startswith("#options\t"):
+                options = json.loads(line[len("#options\t") :])
+                continue
+            submitter_id, *values = line.split("\t")
+            entry = AliquotIndexEntry(submitter_id, *(int(value) for value in values))
+            if submitter_id == "#header":
+                header = entry._replace(tumor_aliquot_submitter_id="")
+            else:
+                entries.append(entry)
+        return cls(header=header, entries=entries, options=options)
+
+
+def read_aliquot(
+    maf: BinaryIO, index: AliquotIndex, tumor_aliquot_submitter_id: str
+) -> Iterator[str]:
+    """Read the rows of one tumor aliquot from an aggregated MAF.
+
+    The MAF must have been written by aggregate_mafs with an aliquot index.  Only the
+    gzip members holding the rows of the aliquot are read and decompressed.
+
+    Args:
+        maf: A seekable file-like object with the aggregated MAF.
+        index: The aliquot index of the MAF.
+        tumor_aliquot_submitter_id: The submitter id of the tumor aliquot.
+
+    Returns:
+        The rows of the aliquot, without line terminators, in file order.
+    """
+    entry = index.get(tumor_aliquot_submitter_id)
+    if entry is None:
+        raise KeyError(tumor_aliquot_submitter_id)
+    partial = b""
+    for data in read_gzip_members(maf, entry.compressed_offset, entry.compressed_size):
+        lines = (partial + data).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line.rstrip(b"\r").decode()
+    if partial:
+        yield partial.rstrip(b"\r").decode()
@@ -0,0 +1,352 @@
+import contextlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from aliquot_level_maf.aggregation import (
+    AggregationStats,
+    AliquotLevelMaf,
+    FileStats,
+    aggregate_mafs,
+    has_headers,
+)
+from aliquot_level_maf.selection import (
+    PrimaryAliquot,
+    PrimaryAliquotSelectionCriterion,
+    select_primary_aliquots,
+    select_ranked_aliquots,
+)
+
+# The default maximum number of inputs open at the same time.
+DEFAULT_MAX_OPEN_FILES = 64
+
+
+class LazyAliquotLevelMaf(NamedTuple):
+    """An aliquot-level MAF file that is only opened if it is read.
+
+    Attributes:
+        open: A function returning a new file-like object with the gzipped content of
+              the MAF.  The file is closed once it has been read.
+        tumor_aliquot_submitter_id: The submitter id of the tumor aliquot.
+    """
+
+    open: Callable[[], BinaryIO]
+    tumor_aliquot_submitter_id: str
+
+
+class PrimaryAliquotAggregation(NamedTuple):
+    """The result of aggregate_primary_aliquots.
+
+    Attributes:
+        primary_aliquots: A dictionary of entity ids to primary aliquot.
+        stats: Statistics of the aggregation of the primary aliquots.
+    """
+
+    primary_aliquots: Dict[str, PrimaryAliquot]
+    stats: AggregationStats
+
+
+def aggregate_primary_aliquots(
+    criteria: List[PrimaryAliquotSelectionCriterion],
+    mafs: Mapping[str, LazyAliquotLevelMaf],
+    output: BinaryIO,
+    max_open_files: int = DEFAULT_MAX_OPEN_FILES,
+    fallbacks: int = 0,
+    **kwargs: Any,
+) -> PrimaryAliquotAggregation:
+    """Select the primary aliquot of each entity and aggregate their MAF files.
+
+    Selection only needs the criteria, so it runs first and only the MAFs of the
+    primary aliquots are opened.  The MAFs of the other candidates are never opened.
+    The selected MAFs are aggregated in the order their ids first appear in criteria,
+    and each is opened when aggregate_mafs first reads it and closed as soon as it
+    has been read.
+
+    At most max_open_files MAFs are open at the same time.  Inputs are read one at a
+    time by default, and read_ahead, which defaults to twice decompression_threads,
+    is lowered to max_open_files.  Since preflight, sort_by_coordinate and
+    union_columns open every input at once, they fail if more than max_open_files
+    MAFs are selected.
+
+    aggregate_mafs skips MAFs without headers, because they are empty or not
+    accessible.  If fallbacks is given, selection also ranks the next fallbacks
+    candidates of each entity, and the headers of the MAF of each primary aliquot
+    are read before aggregation.  If it has none, the next candidate whose MAF has
+    headers is selected instead and returned as the primary aliquot.  If no
+    candidate has headers, the primary aliquot is kept and skipped.  The headers of
+    up to max_open_files entities are read concurrently.  Up to max_open_files - 1
+    of the MAFs whose headers were read are kept open to be aggregated, so they are
+    not opened again.  They are rewound, or if they are not seekable, the bytes read
+    from them are kept to be read again.
+
+    Args:
+        criteria: A list of selection criteria for each aliquot-level MAF.
+        mafs: A mapping from the ids of criteria to their lazily opened MAFs.  Only
+              the ids of selected criteria need to be present.
+        output: A file-like object to write the aggregated MAF file.
+        max_open_files: The maximum number of MAFs open at the same time.
+        fallbacks: The number of candidates tried after the primary aliquot of an
+                   entity if its MAF has no headers.
+        kwargs: Options passed to aggregate_mafs.
+
+    Returns:
+        The primary aliquots and the statistics of their aggregation.
+    """
+    if max_open_files < 1:
+        raise ValueError("max_open_files must be at least 1")
+    if fallbacks < 0:
+        raise ValueError("fallbacks must not be negative")
+
+    probed: Dict[str, _LazyFile] = dict()
+    if fallbacks:
+        primary_aliquots, probed = _select_with_headers(
+            criteria, mafs, fallbacks, max_open_files
+        )
+    else:
+        primary_aliquots = select_primary_aliquots(criteria)
+    try:
+        return _aggregate_selected(
+            criteria, mafs, output, max_open_files, primary_aliquots, probed, kwargs
+        )
+    finally:
+        for file in probed.values():
+            file.close()
+
+
+def _aggregate_selected(
+    criteria: List[PrimaryAliquotSelectionCriterion],
+    mafs: Mapping[str, LazyAliquotLevelMaf],
+    output: BinaryIO,
+    max_open_files: int,
+    primary_aliquots: Dict[str, PrimaryAliquot],
+    probed: Dict[str, "_LazyFile"],
+    kwargs: Dict[str, Any],
+) -> PrimaryAliquotAggregation:
+    """Aggregate the MAFs of the selected aliquots, reusing the probed files."""
+    selected = {primary.id for primary in primary_aliquots.values()}
+    # Criteria of several samples or entities share an id, so ids are deduplicated.
+    ids = list(dict.fromkeys(c.id for c in criteria if c.id in selected))
+    missing = [id_ for id_ in ids if id_ not in mafs]
+    if missing:
+        raise ValueError(f"No MAF was given for the selected ids: {missing}")
+
+    opens_all = any(
+        kwargs.get(option)
+        for option in ("preflight", "sort_by_coordinate", "union_columns")
+    )
+    if opens_all and len(ids) > max_open_files:
+        raise ValueError(
+            f"{len(ids)} MAFs would be open at once, more than max_open_files"
+        )
+    threads = kwargs.get("decompression_threads", 0)
+    if threads:
+        read_ahead = kwargs.get("read_ahead")
+        if read_ahead is None:
+            read_ahead = 2 * threads
+        # Probed files stay open until they are read.
+        kwargs["read_ahead"] = min(read_ahead, max_open_files - len(probed))
+
+    files = [probed.get(id_) or _LazyFile(mafs[id_].open) for id_ in ids]
+    on_file: Optional[Callable[[FileStats], None]] = kwargs.pop("on_file", None)
+    handled = iter(files)
+
+    def close_handled(file_stats: FileStats) -> None:
+        # Files are handled in order, so skipped inputs are closed here.
+        next(handled).close()
+        if on_file is not None:
+            on_file(file_stats)
+
+    try:
+        stats = aggregate_mafs(
+            [
+                AliquotLevelMaf(file, mafs[id_].tumor_aliquot_submitter_id)
+                for file, id_ in zip(files, ids)
+            ],
+            output,
+            on_file=close_handled,
+            **kwargs,
+        )
+    finally:
+        for file in files:
+            file.close()
+    return PrimaryAliquotAggregation(primary_aliquots=primary_aliquots, stats=stats)
+
+
+def _select_with_headers(
+    criteria: List[PrimaryAliquotSelectionCriterion],
+    mafs: Mapping[str, LazyAliquotLevelMaf],
+    fallbacks: int,
+    max_open_files: int,
+) -> Tuple[Dict[str, PrimaryAliquot], Dict[str, "_LazyFile"]]:
+    """Select the best-ranked aliquot of each entity whose MAF has headers.
+
+    The candidates of each entity are probed in order, one at a time, on a thread
+    pool of max_open_files threads.  The files of MAFs with headers are kept open
+    while fewer than max_open_files - 1 are, so that probes can still open one, and
+    returned by id.  At most max_open_files MAFs are open at once.
+    """
+    ranked = select_ranked_aliquots(criteria, fallbacks + 1)
+    # Probes of an id shared by several entities may race, which only repeats them.
+    probed: Dict[str, bool] = dict()
+    kept: Dict[str, _LazyFile] = dict()
+    lock = threading.Lock()
+    slots = threading.Semaphore(max_open_files)
+
+    def probe(id_: str) -> bool:
+        if id_ not in probed:
+            if id_ not in mafs:
+                raise ValueError(f"No MAF was given for the selected ids: {[id_]}")
+            with contextlib.ExitStack() as stack:
+                slots.acquire()
+                stack.callback(slots.release)
+                file = stack.enter_context(contextlib.closing(mafs[id_].open()))
+                found, reread = _probe_headers(mafs[id_], file)
+                with lock:
+                    if found and id_ not in kept and len(kept) + 1 < max_open_files:
+                        # The file keeps its slot, which is never released.
+                        kept[id_] = reread
+                        stack.pop_all()
+            probed[id_] = found
+        return probed[id_]
+
+    def select(candidates: List[PrimaryAliquot]) -> PrimaryAliquot:
+        return next((c for c in candidates if probe(c.id)), candidates[0])
+
+    if not ranked:
+        return dict(), kept
+    try:
+        with ThreadPoolExecutor(
+            max_workers=min(max_open_files, len(ranked))
+        ) as executor:
+            selected = dict(zip(ranked, executor.map(select, ranked.values())))
+    except BaseException:
+        for file in kept.values():
+            file.close()
+        raise
+    return selected, kept
+
+
+def _probe_headers(
+    maf: LazyAliquotLevelMaf, file: BinaryIO
+) -> Tuple[bool, "_LazyFile"]:
+    """Return whether an opened MAF has headers, and a file reading it again.
+
+    A seekable file is rewound.  The bytes read from another file are recorded, to
+    be read again before the rest of the file.
+    """
+    submitter_id = maf.tumor_aliquot_submitter_id
+    if file.seekable():
+        start = file.tell()
+        found = has_headers(AliquotLevelMaf(file, submitter_id))
+        file.seek(start)
+        return found, _LazyFile(maf.open, file=file)
+    recording = _RecordingReader(file)
+    found = has_headers(AliquotLevelMaf(recording, submitter_id))
+    return found, _LazyFile(maf.open, file=file, prefix=bytes(recording.recorded))
+
+
+class _RecordingReader(io.RawIOBase):
+    """A read-only file recording the bytes read from another file."""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.recorded = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.file.read(len(buffer))
+        buffer[: len(data)] = data
+        self.recorded += data
+        return len(data)
+
+
+class _LazyFile(io.RawIOBase):
+    """A read-only file opened on first use and closed once it is read to the end.
+
+    A file that is already open can be given instead, with the bytes already read
+    from it, which are read first.
+    """
+
+    def __init__(
+        self,
+        open_file: Callable[[], BinaryIO],
+        file: Optional[BinaryIO] = None,
+        prefix: bytes = b"",
+    ):
+        self._open_file = open_file
+        self._file = file
+        self._prefix = prefix
+        self._exhausted = False
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        file = self._opened()
+        return file is not None and file.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        file = self._opened()
+        if file is None:
+            raise io.UnsupportedOperation("seek of a file that was read to the end")
+        return file.seek(offset, whence)
+
+    def tell(self) -> int:
+        file = self._opened()
+        if file is None:
+            raise io.UnsupportedOperation("tell of a file that was read to the end")
+        return file.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        file = self._opened()
+        if self._prefix:
+            if size is None or size < 0:
+                data, self._prefix = self._prefix, b""
+                return data + self.read()
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+            return data
+        if file is None:
+            return b""
+        data = file.read(size)
+        if size is None or size < 0 or (not data and size != 0):
+            self._release()
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        self._release()
+        self._exhausted = True
+        super().close()
+
+    def _opened(self) -> Optional[BinaryIO]:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self._file is None and not self._exhausted:
+            self._file = self._open_file()
+        return self._file
+
+    def _release(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._exhausted = True
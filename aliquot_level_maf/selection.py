@@ -1,7 +1,9 @@
 import datetime
+import heapq
+import itertools
 import sys
 from collections import defaultdict
-from typing import Dict, List, NamedTuple
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
 
 # This is the order that sample types should be selected.
 # Lowest rank wins.
@@ -21,6 +23,9 @@ _SAMPLE_TYPE_RANK: Dict[str, int] = {
 # it at the bottom of the ranking.
 _MAX_SORT_RANK = sys.maxsize
 
+# Candidates are ordered by sample type rank, then MAF creation date, then id.
+_SelectionKey = Tuple[int, datetime.datetime, str]
+
 
 class SampleCriterion(NamedTuple):
     """Attributes describing a sample for primary-aliquot selection.
@@ -98,6 +103,251 @@ def select_primary_aliquots(
     return {entity: _perform_selection(cs) for entity, cs in criteria_by_entity.items()}
 
 
+def select_primary_aliquots_streaming(
+    criteria: Iterable[PrimaryAliquotSelectionCriterion],
+) -> Dict[str, PrimaryAliquot]:
+    """Select the primary-aliquot for each entity in a single pass.
+
+    This gives the same results as select_primary_aliquots, but accepts any iterable
+    of criteria, such as a generator over database rows.  Only the best candidate
+    seen so far is kept for each entity, so memory grows with the number of
+    entities rather than with the number of criteria.
+
+    Args:
+        criteria: An iterable of selection criteria for each aliquot-level MAF
+
+    Returns:
+        A dictionary of entity ids to primary aliquot
+    """
+    best: Dict[str, Tuple[_SelectionKey, str]] = dict()
+    for criterion in criteria:
+        for sample in criterion.samples:
+            key = (
+                _get_sample_rank(sample),
+                criterion.maf_creation_date,
+                criterion.id,
+            )
+            current = best.get(criterion.entity_id)
+            # Strictly less than, so that the first of equal candidates wins.
+            if current is None or key < current[0]:
+                best[criterion.entity_id] = (key, sample.id)
+
+    return {
+        entity: PrimaryAliquot(id=key[2], sample_id=sample_id)
+        for entity, (key, sample_id) in best.items()
+    }
+
+
+def select_ranked_aliquots(
+    criteria: Iterable[PrimaryAliquotSelectionCriterion], k: int
+) -> Dict[str, List[PrimaryAliquot]]:
+    """Select the k best-ranked aliquots for each entity in a single pass.
+
+    Aliquots are ranked as in select_primary_aliquots, so the first aliquot of each
+    entity is its primary aliquot, and the following ones are the candidates that
+    would be selected if the aliquots ranked before them were excluded.  Each
+    aliquot is ranked by its best sample, and criteria sharing an id are ranked as
+    a single aliquot.  Only the k best candidates seen so far are kept for each
+    entity, in a bounded heap.
+
+    Args:
+        criteria: An iterable of selection criteria for each aliquot-level MAF
+        k: The maximum number of aliquots selected for each entity.
+
+    Returns:
+        A dictionary of entity ids to their best aliquots, best first
+    """
+    if k < 1:
+        raise ValueError("k must be at least 1")
+    heaps: Dict[str, List[_RankedAliquot]] = dict()
+    # The aliquots in the heap of each entity, by id.
+    kept: Dict[str, Dict[str, _RankedAliquot]] = dict()
+    for order, criterion in enumerate(criteria):
+        best: Optional[Tuple[_SelectionKey, str]] = None
+        for sample in criterion.samples:
+            key = (
+                _get_sample_rank(sample),
+                criterion.maf_creation_date,
+                criterion.id,
+            )
+            if best is None or key < best[0]:
+                best = (key, sample.id)
+        if best is None:
+            continue
+        ranked = _RankedAliquot(best[0], order, best[1])
+        heap = heaps.setdefault(criterion.entity_id, [])
+        ids = kept.setdefault(criterion.entity_id, dict())
+        current = ids.get(criterion.id)
+        if current is not None:
+            if ranked.rank() < current.rank():
+                heap[heap.index(current)] = ranked
+                heapq.heapify(heap)
+                ids[criterion.id] = ranked
+        elif len(heap) < k:
+            heapq.heappush(heap, ranked)
+            ids[criterion.id] = ranked
+        elif ranked.rank() < heap[0].rank():
+            evicted = heapq.heapreplace(heap, ranked)
+            del ids[evicted.key[2]]
+            ids[criterion.id] = ranked
+
+    return {
+        entity: [
+            PrimaryAliquot(id=ranked.key[2], sample_id=ranked.sample_id)
+            for ranked in sorted(heap, key=_RankedAliquot.rank)
+        ]
+        for entity, heap in heaps.items()
+    }
+
+
+class _RankedAliquot(NamedTuple):
+    """An aliquot in the bounded heap of select_ranked_aliquots.
+
+    Comparisons are reversed, so that the worst aliquot kept is at the top of the
+    heap.
+    """
+
+    key: _SelectionKey
+    order: int
+    sample_id: str
+
+    def rank(self) -> Tuple[_SelectionKey, int]:
+        # The first of equal aliquots wins.
+        return self.key, self.order
+
+    def __lt__(self, other: Tuple) -> bool:
+        return self.rank() > other.rank()
+
+
+class PrimaryAliquotSelector:
+    """An incrementally updated primary-aliquot selection.
+
+    This gives the same results as select_primary_aliquots on the criteria added
+    and not removed, with each criterion replacing any earlier one with the same id.
+    The candidates of each entity are kept in a heap ordered by sample type rank,
+    then MAF creation date, then id, so that an update costs O(log n) in the number
+    of candidates of the affected entity.  Removed candidates are dropped from a
+    heap once they reach its top, or when they make up half of it.
+
+    Args:
+        criteria: The initial selection criteria.
+    """
+
+    def __init__(self, criteria: Iterable[PrimaryAliquotSelectionCriterion] = ()):
+        self._heaps: Dict[str, List[_Candidate]] = dict()
+        # The entity, generation and number of samples of each current criterion.
+        self._live: Dict[str, Tuple[str, int, int]] = dict()
+        self._stale: Dict[str, int] = defaultdict(int)
+        self._generations = itertools.count()
+        self._changed: Set[str] = set()
+        self._reported: Dict[str, PrimaryAliquot] = dict()
+        for criterion in criteria:
+            self.add(criterion)
+
+    def add(self, criterion: PrimaryAliquotSelectionCriterion) -> None:
+        """Add a criterion, replacing any criterion with the same id."""
+        if criterion.id in self._live:
+            self.remove(criterion.id)
+        generation = next(self._generations)
+        heap = self._heaps.setdefault(criterion.entity_id, [])
+        for index, sample in enumerate(criterion.samples):
+            key = (
+                _get_sample_rank(sample),
+                criterion.maf_creation_date,
+                criterion.id,
+            )
+            heapq.heappush(heap, _Candidate(key, generation, index, sample.id))
+        if not heap:
+            del self._heaps[criterion.entity_id]
+        self._live[criterion.id] = (
+            criterion.entity_id,
+            generation,
+            len(criterion.samples),
+        )
+        self._changed.add(criterion.entity_id)
+
+    def remove(self, criterion_id: str) -> None:
+        """Remove the criterion with the given id.
+
+        Raises:
+            KeyError: If there is no criterion with the id.
+        """
+        entity_id, _, sample_count = self._live.pop(criterion_id)
+        self._changed.add(entity_id)
+        if not sample_count:
+            return
+        self._stale[entity_id] += sample_count
+        self._prune(entity_id)
+
+    def get(self, entity_id: str) -> Optional[PrimaryAliquot]:
+        """Return the primary aliquot of an entity, or None if it has no candidates."""
+        heap = self._heaps.get(entity_id)
+        if not heap:
+            return None
+        candidate = heap[0]
+        return PrimaryAliquot(id=candidate.key[2], sample_id=candidate.sample_id)
+
+    def primary_aliquots(self) -> Dict[str, PrimaryAliquot]:
+        """Return a dictionary of entity ids to primary aliquot."""
+        return {
+            entity: PrimaryAliquot(id=heap[0].key[2], sample_id=heap[0].sample_id)
+            for entity, heap in self._heaps.items()
+        }
+
+    def changes(self) -> Dict[str, Optional[PrimaryAliquot]]:
+        """Return the entities whose primary aliquot changed since the last call.
+
+        The first call returns every entity with a primary aliquot.
+
+        Returns:
+            A dictionary of entity ids to their new primary aliquot, or to None if
+            they no longer have any candidates.
+        """
+        changes: Dict[str, Optional[PrimaryAliquot]] = dict()
+        for entity_id in self._changed:
+            primary = self.get(entity_id)
+            if primary == self._reported.get(entity_id):
+                continue
+            changes[entity_id] = primary
+            if primary is None:
+                del self._reported[entity_id]
+            else:
+                self._reported[entity_id] = primary
+        self._changed.clear()
+        return changes
+
+    def _is_live(self, candidate: "_Candidate") -> bool:
+        live = self._live.get(candidate.key[2])
+        return live is not None and live[1] == candidate.generation
+
+    def _prune(self, entity_id: str) -> None:
+        """Drop removed candidates from the top of a heap, or from all of it."""
+        heap = self._heaps[entity_id]
+        if 2 * self._stale[entity_id] >= len(heap):
+            heap[:] = [candidate for candidate in heap if self._is_live(candidate)]
+            heapq.heapify(heap)
+            del self._stale[entity_id]
+        else:
+            while heap and not self._is_live(heap[0]):
+                heapq.heappop(heap)
+                self._stale[entity_id] -= 1
+        if not heap:
+            del self._heaps[entity_id]
+
+
+class _Candidate(NamedTuple):
+    """A sample of a criterion in a PrimaryAliquotSelector heap.
+
+    Candidates are ordered by their selection key, then by the order of their
+    criterion and sample, so that the first of equal candidates wins.
+    """
+
+    key: _SelectionKey
+    generation: int
+    sample_index: int
+    sample_id: str
+
+
 def _flatten(
     criteria: List[PrimaryAliquotSelectionCriterion],
 ) -> List[PrimaryAliquotSelectionCriterion]:
@@ -146,13 +396,14 @@ def _get_sort_rank(criterion: PrimaryAliquotSelectionCriterion) -> int:
     Returns:
         An integer rank where lowest wins
     """
-    ranks = [
-        _SAMPLE_TYPE_RANK.get(sample.sample_type, _MAX_SORT_RANK)
-        for sample in criterion.samples
-    ]
+    ranks = [_get_sample_rank(sample) for sample in criterion.samples]
     return min(ranks)
 
 
+def _get_sample_rank(sample: SampleCriterion) -> int:
+    return _SAMPLE_TYPE_RANK.get(sample.sample_type, _MAX_SORT_RANK)
+
+
 def _select_by_sample_type(
     criteria: List[PrimaryAliquotSelectionCriterion],
 ) -> List[PrimaryAliquotSelectionCriterion]:
@@ -0,0 +1,114 @@
+from typing import Dict, Tuple
+
+import numpy as np
+
+from aliquot_level_maf.selection import (
+    PrimaryAliquot,
+    _MAX_SORT_RANK,
+    _SAMPLE_TYPE_RANK,
+)
+
+
+def select_primary_aliquots_vectorized(
+    criterion_ids: np.ndarray,
+    entity_ids: np.ndarray,
+    sample_ids: np.ndarray,
+    sample_types: np.ndarray,
+    maf_creation_dates: np.ndarray,
+) -> Dict[str, PrimaryAliquot]:
+    """Select the primary-aliquot for each entity from columnar criteria.
+
+    This gives the same results as select_primary_aliquots, but operates on arrays
+    with one row per sample of each PrimaryAliquotSelectionCriterion instead of on
+    a list of objects.  Any array-like accepted by numpy.asarray can be given.
+
+    This requires NumPy, which is installed with the `numpy` extra.
+
+    Args:
+        criterion_ids: The PrimaryAliquotSelectionCriterion.id of each row.
+        entity_ids: The PrimaryAliquotSelectionCriterion.entity_id of each row.
+        sample_ids: The SampleCriterion.id of each row.
+        sample_types: The SampleCriterion.sample_type of each row.
+        maf_creation_dates: The PrimaryAliquotSelectionCriterion.maf_creation_date
+                            of each row.  Any orderable values, such as datetimes,
+                            numpy.datetime64 or epoch timestamps, can be given.
+
+    Returns:
+        A dictionary of entity ids to primary aliquot
+    """
+    criterion_ids = np.asarray(criterion_ids)
+    entity_ids = np.asarray(entity_ids)
+    sample_ids = np.asarray(sample_ids)
+    if len(sample_ids) != len(entity_ids):
+        raise ValueError("All columns must have the same length")
+    rows = select_primary_aliquot_rows(
+        criterion_ids=criterion_ids,
+        entity_ids=entity_ids,
+        sample_types=sample_types,
+        maf_creation_dates=maf_creation_dates,
+    )
+    return {
+        str(entity): PrimaryAliquot(id=str(criterion_id), sample_id=str(sample_id))
+        for entity, criterion_id, sample_id in zip(
+            entity_ids[rows].tolist(),
+            criterion_ids[rows].tolist(),
+            sample_ids[rows].tolist(),
+        )
+    }
+
+
+def select_primary_aliquot_rows(
+    criterion_ids: np.ndarray,
+    entity_ids: np.ndarray,
+    sample_types: np.ndarray,
+    maf_creation_dates: np.ndarray,
+) -> np.ndarray:
+    """Select the row of the primary-aliquot for each entity from columnar criteria.
+
+    This is the columnar equivalent of select_primary_aliquots_vectorized.  The
+    arguments are the same, except that sample ids are not needed.
+
+    Returns:
+        The indices of the selected rows, one per entity, in the order in which the
+        entities first appear.
+    """
+    columns = [
+        np.asarray(column)
+        for column in (criterion_ids, entity_ids, sample_types, maf_creation_dates)
+    ]
+    if len({len(column) for column in columns}) != 1:
+        raise ValueError("All columns must have the same length")
+    criterion_ids, entity_ids, sample_types, maf_creation_dates = columns
+    if not len(entity_ids):
+        return np.empty(0, dtype=np.intp)
+
+    type_values, type_codes = _factorize(sample_types)
+    type_ranks = np.array(
+        [_SAMPLE_TYPE_RANK.get(t, _MAX_SORT_RANK) for t in type_values.tolist()],
+        dtype=np.int64,
+    )
+    ranks = type_ranks[type_codes]
+    _, date_codes = _factorize(maf_creation_dates)
+    _, id_codes = _factorize(criterion_ids)
+    _, entity_codes = _factorize(entity_ids)
+
+    # Sort by entity, then by the selection order.  The row number is the last
+    # tiebreaker so that the first of equal candidates wins, like it does in
+    # select_primary_aliquots.
+    row_numbers = np.arange(len(entity_codes))
+    order = np.lexsort((row_numbers, id_codes, date_codes, ranks, entity_codes))
+    sorted_entities = entity_codes[order]
+    is_group_start = np.empty(len(order), dtype=bool)
+    is_group_start[0] = True
+    np.not_equal(sorted_entities[1:], sorted_entities[:-1], out=is_group_start[1:])
+    winners = order[is_group_start]
+
+    # Winners are in entity code order.  Reorder them by first appearance.
+    _, first_rows = np.unique(entity_codes, return_index=True)
+    return winners[np.argsort(first_rows, kind="stable")]
+
+
+def _factorize(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode values as integer codes that sort in the same order as the values."""
+    uniques, codes = np.unique(values, return_inverse=True)
+    return uniques, codes.reshape(-1)
@@ -0,0 +1,204 @@
+"""Benchmarks for MAF aggregation and primary-aliquot selection.
+
+Run from the root of the repository:
+
+    python -m benchmarks.run [--scale N] [--repeat N] [benchmark ...]
+
+Fixtures are generated with a fixed seed into a temporary directory.  For each
+benchmark the best wall time of the repeats is reported together with the
+throughput and the peak memory traced by tracemalloc during a separate run.
+"""
+import argparse
+import contextlib
+import datetime
+import gzip
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple
+
+from aliquot_level_maf.aggregation import AliquotLevelMaf, aggregate_mafs
+from aliquot_level_maf.selection import (
+    PrimaryAliquotSelectionCriterion,
+    SampleCriterion,
+    select_primary_aliquots,
+)
+from tests.resources.generate_maf import generate_maf
+
+
+class Workload(NamedTuple):
+    """A prepared benchmark.
+
+    Attributes:
+        run: Runs the benchmarked code once.
+        size: The number of uncompressed bytes processed by one run, or 0.
+        rows: The number of rows (MAF lines or criteria) processed by one run.
+    """
+
+    run: Callable[[], None]
+    size: int
+    rows: int
+
+
+class Result(NamedTuple):
+    name: str
+    seconds: float
+    size: int
+    rows: int
+    peak_memory: int
+
+
+def _generate_mafs(
+    directory: str, files: int, rows: int, value_length: int = 10
+) -> List[str]:
+    filenames = []
+    for i in range(files):
+        filename = os.path.join(directory, f"{files}x{rows}x{value_length}_{i}.maf.gz")
+        if not os.path.exists(filename):
+            generate_maf(filename, rows, seed=i, value_length=value_length)
+        filenames.append(filename)
+    return filenames
+
+
+def _uncompressed_size(filenames: List[str]) -> int:
+    size = 0
+    for filename in filenames:
+        with gzip.open(filename, "rb") as reader:
+            while True:
+                block = reader.read(1024 * 1024)
+                if not block:
+                    break
+                size += len(block)
+    return size
+
+
+def _aggregation(filenames: List[str], rows: int, **kwargs) -> Workload:
+    def run():
+        with contextlib.ExitStack() as stack:
+            mafs = [
+                AliquotLevelMaf(
+                    file=stack.enter_context(open(filename, "rb")),
+                    tumor_aliquot_submitter_id=f"submitter_id_{i}",
+                )
+                for i, filename in enumerate(filenames)
+            ]
+            with open(os.devnull, "wb") as output:
+                aggregate_mafs(mafs, output, **kwargs)
+
+    return Workload(run=run, size=_uncompressed_size(filenames), rows=rows)
+
+
+def _selection(entities: int, aliquots_per_entity: int) -> Workload:
+    rng = random.Random(0)
+    sample_types = ["Primary Tumor", "Metastatic", "Recurrent Tumor", "Unknown"]
+    criteria = [
+        PrimaryAliquotSelectionCriterion(
+            id=f"aliquot_{entity}_{i}",
+            samples=[
+                SampleCriterion(
+                    id=f"sample_{entity}_{i}", sample_type=rng.choice(sample_types)
+                ),
+                SampleCriterion(
+                    id=f"normal_{entity}_{i}", sample_type="Blood Derived Normal"
+                ),
+            ],
+            entity_id=f"case_{entity}",
+            maf_creation_date=datetime.datetime(2020, 1, rng.randint(1, 28)),
+        )
+        for entity in range(entities)
+        for i in range(aliquots_per_entity)
+    ]
+    return Workload(
+        run=lambda: select_primary_aliquots(criteria), size=0, rows=len(criteria)
+    )
+
+
+def _benchmarks(directory: str, scale: int) -> Dict[str, Callable[[], Workload]]:
+    def aggregation(files: int, rows: int, value_length: int = 10, **kwargs):
+        return lambda: _aggregation(
+            _generate_mafs(directory, files, rows, value_length),
+            rows=files * rows,
+            **kwargs,
+        )
+
+    threads = os.cpu_count() or 1
+    return {
+        "aggregate_many_files": aggregation(200 * scale, 100),
+        "aggregate_many_rows": aggregation(4, 25_000 * scale),
+        "aggregate_wide_rows": aggregation(4, 2_500 * scale, value_length=100),
+        "aggregate_many_rows_threaded": aggregation(
+            4,
+            25_000 * scale,
+            decompression_threads=threads,
+            compression_threads=threads,
+        ),
+        "select_many_entities": lambda: _selection(100_000 * scale, 2),
+        "select_many_aliquots_per_entity": lambda: _selection(10, 20_000 * scale),
+    }
+
+
+def _measure(name: str, workload: Workload, repeat: int) -> Result:
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        workload.run()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        workload.run()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return Result(
+        name=name,
+        seconds=seconds,
+        size=workload.size,
+        rows=workload.rows,
+        peak_memory=peak_memory,
+    )
+
+
+def _report(result: Result) -> str:
+    throughput = (
+        f"{result.size / result.seconds / 1e6:9.1f} MB/s" if result.size else ""
+    )
+    return (
+        f"{result.name:<36} {result.seconds:8.3f} s {throughput:>12} "
+        f"{result.rows / result.seconds:12,.0f} rows/s "
+        f"{result.peak_memory / 1e6:9.1f} MB peak"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "benchmarks", nargs="*", help="Names of the benchmarks to run.  Default: all"
+    )
+    parser.add_argument(
+        "--scale", type=int, default=1, help="Multiplier for the size of the inputs"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of timed runs per benchmark"
+    )
+    parser.add_argument(
+        "--fixtures",
+        help="Directory to cache generated fixtures in.  Default: a temporary one",
+    )
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        directory = args.fixtures or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(directory, exist_ok=True)
+        benchmarks = _benchmarks(directory, args.scale)
+        for name in args.benchmarks or benchmarks:
+            if name not in benchmarks:
+                parser.error(f"unknown benchmark {name}")
+            print(_report(_measure(name, benchmarks[name](), args.repeat)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
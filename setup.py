@@ -7,4 +7,5 @@ setup(
     package_data={},
     scripts=[],
     install_requires=[],
+    extras_require={"numpy": ["numpy>=1.16"]},
 )
@@ -0,0 +1,56 @@
+import io
+import os
+from typing import Callable, List, NamedTuple, Union
+
+import pytest
+
+from aliquot_level_maf.aggregation import (
+    AggregationStats,
+    AliquotLevelMaf,
+    aggregate_mafs,
+)
+from tests.resources.generate_maf import generate_maf
+
+
+class Aggregation(NamedTuple):
+    """The output and statistics of aggregate_mafs."""
+
+    output: bytes
+    stats: AggregationStats
+
+
+def _aggregate(mafs: List[Union[str, bytes]], **kwargs) -> Aggregation:
+    inputs = []
+    for i, maf in enumerate(mafs):
+        if isinstance(maf, str):
+            with open(maf, "rb") as f:
+                maf = f.read()
+        inputs.append(AliquotLevelMaf(io.BytesIO(maf), f"submitter_id_{i}"))
+    output = io.BytesIO()
+    stats = aggregate_mafs(inputs, output, **kwargs)
+    return Aggregation(output.getvalue(), stats)
+
+
+@pytest.fixture
+def aggregate() -> Callable[..., Aggregation]:
+    """Aggregate MAFs, given as filenames or gzipped contents, in memory.
+
+    The submitter id of the i-th MAF is `submitter_id_{i}`.  Keyword arguments are
+    passed to aggregate_mafs.
+    """
+    return _aggregate
+
+
+@pytest.fixture
+def generated_mafs(tmp_path) -> Callable[[int, int], List[str]]:
+    """Generate count MAFs of the given number of rows and return their filenames."""
+
+    def generate(count: int, rows: int) -> List[str]:
+        filenames = []
+        for i in range(count):
+            filename = os.path.join(str(tmp_path), f"generated_{i}.maf.gz")
+            generate_maf(filename, rows, seed=i)
+            filenames.append(filename)
+        return filenames
+
+    return generate
@@ -1,9 +1,9 @@
-import csv
 import gzip
 import random
 import string
 import sys
-from typing import Dict
+import uuid
+from typing import Optional
 
 COLUMN_HEADERS = [
     "Hugo_Symbol",
@@ -134,44 +134,143 @@ COLUMN_HEADERS = [
 ]
 
 
-def generate_maf(filename: str, count: int):
-    with gzip.open(filename, mode="wt") as writer:
-        write_file_header(writer)
-        write_body(writer, count)
+CHROMOSOMES = [f"chr{i}" for i in range(1, 23)] + ["chrX", "chrY"]
 
+VARIANT_CLASSIFICATIONS = [
+    "Missense_Mutation",
+    "Silent",
+    "Nonsense_Mutation",
+    "Frame_Shift_Del",
+    "Intron",
+    "3'UTR",
+    "5'UTR",
+    "RNA",
+]
 
-def write_file_header(writer):
-    writer.writelines(
-        [
-            f"#version gdc-1.0.0\n",
-            f"#annotation.spec gdc-1.0.0-aliquot-merged-masked\n",
-            f"#contigs chr1,chr2,chr3,chr4,chr5,chr6,chr7,chr8,chr9,chr10,chr11\n",
-            f"#sort.order BarcodesAndCoordinate\n",
-            f"#filedate 20200315\n",
-            f"#normal.aliquot {random_value(32)}\n",
-            f"#tumor.aliquot {random_value(32)}\n",
-        ]
+IMPACTS = ["HIGH", "MODERATE", "LOW", "MODIFIER"]
+
+GDC_FILTERS = ["", "common_in_exac", "gdc_pon", "ndp", "NonExonic"]
+
+INTEGER_COLUMNS = [
+    "t_depth",
+    "t_ref_count",
+    "t_alt_count",
+    "n_depth",
+    "n_ref_count",
+    "n_alt_count",
+]
+
+# Number of distinct random strings each run of columns is drawn from.
+_VALUE_POOL_SIZE = 1024
+
+# Number of rows compressed at once.
+_ROWS_PER_WRITE = 1024
+
+
+def generate_maf(
+    filename: str,
+    count: int,
+    seed: Optional[int] = None,
+    value_length: int = 10,
+    compresslevel: int = 1,
+):
+    """Write a gzipped aliquot-level MAF with random content.
+
+    Rows are sorted by coordinate and a few columns (Chromosome, Start_Position,
+    End_Position, Variant_Classification, IMPACT, GDC_FILTER, Tumor_Sample_UUID and
+    the read counts) get plausible values.  Every other cell is drawn from a pool of
+    random strings of up to value_length characters per cell, which keeps generation
+    fast enough for large fixtures.  The same seed always produces the same content.
+    """
+    rng = random.Random(seed)  # nosec
+    with gzip.open(filename, mode="wb", compresslevel=compresslevel) as writer:
+        write_file_header(writer, rng)
+        write_body(writer, count, rng, value_length)
+
+
+def write_file_header(writer, rng: random.Random):
+    writer.write(
+        "".join(
+            [
+                "#version gdc-1.0.0\n",
+                "#annotation.spec gdc-1.0.0-aliquot-merged-masked\n",
+                f"#contigs {','.join(CHROMOSOMES)}\n",
+                "#sort.order BarcodesAndCoordinate\n",
+                "#filedate 20200315\n",
+                f"#normal.aliquot {random_value(rng, 32)}\n",
+                f"#tumor.aliquot {random_value(rng, 32)}\n",
+            ]
+        ).encode()
     )
 
 
-def write_body(writer, count):
-    tsv = csv.DictWriter(writer, COLUMN_HEADERS, dialect=csv.excel_tab)
-    tsv.writeheader()
-    for _ in range(count):
-        tsv.writerow(generate_row())
+def write_body(writer, count: int, rng: random.Random, value_length: int = 10):
+    writer.write(("\t".join(COLUMN_HEADERS) + "\n").encode())
 
+    tumor_sample_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+    counts = [str(i) for i in range(501)]
+    special_values = {
+        "Variant_Classification": VARIANT_CLASSIFICATIONS,
+        "IMPACT": IMPACTS,
+        "GDC_FILTER": GDC_FILTERS,
+        "Tumor_Sample_UUID": [tumor_sample_uuid],
+        **{column: counts for column in INTEGER_COLUMNS},
+    }
+    coordinate_columns = {"Chromosome", "Start_Position", "End_Position"}
 
-def generate_row() -> Dict[str, str]:
-    def value():
-        return random_value(random.randint(1, 10))  # nosec
+    # Runs of consecutive columns without plausible values are pre-joined into pools
+    # of random strings, so that building a row only takes a few random choices.
+    segments = []
+    run = 0
+    for column in COLUMN_HEADERS + [None]:
+        if column is None or column in special_values or column in coordinate_columns:
+            if run:
+                segments.append(
+                    [
+                        "\t".join(
+                            random_value(rng, rng.randint(1, value_length))
+                            for _ in range(run)
+                        )
+                        for _ in range(min(count, _VALUE_POOL_SIZE) or 1)
+                    ]
+                )
+                run = 0
+            if column is not None:
+                segments.append(column)
+        else:
+            run += 1
 
-    return {column: value() for column in COLUMN_HEADERS}
+    positions = sorted(
+        (rng.randrange(len(CHROMOSOMES)), rng.randint(1, 250_000_000))
+        for _ in range(count)
+    )
+    lines = []
+    for chromosome, start in positions:
+        coordinates = {
+            "Chromosome": CHROMOSOMES[chromosome],
+            "Start_Position": str(start),
+            "End_Position": str(start + rng.randint(0, 10)),
+        }
+        row = [
+            rng.choice(segment)
+            if isinstance(segment, list)
+            else coordinates.get(segment) or rng.choice(special_values[segment])
+            for segment in segments
+        ]
+        lines.append("\t".join(row))
+        if len(lines) == _ROWS_PER_WRITE:
+            writer.write(("\n".join(lines) + "\n").encode())
+            lines.clear()
+    if lines:
+        writer.write(("\n".join(lines) + "\n").encode())
 
 
-def random_value(length) -> str:
-    return "".join(random.choices(string.ascii_letters, k=length))  # nosec
+def random_value(rng: random.Random, length: int) -> str:
+    return "".join(rng.choices(string.ascii_letters, k=length))
 
 
 if __name__ == "__main__":
-    # filename, number of entries
-    generate_maf(sys.argv[1], int(sys.argv[2]))
+    # filename, number of entries, optional seed
+    generate_maf(
+        sys.argv[1], int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else None
+    )
@@ -1,20 +1,51 @@
+import asyncio
 import contextlib
 import gzip
 import tempfile
-from typing import BinaryIO, List
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, List
 import io
+import os
 
 import freezegun
 import pytest
 
+from aliquot_level_maf import aggregation
 from aliquot_level_maf.aggregation import (
     aggregate_mafs,
+    aggregate_mafs_async,
+    aggregate_mafs_sharded,
     AliquotLevelMaf,
+    AsyncAliquotLevelMaf,
+    RowFilter,
     ValidationError,
+    _ordered_map,
+    _shards,
+    DEFAULT_CHROMOSOME_ORDER,
+    update_aggregated_maf,
 )
+from aliquot_level_maf.compression import BGZF_EOF
+from aliquot_level_maf.index import AliquotIndex, read_aliquot
+from tests.resources.generate_maf import COLUMN_HEADERS
 
+EXAMPLE_MAFS = [
+    "tests/resources/example_0.wxs.aliquot_ensemble_masked.maf.gz",
+    "tests/resources/example_1.wxs.aliquot_ensemble_masked.maf.gz",
+]
 
-def _aggregate_multiple_mafs(filenames: List[str], output: BinaryIO) -> None:
+
+def _decompressed_output(filenames: List[str], **kwargs: Any) -> bytes:
+    with tempfile.TemporaryFile(mode="w+b") as file:
+        _aggregate_multiple_mafs(filenames=filenames, output=file, **kwargs)
+        file.seek(0)
+        with gzip.open(file, "rb") as reader:
+            return reader.read()
+
+
+def _aggregate_multiple_mafs(
+    filenames: List[str], output: BinaryIO, **kwargs: Any
+) -> None:
     with contextlib.ExitStack() as stack:
         files = [stack.enter_context(open(filename, "rb")) for filename in filenames]
         mafs = [
@@ -23,7 +54,7 @@ def _aggregate_multiple_mafs(filenames: List[str], output: BinaryIO) -> None:
             )
             for i in range(len(files))
         ]
-        aggregate_mafs(mafs, output)
+        aggregate_mafs(mafs, output, **kwargs)
 
 
 def test_aggregate_mafs__check_line_count():
@@ -112,3 +143,686 @@ def test_aggregate_mafs__different_headers_fail():
                 ],
                 output=file,
             )
+
+
+def test_aggregate_mafs__bodies_are_copied_verbatim():
+    filenames = [
+        "tests/resources/example_0.wxs.aliquot_ensemble_masked.maf.gz",
+        "tests/resources/example_1.wxs.aliquot_ensemble_masked.maf.gz",
+    ]
+    expected_body = b""
+    for filename in filenames:
+        with gzip.open(filename, "rb") as reader:
+            lines = [line for line in reader if not line.startswith(b"#")]
+            expected_body += b"".join(lines[1:])
+
+    with tempfile.TemporaryFile(mode="w+b") as file:
+        _aggregate_multiple_mafs(filenames=filenames, output=file)
+        file.seek(0)
+        with gzip.open(file, "rb") as reader:
+            lines = reader.readlines()
+            assert b"".join(lines[6:]) == expected_body
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__decompression_threads_preserve_order():
+    filenames = EXAMPLE_MAFS * 5
+    expected = _decompressed_output(filenames)
+    assert (
+        _decompressed_output(filenames, decompression_threads=3, read_ahead=2)
+        == expected
+    )
+
+
+def test_aggregate_mafs__decompression_threads_validate_headers():
+    with pytest.raises(ValidationError, match="same column headers"):
+        _decompressed_output(
+            [EXAMPLE_MAFS[0], "tests/resources/different_headers.maf.gz"],
+            decompression_threads=2,
+        )
+
+
+def test_ordered_map__bounds_read_ahead():
+    pulled = []
+
+    def items():
+        for i in range(10):
+            pulled.append(i)
+            yield i
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = _ordered_map(executor, lambda i: i * 2, items(), window=3)
+        assert next(results) == 0
+        assert len(pulled) == 4
+        assert list(results) == [2 * i for i in range(1, 10)]
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__compression_threads():
+    filenames = EXAMPLE_MAFS * 5
+    expected = _decompressed_output(filenames)
+    assert (
+        _decompressed_output(filenames, compression_threads=3, compression_level=1)
+        == expected
+    )
+
+
+class _AsyncFileReader:
+    """Stand-in for an object-store download stream."""
+
+    def __init__(self, filename: str):
+        with open(filename, "rb") as file:
+            self._content = io.BytesIO(file.read())
+
+    async def read(self, size: int = -1) -> bytes:
+        await asyncio.sleep(0)
+        return self._content.read(size)
+
+
+def _aggregate_async(filenames: List[str], **kwargs: Any) -> bytes:
+    mafs = [
+        AsyncAliquotLevelMaf(
+            file=_AsyncFileReader(filename),
+            tumor_aliquot_submitter_id=f"submitter_id_{i}",
+        )
+        for i, filename in enumerate(filenames)
+    ]
+    loop = asyncio.new_event_loop()
+    try:
+        with tempfile.TemporaryFile(mode="w+b") as file:
+            loop.run_until_complete(aggregate_mafs_async(mafs, file, **kwargs))
+            file.seek(0)
+            with gzip.open(file, "rb") as reader:
+                return reader.read()
+    finally:
+        loop.close()
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs_async__matches_aggregate_mafs():
+    filenames = EXAMPLE_MAFS * 5
+    expected = _decompressed_output(filenames)
+    assert _aggregate_async(filenames, max_concurrency=3) == expected
+
+
+def test_aggregate_mafs_async__different_versions_fail():
+    with pytest.raises(ValidationError, match="same version"):
+        _aggregate_async([EXAMPLE_MAFS[0], "tests/resources/different_version.maf.gz"])
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__preflight_matches_aggregate_mafs():
+    filenames = EXAMPLE_MAFS * 3
+    expected = _decompressed_output(filenames)
+    assert _decompressed_output(filenames, preflight=True) == expected
+    assert (
+        _decompressed_output(filenames, preflight=True, decompression_threads=2)
+        == expected
+    )
+
+
+def test_aggregate_mafs__preflight_reports_every_mismatch_before_writing():
+    with tempfile.TemporaryFile(mode="w+b") as file:
+        with pytest.raises(ValidationError) as e:
+            _aggregate_multiple_mafs(
+                filenames=[
+                    EXAMPLE_MAFS[0],
+                    "tests/resources/different_version.maf.gz",
+                    EXAMPLE_MAFS[1],
+                    "tests/resources/different_headers.maf.gz",
+                ],
+                output=file,
+                preflight=True,
+            )
+        assert file.tell() == 0
+
+    assert "2 files" in e.value.message
+    assert "submitter_id_1: " in e.value.details
+    assert "same version" in e.value.details
+    assert "submitter_id_3: " in e.value.details
+    assert "same column headers" in e.value.details
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"compression_threads": -1},
+        {"bgzf": True, "compression_threads": 2},
+        {"columnar": True, "aliquot_index": io.BytesIO()},
+    ],
+)
+def test_aggregate_mafs__invalid_options_leave_no_preflighted_input_open(
+    monkeypatch, options
+):
+    parsed_mafs = []
+    parse_maf = aggregation._parse_maf
+
+    def record(maf):
+        parsed_mafs.append(parse_maf(maf))
+        return parsed_mafs[-1]
+
+    monkeypatch.setattr(aggregation, "_parse_maf", record)
+    with pytest.raises(ValueError):
+        _decompressed_output(EXAMPLE_MAFS, preflight=True, **options)
+    assert all(parsed.body.closed for parsed in parsed_mafs)
+
+
+def _body_rows(output: bytes) -> List[List[str]]:
+    lines = [line for line in output.decode().splitlines() if not line.startswith("#")]
+    return [line.split("\t") for line in lines[1:]]
+
+
+def test_aggregate_mafs__sort_by_coordinate(generated_mafs):
+    filenames = generated_mafs(4, 200)
+    output = _decompressed_output(filenames, sort_by_coordinate=True)
+
+    assert "#sort.order Coordinate\n" in output.decode()
+    rows = _body_rows(output)
+    assert sorted(rows) == sorted(_body_rows(_decompressed_output(filenames)))
+    keys = [(DEFAULT_CHROMOSOME_ORDER.index(r[4]), int(r[5])) for r in rows]
+    assert keys == sorted(keys)
+
+
+def _rewrite_maf(source: str, destination: str, reorder) -> None:
+    with gzip.open(source, "rb") as reader:
+        lines = reader.readlines()
+    header_count = next(i for i, line in enumerate(lines) if not line.startswith(b"#"))
+    with gzip.open(destination, "wb") as writer:
+        writer.writelines(
+            lines[: header_count + 1] + reorder(lines[header_count + 1 :])
+        )
+
+
+def test_aggregate_mafs__sort_by_coordinate_with_chromosome_order(generated_mafs):
+    order = ["chrY", "chrX"] + [f"chr{i}" for i in range(22, 0, -1)]
+
+    def key(line: bytes):
+        fields = line.decode().split("\t")
+        return order.index(fields[4]), int(fields[5])
+
+    filenames = generated_mafs(2, 200)
+    for filename in filenames:
+        _rewrite_maf(filename, filename, lambda lines: sorted(lines, key=key))
+
+    rows = _body_rows(
+        _decompressed_output(filenames, sort_by_coordinate=True, chromosome_order=order)
+    )
+    keys = [(order.index(r[4]), int(r[5])) for r in rows]
+    assert keys == sorted(keys)
+
+
+def test_aggregate_mafs__sort_by_coordinate_requires_sorted_inputs(generated_mafs):
+    filename = generated_mafs(1, 200)[0]
+    _rewrite_maf(filename, filename, lambda lines: lines[::-1])
+
+    with pytest.raises(ValidationError, match="sorted by coordinate"):
+        _decompressed_output([filename], sort_by_coordinate=True)
+
+
+def test_aggregate_mafs__sort_by_coordinate_requires_coordinates():
+    with pytest.raises(ValidationError, match="Cannot sort by coordinate"):
+        _decompressed_output([EXAMPLE_MAFS[0]], sort_by_coordinate=True)
+
+
+def _select_maf_columns(source: str, destination: str, columns: List[str]) -> None:
+    with gzip.open(source, "rb") as reader:
+        lines = reader.read().decode().splitlines()
+    header_count = next(i for i, line in enumerate(lines) if not line.startswith("#"))
+    indices = [COLUMN_HEADERS.index(column) for column in columns]
+    rows = [line.split("\t") for line in lines[header_count:]]
+    with gzip.open(destination, "wb") as writer:
+        writer.writelines(
+            [f"{line}\n".encode() for line in lines[:header_count]]
+            + ["\t".join(row[i] for i in indices).encode() + b"\n" for row in rows]
+        )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"decompression_threads": 2}, {"sort_by_coordinate": True}],
+)
+def test_aggregate_mafs__union_columns(options, generated_mafs):
+    filenames = generated_mafs(3, 100)
+    full_rows = _body_rows(_decompressed_output(filenames, **options))
+    first_columns = [c for c in COLUMN_HEADERS if c != "Hugo_Symbol"]
+    _select_maf_columns(filenames[0], filenames[0], first_columns)
+    _select_maf_columns(filenames[1], filenames[1], COLUMN_HEADERS[::-1])
+
+    output = _decompressed_output(filenames, union_columns=True, **options)
+
+    header = [line for line in output.decode().splitlines() if line[0] != "#"][0]
+    union = first_columns + ["Hugo_Symbol"]
+    assert header.split("\t") == union
+    # Only the rows of the first input lack a Hugo_Symbol.
+    indices = [COLUMN_HEADERS.index(column) for column in union]
+    expected = [[row[i] for i in indices] for row in full_rows]
+    rows = _body_rows(output)
+    assert [row[:-1] for row in rows] == [row[:-1] for row in expected]
+    assert [row[-1] for row in rows].count("") == 100
+
+
+def test_aggregate_mafs__union_columns_with_projection(generated_mafs):
+    filenames = generated_mafs(2, 50)
+    full_rows = _body_rows(_decompressed_output(filenames))
+    _select_maf_columns(filenames[1], filenames[1], COLUMN_HEADERS[::-1])
+
+    rows = _body_rows(
+        _decompressed_output(
+            filenames, union_columns=True, columns=["Start_Position", "Hugo_Symbol"]
+        )
+    )
+    assert rows == [[r[5], r[0]] for r in full_rows]
+
+
+def test_aggregate_mafs__union_columns_accept_different_headers():
+    output = _decompressed_output(
+        [EXAMPLE_MAFS[0], "tests/resources/different_headers.maf.gz"],
+        union_columns=True,
+    )
+    widths = {len(row) for row in _body_rows(output)}
+    header = [line for line in output.decode().splitlines() if line[0] != "#"][0]
+    assert widths == {len(header.split("\t"))}
+
+
+def test_aggregate_mafs__union_columns_still_validate_file_headers():
+    with pytest.raises(ValidationError, match="Failed header validation"):
+        _decompressed_output(
+            [EXAMPLE_MAFS[0], "tests/resources/different_version.maf.gz"],
+            union_columns=True,
+        )
+
+
+def test_aggregate_mafs__columns(generated_mafs):
+    filenames = generated_mafs(3, 100)
+    columns = ["Start_Position", "Chromosome", "Hugo_Symbol"]
+    full = _decompressed_output(filenames)
+    projected = _decompressed_output(filenames, columns=columns)
+
+    header = [line for line in projected.decode().splitlines() if line[0] != "#"][0]
+    assert header.split("\t") == columns
+    assert _body_rows(projected) == [[r[5], r[4], r[0]] for r in _body_rows(full)]
+    assert len(projected) < len(full) / 10
+
+
+def test_aggregate_mafs__columns_with_sort_by_coordinate(generated_mafs):
+    filenames = generated_mafs(3, 100)
+    rows = _body_rows(
+        _decompressed_output(
+            filenames, sort_by_coordinate=True, columns=["Chromosome", "Start_Position"]
+        )
+    )
+    keys = [(DEFAULT_CHROMOSOME_ORDER.index(c), int(p)) for c, p in rows]
+    assert len(keys) == 300
+    assert keys == sorted(keys)
+
+
+def test_aggregate_mafs__missing_columns_fail():
+    with pytest.raises(ValidationError, match="columns are missing"):
+        _decompressed_output(EXAMPLE_MAFS, columns=["Hugo_Symbol", "Not_A_Column"])
+
+
+def test_aggregate_mafs__filters(generated_mafs):
+    filenames = generated_mafs(3, 200)
+    full_rows = _body_rows(_decompressed_output(filenames))
+    classification = COLUMN_HEADERS.index("Variant_Classification")
+    gdc_filter = COLUMN_HEADERS.index("GDC_FILTER")
+
+    rows = _body_rows(
+        _decompressed_output(
+            filenames,
+            filters=[
+                RowFilter("Variant_Classification", ["Missense_Mutation", "Silent"]),
+                RowFilter(
+                    "GDC_FILTER", ["gdc_pon", "ndp"], exclude=True, separator=";"
+                ),
+            ],
+        )
+    )
+
+    expected = [
+        r
+        for r in full_rows
+        if r[classification] in ("Missense_Mutation", "Silent")
+        and r[gdc_filter] not in ("gdc_pon", "ndp")
+    ]
+    assert 0 < len(rows) < len(full_rows)
+    assert rows == expected
+
+
+def test_aggregate_mafs__filters_on_empty_value_with_columns(generated_mafs):
+    filenames = generated_mafs(2, 200)
+    full_rows = _body_rows(_decompressed_output(filenames))
+    gdc_filter = COLUMN_HEADERS.index("GDC_FILTER")
+
+    rows = _body_rows(
+        _decompressed_output(
+            filenames,
+            columns=["Hugo_Symbol", "GDC_FILTER"],
+            filters=[RowFilter("GDC_FILTER", [""])],
+        )
+    )
+
+    assert rows == [[r[0], r[gdc_filter]] for r in full_rows if not r[gdc_filter]]
+
+
+def test_aggregate_mafs__filter_on_missing_column_fails():
+    with pytest.raises(ValidationError, match="Filtered column is missing"):
+        _decompressed_output(EXAMPLE_MAFS, filters=[RowFilter("Not_A_Column", ["x"])])
+
+
+def _mafs(files: List[BinaryIO], submitter_ids: List[str]) -> List[AliquotLevelMaf]:
+    return [
+        AliquotLevelMaf(file=file, tumor_aliquot_submitter_id=submitter_id)
+        for file, submitter_id in zip(files, submitter_ids)
+    ]
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_update_aggregated_maf(generated_mafs):
+    filenames = generated_mafs(4, 300)
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(f, "rb")) for f in filenames]
+        index_file = io.BytesIO()
+        original = io.BytesIO()
+        aggregate_mafs(
+            _mafs(files[:3], ["a", "b", "c"]), original, aliquot_index=index_file
+        )
+        index_file.seek(0)
+
+        updated = io.BytesIO()
+        index = update_aggregated_maf(
+            original,
+            AliquotIndex.read(index_file),
+            updated,
+            add=_mafs(files[3:], ["d"]),
+            remove=["b"],
+        )
+
+        for file in files:
+            file.seek(0)
+        expected = io.BytesIO()
+        aggregate_mafs(_mafs([files[0], files[2], files[3]], ["a", "c", "d"]), expected)
+
+    assert gzip.decompress(updated.getvalue()) == gzip.decompress(expected.getvalue())
+    assert [e.tumor_aliquot_submitter_id for e in index.entries] == ["a", "c", "d"]
+    rows = list(read_aliquot(updated, index, "d"))
+    assert len(rows) == index.entries[-1].row_count == 300
+
+
+@freezegun.freeze_time("2020-03-23")
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"columns": ["Hugo_Symbol", "Chromosome", "Start_Position"]},
+        {"filters": [RowFilter("IMPACT", {"HIGH", "MODERATE"})]},
+        {"union_columns": True, "columns": ["Hugo_Symbol", "Start_Position"]},
+    ],
+)
+def test_update_aggregated_maf__applies_aggregation_options(generated_mafs, options):
+    filenames = generated_mafs(3, 200)
+    if options.get("union_columns"):
+        columns = [c for c in COLUMN_HEADERS if c != "Hugo_Symbol"]
+        _select_maf_columns(filenames[2], filenames[2], columns)
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(f, "rb")) for f in filenames]
+        index_file = io.BytesIO()
+        original = io.BytesIO()
+        aggregate_mafs(
+            _mafs(files[:2], ["a", "b"]), original, aliquot_index=index_file, **options
+        )
+        index_file.seek(0)
+
+        updated = io.BytesIO()
+        index = update_aggregated_maf(
+            original,
+            AliquotIndex.read(index_file),
+            updated,
+            add=_mafs(files[2:], ["c"]),
+        )
+
+        for file in files:
+            file.seek(0)
+        expected = io.BytesIO()
+        aggregate_mafs(_mafs(files, ["a", "b", "c"]), expected, **options)
+
+    assert gzip.decompress(updated.getvalue()) == gzip.decompress(expected.getvalue())
+    assert index.options["union_columns"] == bool(options.get("union_columns"))
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_update_aggregated_maf__keeps_bgzf(generated_mafs):
+    filenames = generated_mafs(4, 300)
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(f, "rb")) for f in filenames]
+        index_file = io.BytesIO()
+        original = io.BytesIO()
+        aggregate_mafs(
+            _mafs(files[:3], ["a", "b", "c"]),
+            original,
+            aliquot_index=index_file,
+            bgzf=True,
+        )
+        index_file.seek(0)
+
+        updated = io.BytesIO()
+        index = update_aggregated_maf(
+            original,
+            AliquotIndex.read(index_file),
+            updated,
+            add=_mafs(files[3:], ["d"]),
+            remove=["b"],
+        )
+
+        for file in files:
+            file.seek(0)
+        expected = io.BytesIO()
+        aggregate_mafs(
+            _mafs([files[0], files[2], files[3]], ["a", "c", "d"]),
+            expected,
+            aliquot_index=io.BytesIO(),
+            bgzf=True,
+        )
+
+    assert updated.getvalue() == expected.getvalue()
+    assert updated.getvalue().endswith(BGZF_EOF)
+    assert index.options["bgzf"]
+    assert len(list(read_aliquot(updated, index, "d"))) == 300
+
+
+def test_update_aggregated_maf__rejects_unreproducible_updates():
+    with open(EXAMPLE_MAFS[0], "rb") as file:
+        index_file = io.BytesIO()
+        original = io.BytesIO()
+        aggregate_mafs(
+            _mafs([file], ["a"]),
+            original,
+            aliquot_index=index_file,
+            deduplicate=["Chromosome", "Start_Position"],
+        )
+    index_file.seek(0)
+    index = AliquotIndex.read(index_file)
+
+    with pytest.raises(ValueError, match="deduplicated"):
+        update_aggregated_maf(original, index, io.BytesIO(), remove=["a"])
+    with pytest.raises(ValueError, match="options"):
+        update_aggregated_maf(
+            original, index._replace(options=None), io.BytesIO(), remove=["a"]
+        )
+
+
+def test_update_aggregated_maf__validates_added_mafs():
+    with contextlib.ExitStack() as stack:
+        files = [
+            stack.enter_context(open(f, "rb"))
+            for f in [EXAMPLE_MAFS[0], "tests/resources/different_version.maf.gz"]
+        ]
+        index_file = io.BytesIO()
+        original = io.BytesIO()
+        aggregate_mafs(_mafs(files[:1], ["a"]), original, aliquot_index=index_file)
+        index_file.seek(0)
+        index = AliquotIndex.read(index_file)
+
+        with pytest.raises(ValidationError, match="same version"):
+            update_aggregated_maf(
+                original, index, io.BytesIO(), add=_mafs(files[1:], ["b"])
+            )
+        with pytest.raises(ValueError, match="missing"):
+            update_aggregated_maf(original, index, io.BytesIO(), remove=["b"])
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__processes_match_aggregate_mafs(generated_mafs):
+    filenames = generated_mafs(5, 200)
+    filters = [RowFilter("IMPACT", {"HIGH", "MODERATE"})]
+    expected = _decompressed_output(filenames, filters=filters)
+    assert _decompressed_output(filenames, filters=filters, processes=2) == expected
+
+
+def test_shards__bounds_compressed_size_and_reads_lazily():
+    files = [io.BytesIO(b"x" * size) for size in [30, 30, 50, 10, 10, 10]]
+    mafs = [AliquotLevelMaf(f, f"submitter_id_{i}") for i, f in enumerate(files)]
+    shards = _shards(mafs, 2, 50)
+
+    shard, contents = next(shards)
+    assert shard == mafs[:2]
+    assert contents == [b"x" * 30, b"x" * 30]
+    assert files[2].tell() == 0
+    assert [len(shard) for shard, _ in shards] == [1, 2, 1]
+
+
+def test_aggregate_mafs__processes_raise_validation_errors():
+    with pytest.raises(ValidationError, match="same version") as e:
+        _decompressed_output(
+            [*EXAMPLE_MAFS, "tests/resources/different_version.maf.gz"], processes=2
+        )
+    assert e.value.message == "Failed file header validation."
+    assert "gdc-1.0.0" in e.value.details
+
+
+def test_aggregate_mafs__processes_raise_worker_validation_errors():
+    with pytest.raises(ValidationError, match="Filtered column is missing") as e:
+        _decompressed_output(
+            EXAMPLE_MAFS, filters=[RowFilter("missing", ["x"])], processes=1
+        )
+    assert "Missing: missing" in e.value.details
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__path_inputs(generated_mafs):
+    filenames = [*EXAMPLE_MAFS, *generated_mafs(2, 100)]
+    expected = _decompressed_output(filenames)
+    for kwargs in [{}, {"decompression_threads": 2}, {"processes": 1}]:
+        output = io.BytesIO()
+        aggregate_mafs(
+            [
+                AliquotLevelMaf(
+                    file=filename, tumor_aliquot_submitter_id=f"submitter_id_{i}"
+                )
+                for i, filename in enumerate(filenames)
+            ],
+            output,
+            **kwargs,
+        )
+        assert gzip.decompress(output.getvalue()) == expected
+
+
+def test_aggregate_mafs__path_inputs_held_open_use_small_buffers(generated_mafs):
+    (filename,) = generated_mafs(1, 100)
+    mafs = [AliquotLevelMaf(filename, f"submitter_id_{i}") for i in range(50)]
+    tracemalloc.start()
+    try:
+        aggregate_mafs(mafs, io.BytesIO(), preflight=True, compression_level=1)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < 10 * 1024 * 1024
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"decompression_threads": 2}, {"sort_by_coordinate": True}]
+)
+def test_aggregate_mafs__stats(options, generated_mafs):
+    filenames = generated_mafs(2, 150)
+    files = [open(f, "rb") for f in filenames] + [io.BytesIO(gzip.compress(b""))]
+    observed = []
+    output = io.BytesIO()
+    try:
+        stats = aggregate_mafs(
+            [
+                AliquotLevelMaf(file=file, tumor_aliquot_submitter_id=f"id_{i}")
+                for i, file in enumerate(files)
+            ],
+            output,
+            on_file=observed.append,
+            **options,
+        )
+    finally:
+        for file in files:
+            file.close()
+
+    assert observed == stats.files
+    assert [f.tumor_aliquot_submitter_id for f in stats.files] == [
+        "id_0",
+        "id_1",
+        "id_2",
+    ]
+    assert stats.skipped == ["id_2"]
+    assert stats.row_count == 300
+    assert stats.compressed_bytes == len(output.getvalue())
+    body = _body_rows(gzip.decompress(output.getvalue()))
+    assert stats.uncompressed_bytes == sum(len("\t".join(row)) + 1 for row in body)
+    assert [f.compressed_bytes for f in stats.files[:2]] == [
+        os.path.getsize(f) for f in filenames
+    ]
+    assert all(f.decompression_seconds > 0 for f in stats.files[:2])
+    if not options.get("sort_by_coordinate"):
+        assert [f.row_count for f in stats.files] == [150, 150, 0]
+
+
+@freezegun.freeze_time("2020-03-23")
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"compression_threads": 2, "decompression_threads": 2},
+        {"columns": ["Hugo_Symbol", "Start_Position"]},
+    ],
+)
+def test_aggregate_mafs_sharded(options, generated_mafs):
+    filenames = generated_mafs(3, 300)
+    outputs = {}
+
+    def open_output(value):
+        outputs[value] = io.BytesIO()
+        return outputs[value]
+
+    with contextlib.ExitStack() as stack:
+        mafs = _mafs(
+            [stack.enter_context(open(f, "rb")) for f in filenames],
+            [f"submitter_id_{i}" for i in range(3)],
+        )
+        stats = aggregate_mafs_sharded(mafs, open_output, "Chromosome", **options)
+
+    full = _decompressed_output(filenames)
+    full_rows = _body_rows(full)
+    projected = _body_rows(_decompressed_output(filenames, **options))
+    assert set(outputs) == {row[4] for row in full_rows}
+    assert stats.row_count == len(full_rows)
+    assert stats.compressed_bytes == sum(len(o.getvalue()) for o in outputs.values())
+    header_lines = [line for line in full.decode().splitlines() if line[0] == "#"]
+    for chromosome, output in outputs.items():
+        content = gzip.decompress(output.getvalue()).decode()
+        assert content.splitlines()[: len(header_lines)] == header_lines
+        assert _body_rows(content.encode()) == [
+            row
+            for row, full_row in zip(projected, full_rows)
+            if full_row[4] == chromosome
+        ]
+
+
+def test_aggregate_mafs_sharded__missing_shard_column_fails():
+    with pytest.raises(ValidationError, match="Shard column is missing"):
+        with open(EXAMPLE_MAFS[0], "rb") as f:
+            aggregate_mafs_sharded(
+                _mafs([f], ["submitter_id_0"]), lambda value: io.BytesIO(), "Nope"
+            )
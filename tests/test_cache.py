@@ -0,0 +1,124 @@
+import gzip
+import io
+import os
+import time
+
+import freezegun
+import pytest
+
+from aliquot_level_maf import aggregation
+from aliquot_level_maf.cache import SegmentCache, content_key, file_content_key
+from aliquot_level_maf.index import AliquotIndex, read_aliquot
+
+EMPTY_MAF = gzip.compress(b"")
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__cache_hit_copies_bodies(
+    tmp_path, monkeypatch, aggregate, generated_mafs
+):
+    filenames = generated_mafs(3, 300) + [EMPTY_MAF]
+    cache = SegmentCache(str(tmp_path / "cache"))
+    expected = gzip.decompress(aggregate(filenames).output)
+
+    assert gzip.decompress(aggregate(filenames, cache=cache).output) == expected
+    assert len(os.listdir(cache.directory)) == 8
+
+    def fail(maf):
+        raise AssertionError("Cached input was decompressed")
+
+    monkeypatch.setattr(aggregation, "_parse_maf", fail)
+    index_file = io.BytesIO()
+    cached = aggregate(filenames, cache=cache, aliquot_index=index_file).output
+    assert gzip.decompress(cached) == expected
+
+    index_file.seek(0)
+    index = AliquotIndex.read(index_file)
+    assert [e.row_count for e in index.entries] == [300, 300, 300]
+    assert len(list(read_aliquot(io.BytesIO(cached), index, "submitter_id_1"))) == 300
+
+
+def test_aggregate_mafs__cache_is_keyed_by_options(tmp_path, aggregate, generated_mafs):
+    filenames = generated_mafs(1, 100)
+    cache = SegmentCache(str(tmp_path / "cache"))
+    aggregate(filenames, cache=cache)
+    projected = aggregate(filenames, cache=cache, columns=["Chromosome"]).output
+
+    assert len(os.listdir(cache.directory)) == 4
+    lines = gzip.decompress(projected).decode().splitlines()
+    assert all(line.startswith("chr") for line in lines[-100:])
+
+
+def test_aggregate_mafs__cache_requires_default_output(
+    tmp_path, aggregate, generated_mafs
+):
+    filenames = generated_mafs(1, 10)
+    cache = SegmentCache(str(tmp_path / "cache"))
+    with pytest.raises(ValueError):
+        aggregate(filenames, cache=cache, compression_threads=2)
+
+
+def test_segment_cache__evicts_least_recently_used(tmp_path):
+    cache = SegmentCache(str(tmp_path), max_size=250)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, {"i": i}, io.BytesIO(b"x" * 100))
+        os.utime(os.path.join(cache.directory, key + ".json"), (i, i))
+
+    assert cache.get("a") is None
+    entry = cache.get("b")
+    with entry.body:
+        assert entry.metadata == {"i": 1}
+        assert entry.body.read() == b"x" * 100
+    assert cache.size() <= 250
+
+    # Reading b made it the most recently used, so c is evicted next.
+    time.sleep(0.01)
+    cache.put("d", {}, io.BytesIO(b"y" * 100))
+    assert cache.get("c") is None
+    assert cache.get("b") is not None
+
+
+@pytest.mark.parametrize("max_size", [None, 10000])
+def test_segment_cache__put_under_max_size_does_not_rescan(
+    tmp_path, monkeypatch, max_size
+):
+    cache = SegmentCache(str(tmp_path), max_size=max_size)
+
+    def fail():
+        raise AssertionError("The cache directory was rescanned")
+
+    monkeypatch.setattr(cache, "_entries", fail)
+    for key in ["a", "b", "c"]:
+        cache.put(key, {}, io.BytesIO(b"x" * 100))
+    assert cache.get("a") is not None
+
+
+def test_content_key():
+    assert content_key(b"ab", b"c") != content_key(b"a", b"bc")
+    assert content_key(b"ab", b"c") == content_key(b"ab", b"c")
+
+
+def test_file_content_key__hashes_in_blocks():
+    file = io.BytesIO(b"head" + b"content" * 100)
+    file.seek(4)
+    key = file_content_key(b"options", file, 700, block_size=64)
+    assert key == content_key(b"options", b"content" * 100)
+    assert file.tell() == 704
+
+
+def test_aggregate_mafs__cache_hashes_path_inputs(
+    tmp_path, monkeypatch, aggregate, generated_mafs
+):
+    filenames = generated_mafs(2, 50)
+    mafs = [
+        aggregation.AliquotLevelMaf(filename, f"submitter_id_{i}")
+        for i, filename in enumerate(filenames)
+    ]
+    cache = SegmentCache(str(tmp_path / "cache"))
+    expected = gzip.decompress(aggregate(filenames).output)
+
+    for _ in range(2):
+        output = io.BytesIO()
+        aggregation.aggregate_mafs(mafs, output, cache=cache)
+        assert gzip.decompress(output.getvalue()) == expected
+        monkeypatch.setattr(aggregation, "_parse_maf", None)
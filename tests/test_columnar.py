@@ -0,0 +1,165 @@
+import gzip
+import io
+
+import freezegun
+import pytest
+
+from aliquot_level_maf.columnar import ColumnarReader, ColumnarWriter
+
+
+@pytest.fixture
+def filenames(generated_mafs):
+    return generated_mafs(3, 300)
+
+
+def _as_text(value) -> str:
+    if value is None:
+        return ""
+    return str(value)
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__columnar(aggregate, filenames):
+    text = gzip.decompress(aggregate(filenames).output).decode()
+    reader = ColumnarReader(io.BytesIO(aggregate(filenames, columnar=True).output))
+
+    lines = text.splitlines()
+    header_count = sum(line.startswith("#") for line in lines)
+    assert reader.pragmas == lines[:header_count]
+    assert reader.columns == lines[header_count].split("\t")
+    assert reader.row_count == len(lines) - header_count - 1
+
+    values = reader.read_columns()
+    rows = [
+        "\t".join(_as_text(values[column][i]) for column in reader.columns)
+        for i in range(reader.row_count)
+    ]
+    assert rows == lines[header_count + 1 :]
+    assert all(isinstance(p, int) for p in values["Start_Position"])
+
+
+def test_columnar_writer__row_groups_and_encodings():
+    output = io.BytesIO()
+    # Each row takes about 200 bytes, so row groups have 4 rows.
+    with ColumnarWriter(output, row_group_bytes=800) as writer:
+        writer.write(b"#version 2.4\nChromosome\tStart_Position\tt_depth\tName\n")
+        for i in range(10):
+            writer.write(f"chr{i % 2 + 1}\t{100 + i}\t{i or ''}\tname_{i}\n".encode())
+
+    reader = ColumnarReader(output)
+    assert [row_group.row_count for row_group in reader._row_groups] == [4, 4, 2]
+    assert [chunk.encoding for chunk in reader._row_groups[0].chunks] == [
+        "dictionary",
+        "int",
+        "int",
+        "plain",
+    ]
+    assert reader.read_columns(["t_depth", "Chromosome"]) == {
+        "t_depth": [None] + list(range(1, 10)),
+        "Chromosome": [f"chr{i % 2 + 1}" for i in range(10)],
+    }
+    assert [list(g) for g in reader.iter_row_groups(["Name"])] == [["Name"]] * 3
+
+
+def test_columnar_writer__column_types_are_the_same_in_every_row_group():
+    output = io.BytesIO()
+    with ColumnarWriter(output, row_group_bytes=1) as writer:
+        writer.write(b"Count\tName\tId\n\t1\ta\n\t\tb\n5\tx\tc\n6\t2\td\n")
+
+    reader = ColumnarReader(output)
+    assert [chunk.encoding for chunk in reader._row_groups[3].chunks] == [
+        "int",
+        "int",
+        "plain",
+    ]
+    assert reader.read_columns(["Count", "Name"]) == {
+        "Count": [None, None, 5, 6],
+        "Name": ["1", "", "x", "2"],
+    }
+
+
+def test_columnar_writer__bounds_buffered_bytes():
+    output = io.BytesIO()
+    with ColumnarWriter(output, row_group_bytes=64 * 1024) as writer:
+        writer.write(("\t".join(f"C{i}" for i in range(100)) + "\n").encode())
+        for _ in range(1000):
+            writer.write(("\t".join("x" * 10 for _ in range(100)) + "\n").encode())
+
+    row_counts = [g.row_count for g in ColumnarReader(output)._row_groups]
+    assert sum(row_counts) == 1000
+    assert max(row_counts) < 64 * 1024 / (100 * 10)
+
+
+def test_columnar_writer__keeps_rows_of_empty_fields():
+    output = io.BytesIO()
+    with ColumnarWriter(output) as writer:
+        writer.write(b"A\tB\n1\tx\n\t\n\n2\t\n")
+
+    assert ColumnarReader(output).read_columns() == {
+        "A": [1, None, 2],
+        "B": ["x", "", ""],
+    }
+
+
+def test_columnar_writer__non_canonical_integers_are_text():
+    output = io.BytesIO()
+    with ColumnarWriter(output) as writer:
+        writer.write(b"Position\n007\n1\n")
+
+    assert ColumnarReader(output).read_columns() == {"Position": ["007", "1"]}
+
+
+def test_columnar_writer__rows_must_match_columns():
+    with pytest.raises(ValueError, match="columns"):
+        with ColumnarWriter(io.BytesIO()) as writer:
+            writer.write(b"A\tB\n1\n")
+
+
+class _CountingReader(io.BytesIO):
+    def __init__(self, content: bytes):
+        super().__init__(content)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_columnar_reader__reads_only_selected_columns(aggregate, filenames):
+    content = aggregate(filenames, columnar=True).output
+    file = _CountingReader(content)
+    reader = ColumnarReader(file)
+    footer_bytes = file.bytes_read
+
+    values = reader.read_columns(["Chromosome"])
+
+    assert len(values["Chromosome"]) == 900
+    assert file.bytes_read - footer_bytes < len(content) / 20
+
+
+def test_columnar_reader__missing_columns_fail(aggregate, filenames):
+    reader = ColumnarReader(io.BytesIO(aggregate(filenames, columnar=True).output))
+    with pytest.raises(KeyError):
+        reader.read_columns(["Not_A_Column"])
+
+
+def test_columnar_reader__not_columnar_fails(filenames):
+    with pytest.raises(ValueError, match="Not a columnar MAF"):
+        with open(filenames[0], "rb") as f:
+            ColumnarReader(f)
+
+
+def test_aggregate_mafs__columnar_with_gzip_options_fails(aggregate, filenames):
+    with pytest.raises(ValueError, match="Columnar"):
+        aggregate(filenames, columnar=True, bgzf=True)
+
+
+def test_columnar_writer__empty():
+    output = io.BytesIO()
+    ColumnarWriter(output).close()
+
+    reader = ColumnarReader(output)
+    assert reader.columns == []
+    assert reader.row_count == 0
+    assert reader.read_columns() == {}
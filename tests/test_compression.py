@@ -0,0 +1,107 @@
+import gzip
+import io
+import os
+import zlib
+
+import pytest
+
+from aliquot_level_maf.compression import (
+    BGZF_EOF,
+    BgzfReader,
+    BgzfWriter,
+    MappedGzipReader,
+    ParallelGzipWriter,
+)
+
+
+def _split_members(data: bytes) -> list:
+    members = []
+    while data:
+        decompressor = zlib.decompressobj(wbits=31)
+        members.append(decompressor.decompress(data))
+        assert decompressor.eof
+        data = decompressor.unused_data
+    return members
+
+
+def test_parallel_gzip_writer__writes_ordered_members():
+    data = b"".join(f"line {i}\n".encode() for i in range(10000))
+    output = io.BytesIO()
+    with ParallelGzipWriter(output, threads=4, chunk_size=1000) as writer:
+        for i in range(0, len(data), 777):
+            writer.write(data[i : i + 777])
+
+    members = _split_members(output.getvalue())
+    assert len(members) == -(-len(data) // 1000)
+    assert all(len(member) == 1000 for member in members[:-1])
+    assert b"".join(members) == data
+    assert gzip.decompress(output.getvalue()) == data
+
+
+def test_parallel_gzip_writer__empty_output_is_valid_gzip():
+    output = io.BytesIO()
+    with ParallelGzipWriter(output, threads=2):
+        pass
+    assert gzip.decompress(output.getvalue()) == b""
+
+
+def test_bgzf__seek_to_virtual_offsets():
+    lines = [f"line {i} {'x' * (i % 300)}\n".encode() for i in range(5000)]
+    output = io.BytesIO()
+    offsets = []
+    with BgzfWriter(output) as writer:
+        for line in lines:
+            offsets.append(writer.tell_virtual())
+            writer.write(line)
+
+    assert gzip.decompress(output.getvalue()) == b"".join(lines)
+    assert output.getvalue().endswith(BGZF_EOF)
+    assert len({offset >> 16 for offset in offsets}) > 10
+
+    reader = BgzfReader(output)
+    for i in [0, 1, 2000, 3333, 4998]:
+        reader.seek_virtual(offsets[i])
+        assert reader.readline() == lines[i]
+        assert reader.tell_virtual() == offsets[i + 1]
+    assert list(reader) == lines[4999:]
+
+
+def test_mapped_gzip_reader__reads_multiple_members(tmp_path):
+    data = b"".join(f"line {i}\n".encode() for i in range(100000))
+    path = os.path.join(str(tmp_path), "members.gz")
+    with open(path, "wb") as file:
+        for i in range(0, len(data), 300000):
+            file.write(gzip.compress(data[i : i + 300000]))
+        file.write(gzip.compress(b""))
+
+    with io.BufferedReader(MappedGzipReader(path), buffer_size=4096) as reader:
+        assert reader.readline() == b"line 0\n"
+        assert reader.readline() + reader.read() == data[len(b"line 0\n") :]
+
+
+def test_mapped_gzip_reader__skips_padding(tmp_path):
+    path = os.path.join(str(tmp_path), "padded.gz")
+    with open(path, "wb") as file:
+        file.write(gzip.compress(b"first\n") + b"\0" * 10)
+        file.write(gzip.compress(b"second\n") + b"\0" * 1000)
+
+    with io.BufferedReader(MappedGzipReader(path)) as reader:
+        data = reader.read()
+    with gzip.open(path) as reader:
+        assert data == reader.read() == b"first\nsecond\n"
+
+
+def test_mapped_gzip_reader__empty_file(tmp_path):
+    path = os.path.join(str(tmp_path), "empty.gz")
+    open(path, "wb").close()
+    with io.BufferedReader(MappedGzipReader(path)) as reader:
+        assert reader.read() == b""
+
+
+def test_mapped_gzip_reader__truncated_file(tmp_path):
+    path = os.path.join(str(tmp_path), "truncated.gz")
+    with open(path, "wb") as file:
+        file.write(gzip.compress(os.urandom(10000))[:-20])
+    with pytest.raises(EOFError):
+        with io.BufferedReader(MappedGzipReader(path)) as reader:
+            reader.read()
@@ -0,0 +1,99 @@
+import gzip
+
+import pytest
+
+from aliquot_level_maf.dedup import KEY_SIZE, SpillingKeySet, _KeyFilter, hash_key
+
+DEDUP_COLUMNS = [
+    "Chromosome",
+    "Start_Position",
+    "Reference_Allele",
+    "Tumor_Seq_Allele2",
+    "Tumor_Sample_UUID",
+]
+
+
+def test_hash_key():
+    assert len(hash_key(b"chr1\t100")) == KEY_SIZE
+    assert hash_key(b"chr1\t100") == hash_key(b"chr1\t100")
+    assert hash_key(b"chr1\t100") != hash_key(b"chr1\t101")
+
+
+@pytest.mark.parametrize("memory_budget", [1, 1000, 1024 * 1024])
+def test_spilling_key_set(memory_budget):
+    keys = [hash_key(str(i % 500).encode()) for i in range(2000)]
+    with SpillingKeySet(memory_budget) as key_set:
+        added = [key_set.add(key) for key in keys]
+
+        assert added == [i < 500 for i in range(2000)]
+        assert len(key_set) == 500
+        assert key_set.spilled == (memory_budget < 1024 * 1024)
+
+
+def test_spilling_key_set__merges_runs_in_tiers():
+    keys = [hash_key(str(i).encode()) for i in range(50000)]
+    with SpillingKeySet(100 * 1000) as key_set:
+        assert all(key_set.add(key) for key in keys)
+        assert not any(key_set.add(key) for key in keys)
+
+        assert len(key_set) == 50000
+        # 50 runs of 1000 keys are merged into 3 runs of 16000 and 2 of 1000.
+        assert [len(run) for run in key_set._runs] == [16000] * 3 + [1000] * 2
+        # The filter grew from 4000 keys to 64000, 2 bytes each.
+        assert len(key_set._filter._bits) == 64000 * 2
+
+
+def test_key_filter__grow_keeps_keys():
+    keys = [hash_key(str(i).encode()) for i in range(1000)]
+    key_filter = _KeyFilter(1000)
+    key_filter.update(keys)
+    for _ in range(3):
+        key_filter.grow()
+        assert all(key in key_filter for key in keys)
+    assert key_filter.capacity == 8000
+
+
+def _body(output: bytes) -> bytes:
+    return b"".join(
+        line
+        for line in gzip.decompress(output).splitlines(True)
+        if not line.startswith(b"#")
+    )
+
+
+@pytest.mark.parametrize("dedup_memory", [100, 256 * 1024 * 1024])
+def test_aggregate_mafs__deduplicate(aggregate, generated_mafs, dedup_memory):
+    (filename,) = generated_mafs(1, 300)
+
+    expected = aggregate([filename])
+    output, stats = aggregate(
+        [filename, filename], deduplicate=DEDUP_COLUMNS, dedup_memory=dedup_memory
+    )
+
+    assert _body(output) == _body(expected.output)
+    assert stats.row_count == 300
+    assert stats.duplicate_count == 300
+
+
+def test_aggregate_mafs__deduplicate_with_columns(aggregate, generated_mafs):
+    (filename,) = generated_mafs(1, 100)
+
+    expected = aggregate([filename], columns=["Hugo_Symbol"])
+    output, stats = aggregate(
+        [filename, filename], columns=["Hugo_Symbol"], deduplicate=DEDUP_COLUMNS
+    )
+
+    assert _body(output) == _body(expected.output)
+    assert stats.duplicate_count == 100
+
+
+def test_aggregate_mafs__deduplicate_on_missing_column_fails(aggregate, generated_mafs):
+    filenames = generated_mafs(1, 10)
+
+    with pytest.raises(Exception, match="Deduplication columns are missing"):
+        aggregate(filenames, deduplicate=["Nonexistent"])
+
+
+def test_aggregate_mafs__deduplicate_with_processes_fails(aggregate):
+    with pytest.raises(ValueError):
+        aggregate([gzip.compress(b"")], deduplicate=DEDUP_COLUMNS, processes=2)
@@ -0,0 +1,125 @@
+import gzip
+import io
+import tempfile
+
+import freezegun
+import pytest
+
+from aliquot_level_maf.index import (
+    AliquotIndex,
+    RegionIndex,
+    read_aliquot,
+    read_region,
+)
+
+
+def _expected_rows(maf: bytes, chromosome: str, start: int, end: int):
+    rows = [
+        line.split("\t")
+        for line in gzip.decompress(maf).decode().splitlines()
+        if not line.startswith("#") and not line.startswith("Hugo_Symbol")
+    ]
+    return [
+        "\t".join(r)
+        for r in rows
+        if r[4] == chromosome and int(r[5]) <= end and int(r[6]) >= start
+    ]
+
+
+def test_read_region__sorted_output(aggregate, generated_mafs):
+    index_file = io.BytesIO()
+    maf = aggregate(
+        generated_mafs(4, 1000), sort_by_coordinate=True, region_index=index_file
+    ).output
+    index_file.seek(0)
+    index = RegionIndex.read(index_file)
+
+    for chromosome, start, end in [
+        ("chr1", 1, 250_000_000),
+        ("chr2", 50_000_000, 60_000_000),
+        ("chrX", 100_000_000, 100_000_001),
+        ("chrM", 1, 100),
+    ]:
+        rows = list(read_region(io.BytesIO(maf), index, chromosome, start, end))
+        assert rows == _expected_rows(maf, chromosome, start, end)
+
+
+def test_read_region__unsorted_output(aggregate, generated_mafs):
+    index_file = io.BytesIO()
+    maf = aggregate(generated_mafs(3, 1000), region_index=index_file).output
+    index_file.seek(0)
+    index = RegionIndex.read(index_file)
+
+    rows = list(read_region(io.BytesIO(maf), index, "chr3", 10_000_000, 90_000_000))
+    assert rows
+    assert rows == _expected_rows(maf, "chr3", 10_000_000, 90_000_000)
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__bgzf_output_is_gzip(aggregate, generated_mafs):
+    filenames = generated_mafs(2, 500)
+    plain = aggregate(filenames).output
+    bgzf = aggregate(filenames, bgzf=True).output
+
+    with tempfile.TemporaryFile() as file:
+        file.write(bgzf)
+        file.seek(0)
+        with gzip.open(file) as reader:
+            assert (
+                reader.read().splitlines()[1:]
+                == gzip.decompress(plain).splitlines()[1:]
+            )
+
+
+def _body_rows(filename: str):
+    with gzip.open(filename, "rt") as f:
+        return [line.rstrip("\n") for line in f if not line.startswith("#")][1:]
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"compression_threads": 2}, {"bgzf": True}, {"columns": ["Chromosome"]}],
+)
+def test_read_aliquot(aggregate, generated_mafs, options):
+    filenames = generated_mafs(3, 700)
+    index_file = io.BytesIO()
+    maf = aggregate(filenames, aliquot_index=index_file, **options).output
+    index_file.seek(0)
+    index = AliquotIndex.read(index_file)
+
+    assert [e.tumor_aliquot_submitter_id for e in index.entries] == [
+        "submitter_id_0",
+        "submitter_id_1",
+        "submitter_id_2",
+    ]
+    decompressed = gzip.decompress(maf)
+    header = decompressed[: index.header.uncompressed_size].decode().splitlines()
+    assert header[-1].startswith("Chromosome" if options.get("columns") else "Hugo")
+    for i, entry in enumerate(index.entries):
+        expected = _body_rows(filenames[i])
+        if options.get("columns"):
+            expected = [row.split("\t")[4] for row in expected]
+        rows = list(
+            read_aliquot(io.BytesIO(maf), index, entry.tumor_aliquot_submitter_id)
+        )
+        assert rows == expected
+        assert entry.row_count == len(expected)
+        begin = entry.uncompressed_offset
+        body = decompressed[begin : begin + entry.uncompressed_size]
+        assert body.decode().splitlines() == expected
+
+
+@freezegun.freeze_time("2020-03-23")
+def test_aggregate_mafs__aliquot_index_output_matches(aggregate, generated_mafs):
+    filenames = generated_mafs(2, 300)
+    plain = aggregate(filenames).output
+    indexed = aggregate(filenames, aliquot_index=io.BytesIO()).output
+    assert gzip.decompress(indexed) == gzip.decompress(plain)
+
+
+def test_read_aliquot__missing_aliquot(aggregate, generated_mafs):
+    index_file = io.BytesIO()
+    maf = aggregate(generated_mafs(1, 10), aliquot_index=index_file).output
+    index_file.seek(0)
+    with pytest.raises(KeyError):
+        list(read_aliquot(io.BytesIO(maf), AliquotIndex.read(index_file), "missing"))
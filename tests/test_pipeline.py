@@ -0,0 +1,229 @@
+import gzip
+import io
+import threading
+from datetime import datetime
+
+import pytest
+
+from aliquot_level_maf.aggregation import AliquotLevelMaf, aggregate_mafs
+from aliquot_level_maf.pipeline import (
+    LazyAliquotLevelMaf,
+    aggregate_primary_aliquots,
+)
+from aliquot_level_maf.selection import (
+    PrimaryAliquotSelectionCriterion,
+    SampleCriterion,
+)
+
+
+class _Opener:
+    """Opens in-memory MAFs, tracking which were opened and how many are open."""
+
+    def __init__(self, contents, seekable=True):
+        self.contents = contents
+        self.seekable = seekable
+        self.opened = []
+        self.open_count = 0
+        self.max_open_count = 0
+        self._lock = threading.Lock()
+
+    def lazy_maf(self, id_):
+        return LazyAliquotLevelMaf(lambda: self._open(id_), f"submitter_{id_}")
+
+    def _open(self, id_):
+        opener = self
+
+        class File(io.BytesIO):
+            def seekable(self):
+                return opener.seekable
+
+            def close(self):
+                if not self.closed:
+                    with opener._lock:
+                        opener.open_count -= 1
+                super().close()
+
+        with self._lock:
+            self.opened.append(id_)
+            self.open_count += 1
+            self.max_open_count = max(self.max_open_count, self.open_count)
+        return File(self.contents[id_])
+
+
+def _criteria(case_count, candidates_per_case):
+    criteria = []
+    for case in range(case_count):
+        for candidate in range(candidates_per_case):
+            sample_type = "Primary Tumor" if candidate == 1 else "Metastatic"
+            criteria.append(
+                PrimaryAliquotSelectionCriterion(
+                    id=f"{case}_{candidate}",
+                    samples=[
+                        SampleCriterion(f"sample_{case}_{candidate}", sample_type)
+                    ],
+                    entity_id=f"case_{case}",
+                    maf_creation_date=datetime(2020, 1, 1),
+                )
+            )
+    return criteria
+
+
+@pytest.fixture
+def contents(generated_mafs):
+    contents = {}
+    for i, filename in enumerate(generated_mafs(12, 20)):
+        with open(filename, "rb") as f:
+            contents[f"{i // 3}_{i % 3}"] = f.read()
+    return contents
+
+
+@pytest.mark.parametrize(
+    "options,max_open_files",
+    [
+        ({}, 1),
+        ({"decompression_threads": 4}, 2),
+        ({"preflight": True}, 4),
+        ({"processes": 2}, 1),
+        ({"aliquot_index": io.BytesIO()}, 1),
+    ],
+)
+def test_aggregate_primary_aliquots(contents, options, max_open_files):
+    opener = _Opener(contents)
+    output = io.BytesIO()
+    result = aggregate_primary_aliquots(
+        _criteria(4, 3),
+        {id_: opener.lazy_maf(id_) for id_ in contents},
+        output,
+        max_open_files=max_open_files,
+        **options,
+    )
+
+    selected = ["0_1", "1_1", "2_1", "3_1"]
+    assert {e: p.id for e, p in result.primary_aliquots.items()} == {
+        f"case_{case}": f"{case}_1" for case in range(4)
+    }
+    assert sorted(opener.opened) == selected
+    assert opener.open_count == 0
+    assert opener.max_open_count <= max_open_files
+
+    expected = io.BytesIO()
+    aggregate_mafs(
+        [
+            AliquotLevelMaf(io.BytesIO(contents[id_]), f"submitter_{id_}")
+            for id_ in selected
+        ],
+        expected,
+    )
+    assert gzip.decompress(output.getvalue()) == gzip.decompress(expected.getvalue())
+    assert [f.tumor_aliquot_submitter_id for f in result.stats.files] == [
+        f"submitter_{id_}" for id_ in selected
+    ]
+
+
+def test_aggregate_primary_aliquots__closes_skipped_inputs():
+    opener = _Opener({"0_0": gzip.compress(b""), "0_1": gzip.compress(b"")})
+    result = aggregate_primary_aliquots(
+        _criteria(1, 2), {id_: opener.lazy_maf(id_) for id_ in ["0_1"]}, io.BytesIO()
+    )
+
+    assert opener.opened == ["0_1"]
+    assert opener.open_count == 0
+    assert result.stats.skipped == ["submitter_0_1"]
+
+
+def test_aggregate_primary_aliquots__missing_mafs_fail():
+    with pytest.raises(ValueError, match="0_1"):
+        aggregate_primary_aliquots(_criteria(1, 2), {}, io.BytesIO())
+
+
+def test_aggregate_primary_aliquots__preflight_over_max_open_files_fails(contents):
+    opener = _Opener(contents)
+    with pytest.raises(ValueError, match="max_open_files"):
+        aggregate_primary_aliquots(
+            _criteria(4, 3),
+            {id_: opener.lazy_maf(id_) for id_ in contents},
+            io.BytesIO(),
+            max_open_files=3,
+            preflight=True,
+        )
+    assert opener.opened == []
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+def test_aggregate_primary_aliquots__fallbacks(contents, seekable):
+    contents = dict(contents, **{"0_1": gzip.compress(b""), "2_1": b""})
+    opener = _Opener(contents, seekable)
+    output = io.BytesIO()
+    result = aggregate_primary_aliquots(
+        _criteria(4, 3),
+        {id_: opener.lazy_maf(id_) for id_ in contents},
+        output,
+        fallbacks=1,
+    )
+
+    assert {e: p.id for e, p in result.primary_aliquots.items()} == {
+        "case_0": "0_0",
+        "case_1": "1_1",
+        "case_2": "2_0",
+        "case_3": "3_1",
+    }
+    # The MAFs whose headers were read are not opened again.
+    assert sorted(opener.opened) == ["0_0", "0_1", "1_1", "2_0", "2_1", "3_1"]
+    assert opener.open_count == 0
+    assert result.stats.skipped == []
+    selected = ["0_0", "1_1", "2_0", "3_1"]
+    assert [f.tumor_aliquot_submitter_id for f in result.stats.files] == [
+        f"submitter_{id_}" for id_ in selected
+    ]
+
+    expected = io.BytesIO()
+    aggregate_mafs(
+        [
+            AliquotLevelMaf(io.BytesIO(contents[id_]), f"submitter_{id_}")
+            for id_ in selected
+        ],
+        expected,
+    )
+    assert gzip.decompress(output.getvalue()) == gzip.decompress(expected.getvalue())
+
+
+def test_aggregate_primary_aliquots__fallbacks_read_headers_concurrently(contents):
+    opener = _Opener(contents)
+    barrier = threading.Barrier(2, timeout=10)
+    waits = [barrier.wait, barrier.wait]
+    open_ = opener._open
+
+    def open_after_barrier(id_):
+        # The first two MAFs are only opened once both are being opened.
+        with opener._lock:
+            wait = waits.pop() if waits else None
+        if wait is not None:
+            wait()
+        return open_(id_)
+
+    opener._open = open_after_barrier
+    result = aggregate_primary_aliquots(
+        _criteria(4, 3),
+        {id_: opener.lazy_maf(id_) for id_ in contents},
+        io.BytesIO(),
+        max_open_files=2,
+        fallbacks=1,
+    )
+
+    assert len(result.stats.files) == 4
+    assert opener.max_open_count <= 2
+    assert opener.open_count == 0
+
+
+def test_aggregate_primary_aliquots__fallbacks_exhausted(contents):
+    contents = dict(contents, **{"0_0": b"", "0_1": b""})
+    opener = _Opener(contents)
+    result = aggregate_primary_aliquots(
+        _criteria(1, 3),
+        {id_: opener.lazy_maf(id_) for id_ in ["0_0", "0_1"]},
+        io.BytesIO(),
+        fallbacks=1,
+    )
+
+    assert result.primary_aliquots["case_0"].id == "0_1"
+    assert result.stats.skipped == ["submitter_0_1"]
@@ -1,8 +1,15 @@
+import random
 from datetime import datetime
+from typing import List
+
+import pytest
 
 from aliquot_level_maf.selection import (
     PrimaryAliquotSelectionCriterion,
     select_primary_aliquots,
+    select_primary_aliquots_streaming,
+    PrimaryAliquotSelector,
+    select_ranked_aliquots,
     SampleCriterion,
     PrimaryAliquot,
 )
@@ -176,3 +183,156 @@ def test_select_primary_aliquots__handles_multiple_cases():
 def test_select_primary_aliquots__no_criteria():
     results = select_primary_aliquots([])
     assert len(results.items()) == 0
+
+
+def _random_criteria(count: int, seed: int) -> List[PrimaryAliquotSelectionCriterion]:
+    rng = random.Random(seed)  # nosec
+    sample_types = ["Primary Tumor", "Metastatic", "Recurrent Tumor", "Unknown"]
+    return [
+        PrimaryAliquotSelectionCriterion(
+            id=str(rng.randint(0, count)),
+            samples=[
+                SampleCriterion(
+                    id=f"sample_{i}_{j}", sample_type=rng.choice(sample_types)
+                )
+                for j in range(rng.randint(0, 3))
+            ],
+            entity_id=f"case_{rng.randint(0, count // 5)}",
+            maf_creation_date=datetime(2020, 1, rng.randint(1, 3)),
+        )
+        for i in range(count)
+    ]
+
+
+def test_select_primary_aliquots_streaming__matches_select_primary_aliquots():
+    criteria = _random_criteria(2000, seed=0)
+    expected = select_primary_aliquots(criteria)
+    results = select_primary_aliquots_streaming(c for c in criteria)
+    assert results == expected
+    assert list(results) == list(expected)
+
+
+def test_select_primary_aliquots_streaming__no_criteria():
+    assert select_primary_aliquots_streaming(iter([])) == {}
+
+
+def test_select_ranked_aliquots__first_matches_select_primary_aliquots():
+    criteria = _random_criteria(2000, seed=0)
+    results = select_ranked_aliquots(criteria, k=1)
+    assert {e: aliquots[0] for e, aliquots in results.items()} == (
+        select_primary_aliquots(criteria)
+    )
+    assert all(len(aliquots) == 1 for aliquots in results.values())
+
+
+def test_select_ranked_aliquots__ranks_candidates():
+    criteria = [c._replace(id=str(i)) for i, c in enumerate(_random_criteria(2000, 1))]
+    results = select_ranked_aliquots(iter(criteria), k=3)
+
+    remaining = list(criteria)
+    for rank in range(3):
+        expected = select_primary_aliquots(remaining)
+        assert {
+            e: aliquots[rank] for e, aliquots in results.items() if len(aliquots) > rank
+        } == expected
+        # Excluding the selected aliquots makes the next ones primary.
+        selected = {p.id for p in expected.values()}
+        remaining = [c for c in remaining if c.id not in selected]
+
+
+def test_select_ranked_aliquots__skips_duplicate_ids():
+    def criterion(id_, sample_type):
+        return PrimaryAliquotSelectionCriterion(
+            id=id_,
+            samples=[SampleCriterion(id=f"sample_{id_}", sample_type=sample_type)],
+            entity_id="case_1",
+            maf_creation_date=datetime(2020, 1, 1),
+        )
+
+    criteria = [
+        criterion("1", "Metastatic"),
+        criterion("2", "Primary Tumor"),
+        criterion("2", "Primary Tumor"),
+        criterion("3", "Recurrent Tumor"),
+        criterion("1", "Primary Tumor"),
+    ]
+    results = select_ranked_aliquots(criteria[:4], k=2)
+    assert [aliquot.id for aliquot in results["case_1"]] == ["2", "1"]
+    results = select_ranked_aliquots(criteria, k=2)
+    assert [aliquot.id for aliquot in results["case_1"]] == ["1", "2"]
+
+
+def test_select_ranked_aliquots__invalid_k_fails():
+    with pytest.raises(ValueError):
+        select_ranked_aliquots([], k=0)
+
+
+def test_primary_aliquot_selector__matches_select_primary_aliquots():
+    rng = random.Random(1)  # nosec
+    criteria = [c._replace(id=str(i)) for i, c in enumerate(_random_criteria(500, 0))]
+    selector = PrimaryAliquotSelector(criteria[:300])
+    current = {c.id: c for c in criteria[:300]}
+    assert selector.primary_aliquots() == select_primary_aliquots(criteria[:300])
+
+    for criterion in criteria[300:]:
+        selector.add(criterion)
+        current[criterion.id] = criterion
+        removed = rng.choice(sorted(current))
+        selector.remove(removed)
+        del current[removed]
+
+        expected = select_primary_aliquots(list(current.values()))
+        assert selector.get(criterion.entity_id) == expected.get(criterion.entity_id)
+    assert selector.primary_aliquots() == expected
+
+
+def test_primary_aliquot_selector__add_replaces_same_id():
+    criterion = PrimaryAliquotSelectionCriterion(
+        id="1",
+        samples=[SampleCriterion(id="sample_1", sample_type="Primary Tumor")],
+        entity_id="case_1",
+        maf_creation_date=datetime(2020, 1, 1),
+    )
+    selector = PrimaryAliquotSelector([criterion])
+    selector.add(criterion._replace(entity_id="case_2"))
+
+    assert selector.get("case_1") is None
+    assert selector.get("case_2") == PrimaryAliquot(id="1", sample_id="sample_1")
+
+
+def test_primary_aliquot_selector__changes():
+    def criterion(id_, sample_type, entity_id="case_1"):
+        return PrimaryAliquotSelectionCriterion(
+            id=id_,
+            samples=[SampleCriterion(id=f"sample_{id_}", sample_type=sample_type)],
+            entity_id=entity_id,
+            maf_creation_date=datetime(2020, 1, 1),
+        )
+
+    selector = PrimaryAliquotSelector(
+        [criterion("1", "Metastatic"), criterion("2", "Metastatic", "case_2")]
+    )
+    assert selector.changes() == {
+        "case_1": PrimaryAliquot(id="1", sample_id="sample_1"),
+        "case_2": PrimaryAliquot(id="2", sample_id="sample_2"),
+    }
+    assert selector.changes() == {}
+
+    selector.add(criterion("3", "Recurrent Tumor"))
+    assert selector.changes() == {}
+
+    selector.add(criterion("4", "Primary Tumor"))
+    selector.remove("2")
+    assert selector.changes() == {
+        "case_1": PrimaryAliquot(id="4", sample_id="sample_4"),
+        "case_2": None,
+    }
+
+    selector.remove("4")
+    selector.add(criterion("4", "Primary Tumor"))
+    assert selector.changes() == {}
+
+
+def test_primary_aliquot_selector__remove_unknown_id_fails():
+    with pytest.raises(KeyError):
+        PrimaryAliquotSelector().remove("1")
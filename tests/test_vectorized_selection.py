@@ -0,0 +1,39 @@
+import pytest
+
+from aliquot_level_maf.selection import select_primary_aliquots
+from tests.test_selection import _random_criteria
+
+np = pytest.importorskip("numpy")
+
+from aliquot_level_maf.vectorized_selection import (  # noqa: E402
+    select_primary_aliquots_vectorized,
+)
+
+
+def test_select_primary_aliquots_vectorized__matches_select_primary_aliquots():
+    criteria = _random_criteria(2000, seed=1)
+    rows = [(c, s) for c in criteria for s in c.samples]
+    results = select_primary_aliquots_vectorized(
+        criterion_ids=np.array([c.id for c, _ in rows]),
+        entity_ids=np.array([c.entity_id for c, _ in rows]),
+        sample_ids=np.array([s.id for _, s in rows]),
+        sample_types=np.array([s.sample_type for _, s in rows]),
+        maf_creation_dates=np.array(
+            [c.maf_creation_date for c, _ in rows], dtype="datetime64[s]"
+        ),
+    )
+
+    expected = select_primary_aliquots(criteria)
+    assert results == expected
+    assert list(results) == list(expected)
+
+
+def test_select_primary_aliquots_vectorized__no_rows():
+    empty = np.array([], dtype=str)
+    results = select_primary_aliquots_vectorized(empty, empty, empty, empty, empty)
+    assert results == {}
+
+
+def test_select_primary_aliquots_vectorized__mismatched_lengths_fail():
+    with pytest.raises(ValueError, match="same length"):
+        select_primary_aliquots_vectorized(["1"], ["case_1"], ["s"], [], [1])